@@ -0,0 +1,52 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Per call overhead of building commands from attributes, sh.mkfs.ext4 and so on.
+
+	python benchmarks/attribute_chain.py [checkout]
+
+checkout is another copy of pyshell to measure instead, to compare against an older version.
+"""
+
+import os
+import sys
+import timeit
+
+def best(function, number: int) -> float:
+	# Microseconds per call, the best of a few repeats
+	return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+def main():
+	root = sys.argv[1] if len(sys.argv) > 1 else os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	sys.path.insert(0, root)
+	from pyshell.pyshell import pyshell
+	sh = pyshell()
+
+	def deep():
+		return sh.one.two.three.four
+	print(f'sh.mkfs.ext4 without calling it  {best(lambda: sh.mkfs.ext4, 2000):9.2f} us')
+	print(f'sh.one.two.three.four            {best(deep, 2000):9.2f} us')
+	print(f'sh.true()                        {best(lambda: sh.true(), 300):9.2f} us')
+
+	def nested():
+		# A chain built inside a loop body further down the stack
+		return sh.echo._n('x', capture_output=True)
+	print(f"sh.echo._n('x') captured         {best(nested, 300):9.2f} us")
+
+if __name__ == '__main__':
+	main()
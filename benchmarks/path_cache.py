@@ -0,0 +1,72 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+"""How long a fresh process takes for its first $PATH lookup, with and without the on-disk index.
+
+	python benchmarks/path_cache.py
+
+Every case is a new interpreter, the best of a few runs is printed.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+RUNS = 7
+_CODE = ('import time\n'
+		'from pyshell.pyshell import _path_index\n'
+		'start = time.perf_counter()\n'
+		'count = len(_path_index.programs())\n'
+		'print((time.perf_counter() - start) * 1000, count)\n')
+
+def first_lookup(env: dict) -> tuple:
+	best = None
+	for _ in range(RUNS):
+		out = subprocess.run([sys.executable, '-c', _CODE], env=env, capture_output=True, text=True, check=True).stdout
+		elapsed, count = out.split()
+		best = float(elapsed) if best is None else min(best, float(elapsed))
+	return best, int(count)
+
+def main():
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	cache = tempfile.mkdtemp(prefix='pyshell-bench-')
+	bindir = tempfile.mkdtemp(prefix='pyshell-bench-bin-')
+	env = dict(os.environ, PYTHONPATH=root, PYSHELL_PATH_CACHE=cache)
+	try:
+		elapsed, count = first_lookup(dict(env, PYSHELL_PATH_CACHE='0'))
+		dirs = len(env.get('PATH', os.defpath).split(os.pathsep))
+		print(f'{dirs} directories on $PATH, {count} files')
+		print(f'no cache               {elapsed:7.2f} ms')
+		shutil.rmtree(cache)
+		out = subprocess.run([sys.executable, '-c', _CODE], env=env, capture_output=True, text=True, check=True).stdout
+		print(f'cold cache             {float(out.split()[0]):7.2f} ms')
+		print(f'warm cache             {first_lookup(env)[0]:7.2f} ms')
+		# One directory changed since the cache was written, only that one is listed again
+		env['PATH'] = bindir + os.pathsep + env.get('PATH', os.defpath)
+		first_lookup(env)
+		open(os.path.join(bindir, 'new-program'), 'w').close()
+		out = subprocess.run([sys.executable, '-c', _CODE], env=env, capture_output=True, text=True, check=True).stdout
+		print(f'one directory changed  {float(out.split()[0]):7.2f} ms')
+	finally:
+		shutil.rmtree(cache, ignore_errors=True)
+		shutil.rmtree(bindir, ignore_errors=True)
+
+if __name__ == '__main__':
+	main()
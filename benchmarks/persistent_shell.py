@@ -0,0 +1,73 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Per command latency of shell= commands, a fresh shell each time against the persistent one.
+
+	python benchmarks/persistent_shell.py [shell ...]
+
+For each shell (bash and sh by default) a few commands are run RUNS times each, with
+persistent=False and with persistent=True. The persistent shell is started and warmed up
+before the timing, what it costs to start is printed on its own.
+"""
+
+import os
+import sys
+import time
+import shutil
+
+RUNS = 200
+COMMANDS = (
+	'echo hi >/dev/null',
+	# Only builtins, nothing for either of them to exec
+	'x=1; test "$x" = 1',
+	'ls / >/dev/null',
+)
+
+def per_call(shell, command: str, persistent: bool) -> float:
+	# Milliseconds per command, after a few to warm up
+	for _ in range(5):
+		shell(command, persistent=persistent)
+	start = time.perf_counter()
+	for _ in range(RUNS):
+		shell(command, persistent=persistent)
+	return (time.perf_counter() - start) / RUNS * 1000
+
+def main():
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	from pyshell import pyshell
+	names = sys.argv[1:] or ['bash', 'sh']
+	print(f'Python {sys.version.split()[0]}, ms per command')
+	print(f"{'shell':>6}{'command':>22}{'fresh':>10}{'persistent':>12}")
+	for name in names:
+		executable = shutil.which(name)
+		if executable is None:
+			print(f'{name:>6}  not found')
+			continue
+		shell = pyshell(shell=executable)
+		start = time.perf_counter()
+		shell('true', persistent=True)
+		startup = (time.perf_counter() - start) * 1000
+		for command in COMMANDS:
+			print(f'{name:>6}{command[:20]:>22}{per_call(shell, command, False):10.2f}'
+				f'{per_call(shell, command, True):12.2f}')
+		print(f"{'':>6}{'start persistent':>22}{startup:22.2f}")
+		shell.close()
+
+if __name__ == '__main__':
+	main()
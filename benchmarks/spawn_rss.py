@@ -0,0 +1,89 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Time to start a command against how much memory the parent has.
+
+	python benchmarks/spawn_rss.py [MB ...]
+
+A plain fork copies the parent's page tables, so the bigger the parent the slower every
+command starts. For each size the parent grows to that many MB of touched memory and
+sh.true() is timed the default way, with fast_spawn=True (posix_spawn, vfork inside glibc)
+and with fork_server=True (forked from a small helper process).
+
+What the fork server costs up front is printed first: how long it takes to start and to
+run its first command, and how much memory it sits on while it waits.
+"""
+
+import os
+import sys
+import time
+
+RUNS = 200
+
+def per_call(shell) -> float:
+	# Milliseconds per sh.true(), after a few to warm up
+	for _ in range(5):
+		shell.true()
+	start = time.perf_counter()
+	for _ in range(RUNS):
+		shell.true()
+	return (time.perf_counter() - start) / RUNS * 1000
+
+def rss(pid: int) -> int:
+	# Resident memory in kB, from /proc
+	with open(f'/proc/{pid}/status') as status:
+		for line in status:
+			if line.startswith('VmRSS:'):
+				return int(line.split()[1])
+	return 0
+
+def server_cost(pyshell):
+	# Its own server, so the shared one below isn't started yet when this is timed
+	from pyshell import ForkServer
+	start = time.perf_counter()
+	server = ForkServer()
+	pyshell(fork_server=server).true()
+	elapsed = (time.perf_counter() - start) * 1000
+	print(f'fork server: {elapsed:.1f} ms to start and run the first command, '
+		f'{rss(server.process.pid) / 1024:.1f} MB resident')
+	server.close()
+
+def main():
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	from pyshell import pyshell
+	sizes = [int(size) for size in sys.argv[1:]] or [0, 512, 2048]
+	print(f'Python {sys.version.split()[0]}')
+	server_cost(pyshell)
+	shells = (
+		('default', pyshell()),
+		('fast_spawn', pyshell(fast_spawn=True)),
+		# Started now, while we're still small
+		('fork_server', pyshell(fork_server=True)),
+	)
+	print('ms per sh.true()')
+	print(f"{'parent':>9}" + ''.join(f'{name:>13}' for name, shell in shells))
+	for size in sizes:
+		ballast = bytearray(size * 1024 * 1024)
+		# Touch every page so it's really there
+		for offset in range(0, len(ballast), 4096):
+			ballast[offset] = 1
+		print(f'{size:>6} MB' + ''.join(f'{per_call(shell):13.2f}' for name, shell in shells))
+		del ballast
+
+if __name__ == '__main__':
+	main()
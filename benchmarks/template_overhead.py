@@ -0,0 +1,68 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""What prepare saves on every call.
+
+	python benchmarks/template_overhead.py
+
+First the Python side alone: run is stubbed out, so only working out the command is timed,
+sh.cp('-a', path, dest) against a template prepared with sh.ARG for the path. Then both
+for real with sh.true(), with an env of a few hundred vars that a template encodes once.
+"""
+
+import os
+import sys
+import time
+
+CALLS = 20000
+RUNS = 1000
+
+def per_call(function, count: int) -> float:
+	# Microseconds per call, after a few to warm up
+	for _ in range(50):
+		function()
+	start = time.perf_counter()
+	for _ in range(count):
+		function()
+	return (time.perf_counter() - start) / count * 1e6
+
+def main():
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	from pyshell import pyshell, ARG
+
+	class Nop(pyshell):
+		def run(self, *args, **kwargs):
+			return None
+
+	env = dict(os.environ, **{f'VAR{index}': 'x' * 40 for index in range(200)})
+	print(f'Python {sys.version.split()[0]}, {len(env)} vars in env')
+
+	nop = Nop(capture_output=True, text=True, env=env)
+	copy = nop.prepare('cp', '-a', ARG, '/tmp/dest/')
+	print(f"{'only python':>12}{'call':>14}{'template':>14}")
+	print(f"{'us/call':>12}{per_call(lambda: nop.cp('-a', 'file', '/tmp/dest/'), CALLS):14.2f}"
+		f"{per_call(lambda: copy('file'), CALLS):14.2f}")
+
+	shell = pyshell(env=env)
+	true = shell.prepare('true')
+	print(f"{'end to end':>12}{'call':>14}{'template':>14}")
+	print(f"{'us/call':>12}{per_call(shell.true, RUNS):14.0f}{per_call(true, RUNS):14.0f}")
+
+if __name__ == '__main__':
+	main()
@@ -1,5 +1,45 @@
+import threading as _threading
+
 # Import the class to top level
-from .pyshell import pyshell
+from .pyshell import pyshell, ARG
+
+# Everything else is only imported the first time it's asked for, so a script that
+# just runs a few commands doesn't pay for asyncio and the rest. name: module
+_lazy = {
+	'AsyncPyshell': 'aio',
+	'CommandLog': 'log',
+	'CommandMetrics': 'metrics',
+	'ResultCache': 'cache',
+	'CommandResult': 'result',
+	'Supervisor': 'supervisor',
+	'TaskGraph': 'graph',
+	'DependencyFailed': 'graph',
+	'ForkServer': 'forkserver',
+}
+
+__all__ = ['pyshell', 'ARG', 'shell', *_lazy]
+
+_shell_lock = _threading.Lock()
+
+def __getattr__(name: str):
+	if name == 'shell':
+		return _shell()
+	if name not in _lazy:
+		raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+	# The import lock already makes sure every thread gets the same module
+	from importlib import import_module
+	value = getattr(import_module(f'.{_lazy[name]}', __name__), name)
+	globals()[name] = value
+	return value
+
+def _shell():
+	# Only one shell, however many threads ask for it first at the same time
+	with _shell_lock:
+		value = globals().get('shell')
+		if value is None:
+			# Define a basic shell to import quick and dirty command spam
+			value = globals()['shell'] = pyshell()
+	return value
 
-# Define a basic shell to import quick and dirty command spam
-shell = pyshell()
+def __dir__():
+	return sorted(set(globals()) | set(__all__))
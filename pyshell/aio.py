@@ -0,0 +1,429 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import asyncio
+from subprocess import CalledProcessError, TimeoutExpired
+
+from .pyshell import (
+	pyshell, pyshellPopen, CommandNotFound,
+	_text_options, _LineSplitter, _feeder, _pipeline_name, _outcome, _parsed,
+	_OutputBuffer, _output_buffers, _joined, _bounded, _total_output, _output_shape, _stderr_buffer)
+from .log import _describe
+
+class AsyncPyshell(pyshell):
+
+	def __init__(self, *args, **kwargs):
+		"""pyshell for asyncio.
+
+		Takes the same arguments as pyshell and commands are built the same way,
+		they just have to be awaited. Aliases, input, capture_output, check, timeout
+		and logfile all work like they do with pyshell.
+
+		Children are started with pyshellPopen and everything else happens on the
+		event loop. Pipes are read with the loop's readers and exits are picked up
+		through a pidfd, so there is no thread per command and no child watcher involved.
+		Cancelling a command kills it.
+
+		iter_lines and iter_chunks give async iterators, and pipelines are awaited too.
+
+		Example::
+
+		sh = AsyncPyshell(capture_output=True)
+		result = await sh.ls._la('/tmp')
+
+		async for line in sh.journalctl.iter_lines('-f', text=True):
+			print(line, end='')
+
+		await (sh.cat.bind('/etc/passwd') | sh.wc._l)()
+		"""
+		super().__init__(*args, **kwargs)
+
+	def _run_chain(self, chain: tuple, *args, **kwargs):
+		return self._run_async(chain, args, kwargs)
+
+	def _run_template(self, name, commands: list, options: tuple, kwargs: dict):
+		input, capture_output, check, logfile, timeout, popen, compact, max_output, keep = options
+		record = None
+		metrics = self._metrics
+		if metrics is not None and not popen:
+			record = metrics.start()
+			metrics.resolved(record, name, commands)
+		# _run_process takes what it needs out of kwargs, the template keeps its own
+		return self._run_process(commands, input, capture_output, check, logfile, timeout,
+								popen, dict(kwargs), record, compact, max_output, keep)
+
+	async def _run_async(self, chain: tuple, args: tuple, kwargs: dict):
+		cache = kwargs.pop('cache', None)
+		depends = kwargs.pop('cache_depends', None)
+		parse = kwargs.pop('parse', None)
+		compact = self._compact_for(kwargs)
+		max_output, keep = self._output_limit(kwargs)
+		metrics = self._metrics
+		record = metrics.start() if metrics is not None else None
+		(name, commands, found, input, capture_output, check,
+		logfile, timeout, expect, popen, kwargs) = self._prepare(chain, args, **kwargs)
+
+		if not found:
+			raise CommandNotFound(f'command {name} does not exist')
+		if expect:
+			raise ValueError('expect may not be used with AsyncPyshell.')
+		if record is not None:
+			if popen:
+				record = None
+			else:
+				metrics.resolved(record, name, commands)
+
+		if parse is not None:
+			if popen or cache:
+				raise ValueError('parse may not be used with popen or cache.')
+			parser, text, encoding, errors = self._parse_options(name, found, parse, input, capture_output, kwargs)
+			outcome = []
+			async for chunk in self._stream(commands, input, check, logfile, timeout,
+											False, 65536, None, kwargs, record, outcome, max_output, keep):
+				parser.feed(chunk)
+			return _parsed(parser, outcome, text, encoding, errors)
+
+		store, ttl = self._cache_for(name, cache)
+		key = None
+		if store is not None and not popen:
+			key = self._cache_key(commands, found, input, capture_output, kwargs, depends,
+									cache is not None, _output_shape(compact, max_output, keep))
+		if key is not None:
+			result = store.get(key, ttl)
+			if result is not None:
+				return result
+			stored = time.monotonic()
+			snapshot = store.snapshot(depends) if depends else ()
+			result = await self._run_process(commands, input, capture_output, check,
+											logfile, timeout, popen, kwargs, record, compact, max_output, keep)
+			if result.returncode == 0:
+				store.put(key, result, snapshot, stored)
+			return result
+		return await self._run_process(commands, input, capture_output, check,
+									logfile, timeout, popen, kwargs, record, compact, max_output, keep)
+
+	async def _run_process(self, commands, input, capture_output, check,
+						logfile, timeout, popen, kwargs, record=None, compact=False, max_output=None, keep='tail'):
+		metrics = self._metrics
+		text, encoding, errors = _text_options(kwargs, input)
+		feeder = _feeder(input, encoding, errors)
+
+		if not capture_output:
+			if logfile:
+				kwargs['stdout'] = logfile.fileno()
+				kwargs['stderr'] = self.STDOUT
+		process = stdout = stderr = error = None
+		buffers = ()
+		if logfile:
+			started = logfile.begin(commands)
+		try:
+			process = pyshellPopen(commands, **kwargs)
+			if popen:
+				# We never see it finish, so there's only the start of a record
+				logfile = None
+				return process
+			try:
+				pipes = [file for file in (process.stdout, process.stderr) if file]
+				buffers = _output_buffers(max_output, keep, len(pipes))
+				try:
+					outputs = await asyncio.wait_for(_communicate(
+						process.stdin, feeder, [file.fileno() for file in pipes], (process,), buffers=buffers), timeout)
+				except asyncio.TimeoutError:
+					raise TimeoutExpired(process.args, timeout)
+			finally:
+				await _reap((process,))
+
+			outputs = iter(outputs)
+			stdout = next(outputs) if process.stdout else None
+			stderr = next(outputs) if process.stderr else None
+			result = _outcome(process.args, process.returncode, stdout, stderr,
+							check, text, encoding, errors, compact)
+			result.usage = process.rusage
+			if max_output is not None:
+				buffers = iter(buffers)
+				_bounded(result, next(buffers) if process.stdout else None, next(buffers) if process.stderr else None)
+			return result
+		except BaseException as exc:
+			error = exc
+			raise
+		finally:
+			if feeder is not None:
+				feeder.close()
+			if logfile:
+				if process is None:
+					logfile.end(commands, started)
+				else:
+					logfile.end(commands, started, process.pid, process.returncode, stdout, stderr)
+			if record is not None:
+				metrics.finish(record, (process,) if process else (), stdout=stdout, stderr=stderr,
+							bytes_in=feeder.written if feeder is not None else None,
+							bytes_out=_total_output(buffers), error=error)
+
+	async def _stream(self, commands, input, check, logfile, timeout,
+				lines, chunk_size, max_line, kwargs, record=None, outcome=None, max_output=None, keep='tail'):
+		loop = asyncio.get_running_loop()
+		text, encoding, errors = _text_options(kwargs, input)
+		feeder = _feeder(input, encoding, errors)
+
+		process = error = stderr = None
+		received = 0
+		if logfile:
+			if not logfile.tee:
+				kwargs['stderr'] = logfile.fileno()
+			started = logfile.begin(commands, streaming=True)
+
+		splitter = _LineSplitter(text and encoding, errors, max_line) if lines else None
+		deadline = None if timeout is None else loop.time() + timeout
+
+		try:
+			process = pyshellPopen(commands, **kwargs)
+			tasks = []
+			try:
+				if process.stdin:
+					if feeder is not None:
+						tasks.append(loop.create_task(_write(process.stdin, feeder)))
+					else:
+						process.stdin.close()
+				if process.stderr:
+					stderr = _stderr_buffer(max_output, keep)
+					tasks.append(loop.create_task(_collect(process.stderr.fileno(), stderr)))
+
+				chunks = _read_chunks(process.stdout.fileno(), chunk_size)
+				try:
+					while True:
+						try:
+							data = await asyncio.wait_for(chunks.__anext__(), _remaining(loop, deadline))
+						except StopAsyncIteration:
+							break
+						except asyncio.TimeoutError:
+							raise TimeoutExpired(process.args, timeout)
+						received += len(data)
+						if logfile:
+							logfile.write(data)
+						if not lines:
+							yield data
+							continue
+						for line in splitter.feed(data):
+							yield line
+				finally:
+					await chunks.aclose()
+
+				# Whatever is left didn't end with a newline
+				if lines:
+					for line in splitter.flush():
+						yield line
+
+				try:
+					await asyncio.wait_for(
+						_communicate(None, None, [], (process,), tasks), _remaining(loop, deadline))
+				except asyncio.TimeoutError:
+					raise TimeoutExpired(process.args, timeout)
+
+				retcode = process.returncode
+				if outcome is not None:
+					outcome.append((process, stderr.getvalue() if stderr is not None else None))
+				if check and retcode:
+					output = stderr.getvalue() if stderr is not None else None
+					if output is not None and text:
+						output = output.decode(encoding, errors)
+					raise CalledProcessError(retcode, process.args, stderr=output)
+			finally:
+				# Timed out, raised, cancelled or the caller stopped reading
+				for task in tasks:
+					task.cancel()
+				await _reap((process,))
+		except BaseException as exc:
+			error = exc
+			raise
+		finally:
+			if feeder is not None:
+				feeder.close()
+			if logfile:
+				if process is None:
+					logfile.end(commands, started, streaming=True)
+				else:
+					logfile.end(commands, started, process.pid, process.returncode,
+								stderr=stderr.getvalue() if stderr is not None else b'', streaming=True)
+			if record is not None:
+				self._metrics.finish(record, (process,) if process else (),
+									bytes_in=feeder.written if feeder is not None else None,
+									bytes_out=received + (stderr.total if stderr is not None else 0), error=error)
+
+	def _run_pipeline(self, stages: tuple, **kwargs):
+		return self._run_pipeline_async(stages, kwargs)
+
+	async def _run_pipeline_async(self, stages: tuple, kwargs: dict):
+		metrics = self._metrics
+		record = metrics.start() if metrics is not None else None
+		compact = self._compact_for(kwargs)
+		max_output, keep = self._output_limit(kwargs)
+		(prepared, input, capture_output, check, logfile,
+		timeout, text, encoding, errors) = self._pipeline_options(stages, **kwargs)
+		if record is not None:
+			metrics.resolved(record, _pipeline_name(prepared), [commands for commands, popen_kwargs in prepared])
+
+		processes = []
+		errread = None
+		outputs = error = None
+		feeder = _feeder(input, encoding, errors)
+		if logfile:
+			description = ' | '.join(_describe(commands) for commands, popen_kwargs in prepared)
+			started = logfile.begin(description)
+		try:
+			errread = self._spawn_pipeline(prepared, input, capture_output, logfile, processes)
+			readers = buffers = []
+			if capture_output:
+				readers = [processes[-1].stdout.fileno(), errread]
+				buffers = _output_buffers(max_output, keep, 2)
+			try:
+				outputs = await asyncio.wait_for(
+					_communicate(processes[0].stdin, feeder, readers, processes, buffers=buffers), timeout)
+			except asyncio.TimeoutError:
+				raise TimeoutExpired([process.args for process in processes], timeout)
+
+			return self._pipeline_result(processes, outputs, check, text, encoding, errors, compact, buffers)
+		except BaseException as exc:
+			error = exc
+			raise
+		finally:
+			await _reap(processes)
+			if errread is not None:
+				os.close(errread)
+			if feeder is not None:
+				feeder.close()
+			if logfile:
+				logfile.end(description, started,
+							[process.pid for process in processes],
+							[process.returncode for process in processes],
+							*(outputs or ()))
+			if record is not None:
+				stdout, stderr = outputs or (None, None)
+				metrics.finish(record, processes, stdout=stdout, stderr=stderr,
+							bytes_in=feeder.written if feeder is not None else None,
+							bytes_out=_total_output(buffers), error=error)
+
+def _remaining(loop, deadline):
+	if deadline is None:
+		return None
+	return max(deadline - loop.time(), 0)
+
+async def _reap(processes):
+	# Stop whatever is still running and close its pipes. With a kill_grace that can take
+	# a while, so we wait for it here instead of blocking the loop in __exit__.
+	for process in processes:
+		if process.returncode is None:
+			process.stop()
+	for process in processes:
+		await _wait(process)
+		process.__exit__(None, None, None)
+
+def _set_ready(future):
+	if not future.done():
+		future.set_result(None)
+
+async def _ready(fd, write=False):
+	# Wait until the loop says fd can be read or written
+	loop = asyncio.get_running_loop()
+	future = loop.create_future()
+	if write:
+		loop.add_writer(fd, _set_ready, future)
+	else:
+		loop.add_reader(fd, _set_ready, future)
+	try:
+		await future
+	finally:
+		if write:
+			loop.remove_writer(fd)
+		else:
+			loop.remove_reader(fd)
+
+async def _read_chunks(fd, size=32768):
+	os.set_blocking(fd, False)
+	while True:
+		try:
+			data = os.read(fd, size)
+		except BlockingIOError:
+			await _ready(fd)
+			continue
+		if not data:
+			return
+		yield data
+
+async def _collect(fd, sink):
+	if not isinstance(sink, _OutputBuffer):
+		async for data in _read_chunks(fd):
+			sink.append(data)
+		return
+	# Straight into the buffer, no chunk of it is ever a bytes object of its own
+	os.set_blocking(fd, False)
+	while True:
+		try:
+			if not sink.read(fd):
+				return
+		except BlockingIOError:
+			await _ready(fd)
+
+async def _write(file, feeder):
+	fd = file.fileno()
+	os.set_blocking(fd, False)
+	try:
+		while not feeder.write(fd):
+			await _ready(fd, write=True)
+	finally:
+		file.close()
+
+async def _wait(process):
+	# A pidfd becomes readable when the child exits. Without one we fall back to polling.
+	if process.poll() is not None:
+		return
+	try:
+		pidfd = os.pidfd_open(process.pid)
+	except (AttributeError, OSError):
+		delay = 0.0005
+		while process.poll() is None:
+			await asyncio.sleep(delay)
+			delay = min(delay * 2, 0.05)
+		return
+	try:
+		while process.poll() is None:
+			await _ready(pidfd)
+	finally:
+		os.close(pidfd)
+
+async def _communicate(stdin, feeder, readers: list, processes, tasks=(), buffers=()):
+	"""Write what feeder has to stdin and read every fd in readers until they close,
+	then wait for every process to exit. Returns the bytes read from each reader.
+	buffers can have an _OutputBuffer for each reader to keep only part of it.
+	"""
+	outputs = [[] for fd in readers]
+	for number, buffer in enumerate(buffers):
+		if buffer is not None:
+			outputs[number] = buffer
+	work = list(tasks)
+	if stdin:
+		if feeder is not None:
+			work.append(_write(stdin, feeder))
+		else:
+			stdin.close()
+	work.extend(_collect(fd, sink) for fd, sink in zip(readers, outputs))
+	await asyncio.gather(*work)
+	for process in processes:
+		await _wait(process)
+	return [_joined(sink) for sink in outputs]
@@ -0,0 +1,174 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import copy
+import time
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+
+from .result import CommandResult
+
+class ResultCache(object):
+
+	def __init__(self, max_bytes: int=64 * 1024 * 1024, ttl: float=None):
+		"""Results of commands that give the same answer every time, kept in memory.
+
+		Arguments:
+			max_bytes: how much output to keep. The least recently used results go first once it's full.
+			ttl: how many seconds old a result may be unless the call says otherwise. None keeps it until it's pushed out.
+
+		Results are keyed on everything that could change the answer: the command after aliases,
+		input, env, cwd and the other Popen arguments. A result can also depend on files,
+		it's thrown away as soon as one of them has a different mtime or size.
+
+		hits, misses, evictions, expired and invalidated count what happened so far.
+
+		Example::
+
+		sh = pyshell(capture_output=True, cache=ResultCache(max_bytes=8 * 1024 * 1024, ttl=5))
+		sh.lsblk._J()
+		sh.dpkg._l(cache_depends=['/var/lib/dpkg/status'])
+		print(sh.result_cache.stats())
+		"""
+		self.max_bytes = max_bytes
+		self.ttl = ttl
+		self.size = 0
+		self.hits = self.misses = self.evictions = self.expired = self.invalidated = 0
+		self._lock = threading.Lock()
+		# key: (result, size, stored, depends)
+		self._entries = OrderedDict()
+
+	def get(self, key, ttl=None):
+		"""The result stored for key or None. ttl is how old it may be, it defaults to ours."""
+		if ttl is None:
+			ttl = self.ttl
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+			result, size, stored, depends = entry
+			if ttl is not None and time.monotonic() - stored >= ttl:
+				self.expired += 1
+			elif depends and _snapshot(path for path, stat in depends) != depends:
+				self.invalidated += 1
+			else:
+				self._entries.move_to_end(key)
+				self.hits += 1
+				# A copy, so whoever gets it can't change what the next caller sees
+				return copy.copy(result)
+			del self._entries[key]
+			self.size -= size
+			self.misses += 1
+			return None
+
+	def put(self, key, result, depends=(), stored=None):
+		"""Keep result for key.
+
+		depends is what snapshot() returned and stored what time.monotonic() said, both from before the command ran.
+		"""
+		size = _size(result)
+		if size > self.max_bytes:
+			return
+		if stored is None:
+			stored = time.monotonic()
+		with self._lock:
+			old = self._entries.pop(key, None)
+			if old is not None:
+				self.size -= old[1]
+			self._entries[key] = (copy.copy(result), size, stored, depends)
+			self.size += size
+			while self.size > self.max_bytes:
+				key, (result, size, stored, depends) = self._entries.popitem(last=False)
+				self.size -= size
+				self.evictions += 1
+
+	def snapshot(self, paths) -> tuple:
+		"""What the files a result depends on look like right now."""
+		return _snapshot(paths)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.size = 0
+
+	def stats(self) -> dict:
+		with self._lock:
+			return {'entries': len(self._entries), 'size': self.size, 'hits': self.hits, 'misses': self.misses,
+					'evictions': self.evictions, 'expired': self.expired, 'invalidated': self.invalidated}
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __repr__(self):
+		return f"ResultCache(max_bytes={self.max_bytes!r}, ttl={self.ttl!r})"
+
+def _snapshot(paths) -> tuple:
+	# A file that isn't there is part of the answer too
+	snapshot = []
+	for path in paths:
+		try:
+			stat = os.stat(path)
+			snapshot.append((path, (stat.st_mtime_ns, stat.st_size, stat.st_ino)))
+		except FileNotFoundError:
+			snapshot.append((path, None))
+	return tuple(snapshot)
+
+def _size(result) -> int:
+	# A CommandResult is measured by its bytes, reading stdout would decode it
+	if isinstance(result, CommandResult):
+		outputs = (result.stdout_bytes, result.stderr_bytes)
+	else:
+		outputs = (result.stdout, result.stderr)
+	return sum(len(output) for output in outputs if output is not None)
+
+def _freeze(value):
+	# Popen arguments as something we can hash
+	if isinstance(value, (str, bytes, int, type(None))):
+		return value
+	if isinstance(value, Mapping):
+		return frozenset((_freeze(key), _freeze(item)) for key, item in value.items())
+	if isinstance(value, (list, tuple)):
+		return tuple(map(_freeze, value))
+	if isinstance(value, (set, frozenset)):
+		return frozenset(map(_freeze, value))
+	if isinstance(value, os.PathLike):
+		return os.fspath(value)
+	return value
+
+def _environ() -> frozenset:
+	# os.environ keeps the real thing as bytes, reading that skips decoding every variable
+	data = getattr(os.environ, '_data', None)
+	if data is None:
+		return frozenset(os.environ.items())
+	return frozenset(data.items())
+
+def _cache_key(commands: list, input, kwargs: dict, depends=None, shape=()) -> tuple:
+	# Everything that goes into a command's answer. Unset env and cwd mean ours right now.
+	# shape is what pyshell took out of kwargs that changes the result, like compact or max_output
+	env = kwargs.get('env')
+	cwd = kwargs.get('cwd')
+	options = tuple(sorted(
+		(name, _freeze(value)) for name, value in kwargs.items()
+		if name not in ('env', 'cwd', 'stdout', 'stderr')))
+	return (_freeze(commands), input,
+			_environ() if env is None else _freeze(env),
+			os.getcwd() if cwd is None else os.fspath(cwd),
+			options, _freeze(depends), shape)
@@ -0,0 +1,189 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import shlex
+import signal
+import secrets
+import threading
+import weakref
+import selectors
+from subprocess import PIPE, TimeoutExpired
+
+from .pyshell import pyshellPopen, PyshellError, _PopenSelector
+
+class ShellCoprocess(object):
+
+	def __init__(self, shell: list):
+		"""A long lived shell that runs commands one at a time.
+
+		Arguments:
+			shell: the shell and its options, such as ['/bin/bash', '-O', 'extglob']
+
+		Commands are written to the shell's stdin. Each one runs in a subshell through eval,
+		so cd, exit or a syntax error only affect that command. Afterwards the shell prints a
+		random token and the exit status on stdout and the token on stderr, that's how we know
+		where the output of one command ends.
+
+		The shell starts on the first command. If a command times out the whole session is killed,
+		and the next command starts a new shell. Commands never see our stdin, it's /dev/null.
+
+		Every command runs where we are now, not where we were when the shell started. The same
+		goes for the environment, when os.environ has changed since then the shell is started again.
+		"""
+		self.shell = list(shell)
+		self._lock = threading.Lock()
+		self._process = None
+		self._finalizer = None
+		# os.environb as it was when the shell started
+		self._environ = None
+
+	def run(self, command: str, cwd=None, timeout=None, stdout=None, stderr=None):
+		"""Run command and return its exit status, stdout and stderr.
+
+		Arguments:
+			stdout, stderr: callables that get the output as it arrives. When left
+				as None the output is collected and returned instead.
+		"""
+		with self._lock:
+			environ = dict(os.environb)
+			if self._process is None or self._process.poll() is not None or environ != self._environ:
+				# A fresh shell would see the new environment, so this one has to as well
+				self._stop()
+				self._start(environ)
+			process = self._process
+
+			token = secrets.token_hex(16).encode()
+			if cwd is None:
+				cwd = os.getcwd()
+			cd = f"cd -- {shlex.quote(os.fspath(cwd))} && "
+			script = (
+				f"( {cd}eval {shlex.quote(command)} ) </dev/null\n"
+				f"printf '%s %d\\n' {token.decode()} $?\n"
+				f"printf '%s\\n' {token.decode()} >&2\n")
+
+			deadline = None if timeout is None else time.monotonic() + timeout
+			streams = {
+				process.stdout.fileno(): _Demux(token + b' ', stdout),
+				process.stderr.fileno(): _Demux(token + b'\n', stderr),
+			}
+			try:
+				process.stdin.write(script.encode())
+				process.stdin.flush()
+				with _PopenSelector() as selector:
+					for fd in streams:
+						selector.register(fd, selectors.EVENT_READ)
+					while selector.get_map():
+						if deadline is None:
+							ready = selector.select()
+						else:
+							remaining = deadline - time.monotonic()
+							if remaining <= 0:
+								raise TimeoutExpired(command, timeout,
+									output=streams[process.stdout.fileno()].output(),
+									stderr=streams[process.stderr.fileno()].output())
+							ready = selector.select(remaining)
+						for key, events in ready:
+							data = os.read(key.fd, 65536)
+							if not data:
+								raise PyshellError('the persistent shell exited unexpectedly')
+							if streams[key.fd].feed(data):
+								selector.unregister(key.fd)
+			except BaseException:
+				# Timed out, interrupted or the shell died. Nothing we can trust is left in there
+				self._stop()
+				raise
+
+			out = streams[process.stdout.fileno()]
+			returncode = int(out.rest.split(b'\n', 1)[0])
+			return returncode, out.output(), streams[process.stderr.fileno()].output()
+
+	def close(self):
+		"""Stop the shell. It will start again if another command is run."""
+		with self._lock:
+			self._stop()
+
+	def _start(self, environ: dict):
+		# In its own session so a timeout can take out everything the command started
+		self._process = pyshellPopen(self.shell, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+									start_new_session=True)
+		self._environ = environ
+		self._finalizer = weakref.finalize(self, _kill, self._process)
+
+	def _stop(self):
+		if self._finalizer is not None:
+			self._finalizer()
+			self._finalizer = None
+		self._process = None
+
+def _kill(process):
+	if process.poll() is None:
+		try:
+			os.killpg(process.pid, signal.SIGKILL)
+		except OSError:
+			process.kill()
+	process.__exit__(None, None, None)
+
+class _Demux(object):
+	"""Collects or forwards one stream of a command until its end marker shows up"""
+	__slots__ = ('marker', 'sink', 'buffer', 'found', 'rest', 'chunks')
+
+	def __init__(self, marker: bytes, sink=None):
+		self.marker = marker
+		self.sink = sink
+		self.buffer = bytearray()
+		self.found = False
+		self.rest = None
+		self.chunks = []
+
+	def feed(self, data: bytes) -> bool:
+		# Returns True once the marker and the line it is on have been seen
+		buffer = self.buffer
+		if not self.found:
+			start = max(len(buffer) - len(self.marker) + 1, 0)
+			buffer += data
+			index = buffer.find(self.marker, start)
+			if index < 0:
+				# Keep back enough to hold a marker that is cut in half
+				self._send(len(buffer) - len(self.marker) + 1)
+				return False
+			self._send(index)
+			del buffer[:len(self.marker)]
+			self.found = True
+		else:
+			buffer += data
+		if self.marker.endswith(b'\n') or b'\n' in buffer:
+			self.rest = bytes(buffer)
+			return True
+		return False
+
+	def _send(self, end: int):
+		if end <= 0:
+			return
+		data = bytes(self.buffer[:end])
+		del self.buffer[:end]
+		if self.sink is not None:
+			self.sink(data)
+		else:
+			self.chunks.append(data)
+
+	def output(self):
+		if self.sink is not None:
+			return None
+		return b''.join(self.chunks)
@@ -0,0 +1,240 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file is also the fork server itself. It runs as a script in a fresh interpreter,
+# so nothing outside the standard library may be imported here.
+
+import os
+import sys
+import errno
+import pickle
+import signal
+import socket
+import resource
+import itertools
+import selectors
+import threading
+import subprocess
+
+# Big enough for a large environment in one message
+_BUFFER = 4 * 1024 * 1024
+
+class ForkServer(object):
+
+	def __init__(self):
+		"""A small helper process that starts commands for us.
+
+		Forking a process with a heap of many GB means copying all of its page tables, every
+		command pays for that and needs the memory for it while it lasts. The fork server is a
+		fresh interpreter of a few MB started once. Commands are sent to it over a unix socket,
+		the stdio descriptors go along with SCM_RIGHTS, and it forks and execs them and tells
+		us their pid. When one exits it reaps it and sends back the exit status and rusage.
+
+		The commands are its children, not ours. They get our environment and working
+		directory as they are at the time, and pyshellPopen waits on them the same as always.
+
+		Start it while the heap is still small, pyshell(fork_server=True) starts the shared one.
+
+		Example::
+
+		server = ForkServer()
+		sh = pyshell(fork_server=server)
+		sh.true()
+		"""
+		ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+		for sock in (ours, theirs):
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _BUFFER)
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _BUFFER)
+		try:
+			# -S, it doesn't need site-packages and starts faster without them
+			self.process = subprocess.Popen([sys.executable, '-I', '-S', __file__, str(theirs.fileno())],
+											stdin=subprocess.DEVNULL, pass_fds=(theirs.fileno(),))
+		finally:
+			theirs.close()
+		self._socket = ours
+		self._owner = os.getpid()
+		self._send_lock = threading.Lock()
+		self._condition = threading.Condition(threading.Lock())
+		self._tokens = itertools.count()
+		# token: (pid, error), pid: (status, rusage)
+		self._replies = {}
+		self._exits = {}
+		self._closed = False
+		self._reader = threading.Thread(target=self._read, name='pyshell-forkserver', daemon=True)
+		self._reader.start()
+
+	@property
+	def usable(self) -> bool:
+		"""Whether commands can go through us. A forked copy of us can't share the socket."""
+		return not self._closed and self._owner == os.getpid()
+
+	def spawn(self, args: list, executable, fds: tuple, **options) -> int:
+		"""Start a command with fds as its stdin, stdout and stderr and return its pid.
+
+		options are Popen's, cwd, env, close_fds, start_new_session and so on.
+		Failing to start it raises the same error Popen would.
+		"""
+		token = next(self._tokens)
+		message = pickle.dumps((token, args, executable, options), pickle.HIGHEST_PROTOCOL)
+		with self._send_lock:
+			socket.send_fds(self._socket, [message], fds)
+		with self._condition:
+			while token not in self._replies:
+				if self._closed:
+					raise subprocess.SubprocessError('the fork server is gone')
+				self._condition.wait()
+			pid, error = self._replies.pop(token)
+		if error is not None:
+			raise error
+		return pid
+
+	def wait(self, pid: int, block: bool=True) -> tuple:
+		"""Like os.wait4 for one of the commands it started. Without block it's (0, 0, None) until it exited."""
+		with self._condition:
+			while pid not in self._exits:
+				if not block:
+					return 0, 0, None
+				if self._closed:
+					# Its exit status went with the server
+					raise ChildProcessError(errno.ECHILD, os.strerror(errno.ECHILD))
+				self._condition.wait()
+			status, rusage = self._exits.pop(pid)
+		return pid, status, rusage
+
+	def close(self):
+		"""Send no more commands. The server exits once everything it started has."""
+		if not self._closed and self._owner == os.getpid():
+			try:
+				self._socket.shutdown(socket.SHUT_WR)
+			except OSError:
+				pass
+
+	def _read(self):
+		sock = self._socket
+		while True:
+			try:
+				data = sock.recv(65536)
+			except OSError:
+				data = b''
+			if not data:
+				break
+			message = pickle.loads(data)
+			with self._condition:
+				if message[0] == 'spawned':
+					self._replies[message[1]] = message[2:]
+				else:
+					pid, status, rusage = message[1:]
+					self._exits[pid] = (status, resource.struct_rusage(rusage))
+				self._condition.notify_all()
+		with self._condition:
+			self._closed = True
+			self._condition.notify_all()
+		sock.close()
+		self.process.wait()
+
+	def __repr__(self):
+		return f"<ForkServer pid={self.process.pid} {'closed' if self._closed else 'running'}>"
+
+_default = None
+_default_lock = threading.Lock()
+
+def _server(fork_server):
+	# fork_server=True means the shared one, started the first time it's asked for
+	global _default
+	if fork_server is not True:
+		return fork_server or None
+	with _default_lock:
+		if _default is None or not _default.usable:
+			_default = ForkServer()
+		return _default
+
+def _after_fork():
+	# A child of ours gets a server of its own if it wants one
+	global _default, _default_lock
+	_default = None
+	_default_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def _ignore(signum, frame):
+	# A handler instead of SIG_IGN. Handlers are reset by exec, so the commands don't inherit it
+	pass
+
+def _serve(fd: int):
+	sock = socket.socket(fileno=fd)
+	# Ctrl-C is for the program that started us, we go when it closes the socket
+	signal.signal(signal.SIGINT, _ignore)
+	wakeup, wakeup_write = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+	signal.set_wakeup_fd(wakeup_write)
+	signal.signal(signal.SIGCHLD, _ignore)
+	selector = selectors.DefaultSelector()
+	selector.register(sock, selectors.EVENT_READ)
+	selector.register(wakeup, selectors.EVENT_READ)
+	# pid: Popen
+	children = {}
+	accepting = True
+	while accepting or children:
+		for key, events in selector.select():
+			if key.fd != fd:
+				continue
+			message, fds, flags, address = socket.recv_fds(sock, _BUFFER, 3)
+			if not message:
+				accepting = False
+				selector.unregister(sock)
+				continue
+			token, args, executable, options = pickle.loads(message)
+			try:
+				process = subprocess.Popen(args, executable=executable,
+											stdin=fds[0], stdout=fds[1], stderr=fds[2], **options)
+			except Exception as exc:
+				reply = ('spawned', token, None, exc)
+			else:
+				children[process.pid] = process
+				reply = ('spawned', token, process.pid, None)
+			finally:
+				for descriptor in fds:
+					os.close(descriptor)
+			_send(sock, reply)
+		try:
+			while os.read(wakeup, 4096):
+				pass
+		except BlockingIOError:
+			pass
+		# Exits only go out after their pid did, since we reap after answering
+		while children:
+			try:
+				pid, status, rusage = os.wait4(-1, os.WNOHANG)
+			except ChildProcessError:
+				break
+			if not pid:
+				break
+			process = children.pop(pid, None)
+			if process is not None:
+				# So Popen doesn't go looking for it again
+				process.returncode = status
+			_send(sock, ('exited', pid, status, tuple(rusage)))
+
+def _send(sock, message):
+	try:
+		sock.send(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+	except OSError:
+		# The program that started us is gone, there's nobody to tell
+		pass
+
+if __name__ == '__main__':
+	_serve(int(sys.argv[1]))
@@ -0,0 +1,279 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+from subprocess import SubprocessError
+
+from .pyshell import pyshellCommand, PyshellError, _BatchJob, _PopenSelector, _wait_jobs
+
+class DependencyFailed(PyshellError):
+	"""What a task gets instead of running when something it depends on failed."""
+	def __init__(self, task: str, dependency: str):
+		super().__init__(f'{task} was skipped, {dependency} failed')
+		self.task = task
+		self.dependency = dependency
+
+class Task(object):
+	"""One command in a TaskGraph, what TaskGraph.add gives back."""
+	__slots__ = ('name', 'chain', 'args', 'kwargs', 'after', 'result', 'started', 'finished')
+
+	def __init__(self, name: str, chain: tuple, args: tuple, kwargs: dict, after: tuple):
+		self.name = name
+		self.chain = chain
+		self.args = args
+		self.kwargs = kwargs
+		self.after = after
+		self.result = None
+		self.started = None
+		self.finished = None
+
+	@property
+	def failed(self) -> bool:
+		"""It ran and failed, or never got to run"""
+		return isinstance(self.result, Exception)
+
+	@property
+	def skipped(self) -> bool:
+		return isinstance(self.result, DependencyFailed)
+
+	@property
+	def duration(self) -> float:
+		"""Seconds it was running, None if it never started"""
+		if self.started is None or self.finished is None:
+			return None
+		return self.finished - self.started
+
+	def __repr__(self):
+		if self.result is None:
+			state = 'pending'
+		elif self.skipped:
+			state = 'skipped'
+		elif self.failed:
+			state = f'failed {type(self.result).__name__}'
+		else:
+			state = f'returncode={self.result.returncode} {self.duration:.3f}s'
+		return f"<Task {self.name} {state}>"
+
+class GraphResult(object):
+	"""What TaskGraph.run gives back. Every task with its result and when it ran."""
+	def __init__(self, tasks: dict, started: float, finished: float):
+		self.tasks = tasks
+		self.started = started
+		self.finished = finished
+
+	@property
+	def results(self) -> dict:
+		"""name: CompletedProcess, or the exception it ended with"""
+		return {name: task.result for name, task in self.tasks.items()}
+
+	@property
+	def ok(self) -> bool:
+		return not any(task.failed for task in self.tasks.values())
+
+	@property
+	def failed(self) -> list:
+		"""Tasks that ran and failed"""
+		return [task for task in self.tasks.values() if task.failed and not task.skipped]
+
+	@property
+	def skipped(self) -> list:
+		return [task for task in self.tasks.values() if task.skipped]
+
+	@property
+	def duration(self) -> float:
+		return self.finished - self.started
+
+	@property
+	def timings(self) -> dict:
+		"""name: (start, end), in seconds from when the run started. None for tasks that never ran"""
+		return {name: None if task.started is None else (task.started - self.started, task.finished - self.started)
+				for name, task in self.tasks.items()}
+
+	@property
+	def critical_path(self) -> list:
+		"""The chain of tasks that decided how long the run took, first to last.
+
+		It starts from the task that finished last and goes back through whichever of
+		its dependencies finished last, the one it was waiting on.
+		"""
+		ran = [task for task in self.tasks.values() if task.finished is not None and task.started is not None]
+		if not ran:
+			return []
+		task = max(ran, key=lambda task: task.finished)
+		path = [task]
+		while True:
+			dependencies = [self.tasks[name] for name in task.after if self.tasks[name].finished is not None]
+			if not dependencies:
+				break
+			task = max(dependencies, key=lambda task: task.finished)
+			path.append(task)
+		path.reverse()
+		return path
+
+	def check(self):
+		"""Raise the first failure, if there was one."""
+		for task in self.failed:
+			raise task.result
+
+	def __repr__(self):
+		return (f"<GraphResult tasks={len(self.tasks)} failed={len(self.failed)} "
+				f"skipped={len(self.skipped)} {self.duration:.3f}s>")
+
+class TaskGraph(object):
+
+	def __init__(self, shell, max_parallel: int=None):
+		"""Commands with dependencies between them, run as many at once as they can be.
+
+		Arguments:
+			shell: the pyshell the commands run with. Its options apply to all of them.
+			max_parallel: how many commands run at the same time. Defaults to the number of CPUs
+
+		A task starts once everything it was added after has finished. When one fails, an
+		exception for its result like check=True gives, a timeout or a missing command, whatever
+		depends on it is skipped and gets a DependencyFailed. Everything else carries on.
+		Without check a non zero exit status isn't a failure.
+
+		Like map, every command is run from this thread with a single selector.
+
+		Example::
+
+		graph = TaskGraph(sh, max_parallel=4)
+		graph.add('mkfs', sh.mkfs.ext4, '/dev/sdb1')
+		graph.add('mount', sh.mount, '/dev/sdb1', '/mnt', after=['mkfs'])
+		graph.add('debootstrap', sh.debootstrap, 'bookworm', '/mnt', after=['mount'])
+		graph.add('keys', sh.ssh_keygen, '-A', after=['mount'])
+		result = graph.run(check=True)
+		print([task.name for task in result.critical_path], result.timings)
+		"""
+		self._shell = shell
+		self._tasks = {}
+		if max_parallel is None:
+			max_parallel = os.cpu_count() or 1
+		if max_parallel < 1:
+			raise ValueError('max_parallel must be at least 1')
+		self.max_parallel = max_parallel
+
+	def add(self, name: str, command, *args, after=(), **kwargs) -> Task:
+		"""Add a command to run once the tasks in after have.
+
+		Arguments:
+			name: what the task is called in the result. Has to be unique
+			command: a name like 'mount', a list like ['mount', '-o', 'ro'] or a command like sh.mount
+			args: arguments added to the command
+			after: names or Tasks that have to finish first. They have to be added before this one,
+				so there can't be a cycle
+
+		Every other argument is the same as calling pyshell, for this command only.
+		The Task given back is for after=, how it went is in the GraphResult.
+		"""
+		if name in self._tasks:
+			raise ValueError(f'there is already a task called {name}')
+		if isinstance(after, (str, Task)):
+			after = (after,)
+		names = []
+		for dependency in after:
+			dependency = dependency.name if isinstance(dependency, Task) else dependency
+			if dependency not in self._tasks:
+				raise ValueError(f'{name} depends on {dependency}, which has to be added first')
+			names.append(dependency)
+		if isinstance(command, pyshellCommand):
+			chain, base_args, base_kwargs = command._chain, command._args, command._kwargs
+		elif isinstance(command, (list, tuple)):
+			chain, base_args, base_kwargs = (), tuple(command), {}
+		else:
+			chain, base_args, base_kwargs = (), (command,), {}
+		task = Task(name, chain, base_args + args, dict(base_kwargs, **kwargs), tuple(names))
+		self._tasks[name] = task
+		return task
+
+	def run(self, **kwargs) -> GraphResult:
+		"""Run every task and return a GraphResult.
+
+		kwargs are the same as calling pyshell and apply to every task, check=True included.
+		What was given to add wins over them. A graph can be run more than once.
+		"""
+		# Fresh ones every run, so an earlier GraphResult keeps what it had
+		tasks = {name: Task(name, task.chain, task.args, task.kwargs, task.after)
+				for name, task in self._tasks.items()}
+		# name: the names waiting on it
+		dependents = {name: [] for name in tasks}
+		waiting = {}
+		for task in tasks.values():
+			waiting[task.name] = len(task.after)
+			for dependency in task.after:
+				dependents[dependency].append(task.name)
+		# Tasks come out in the order they were added
+		ready = [name for name, count in waiting.items() if not count]
+		running = []
+		started = time.monotonic()
+
+		def done(task):
+			task.finished = time.monotonic()
+			if task.failed:
+				# Everything downstream of it, they can never run
+				skip = [(name, task.name) for name in dependents[task.name]]
+				while skip:
+					name, dependency = skip.pop()
+					if tasks[name].result is None:
+						tasks[name].result = DependencyFailed(name, dependency)
+						skip.extend((after, dependency) for after in dependents[name])
+				return
+			for name in dependents[task.name]:
+				waiting[name] -= 1
+				if not waiting[name] and tasks[name].result is None:
+					ready.append(name)
+
+		try:
+			with _PopenSelector() as selector:
+				while True:
+					while ready and len(running) < self.max_parallel:
+						task = tasks[ready.pop(0)]
+						if task.result is not None:
+							continue
+						job = _BatchJob(task.name)
+						task.started = time.monotonic()
+						try:
+							job.start(self._shell, task.chain, task.args, dict(kwargs, **task.kwargs), selector)
+						except (OSError, ValueError, SubprocessError) as exc:
+							task.result = exc
+							done(task)
+						else:
+							running.append(job)
+
+					if not running:
+						if not ready:
+							break
+						continue
+
+					running, finished = _wait_jobs(running, selector)
+					for job in finished:
+						task = tasks[job.index]
+						task.result = job.result
+						done(task)
+		finally:
+			# Something broke or we were interrupted, don't leave anything behind
+			for job in running:
+				job.kill()
+		return GraphResult(tasks, started, time.monotonic())
+
+	def __len__(self):
+		return len(self._tasks)
+
+	def __repr__(self):
+		return f"<TaskGraph tasks={len(self._tasks)} max_parallel={self.max_parallel}>"
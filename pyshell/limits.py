@@ -0,0 +1,206 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import errno
+import signal
+import itertools
+import resource
+
+# Where cgroup v2 is normally mounted, relative cgroup paths start here
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# ioprio_set has no wrapper in python or glibc
+# ioprio_set by the ABI Python was built for, not the kernel. A 32 bit Python on a
+# 64 bit kernel makes 32 bit syscalls, so it needs the 32 bit number
+_IOPRIO_SET = {
+	'x86_64': 251, 'x32': 0x40000000 | 251, 'i386': 289,
+	'aarch64': 30, 'arm': 314, 'riscv64': 30,
+	'powerpc64': 273, 'powerpc': 273, 's390x': 282, 's390': 282,
+}
+# What the 64 bit ones are called when built with 32 bit pointers
+_ABI_32 = {'x86_64': 'i386', 'aarch64': 'arm', 'powerpc64': 'powerpc', 's390x': 's390'}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# Names for cgroup leaves we make, unique within this process
+_leaves = itertools.count()
+
+# Runs first in the child. It stops itself until the parent is done restricting it
+_GATE = 'kill -STOP $$ && exec "$@"'
+
+class Limits(object):
+	"""Restrictions for one child, applied from the parent through its pid.
+
+	Nothing python runs in the child, so this works without preexec_fn and with posix_spawn.
+	Setting them from outside once the command is running would race it though, a shell can
+	read its limits or fork before we get to it. So the child starts as a small /bin/sh that
+	stops itself, we restrict it while it's stopped and it then execs the real command.
+	That costs one exec of /bin/sh per restricted command.
+	"""
+	__slots__ = ('rlimits', 'nice', 'ionice', 'affinity', 'cgroup', 'leaf')
+
+	def __init__(self, rlimits=None, nice=None, ionice=None, affinity=None, cgroup=None, cgroup_limits=None):
+		self.rlimits = _rlimits(rlimits) if rlimits else ()
+		# Like nice -n, on top of whatever we run at
+		self.nice = None if nice is None else os.getpriority(os.PRIO_PROCESS, 0) + nice
+		self.ionice = None if ionice is None else _ioprio(ionice)
+		self.affinity = None if affinity is None else set(affinity)
+		self.cgroup = None if cgroup is None else os.path.join(CGROUP_ROOT, os.fspath(cgroup))
+		self.leaf = None
+		if cgroup_limits:
+			if self.cgroup is None:
+				raise ValueError('cgroup_limits needs a cgroup to make the command its own group in')
+			self.leaf = self.cgroup = _make_leaf(self.cgroup, cgroup_limits)
+
+	def gate(self, args: list, executable, env) -> tuple:
+		"""The args and executable to start instead, so the child waits for apply before it execs."""
+		# Errors for a missing command should be the same as without the gate
+		if not os.path.dirname(executable):
+			import shutil
+			found = shutil.which(executable, path=os.pathsep.join(os.get_exec_path(env)))
+			if found is None:
+				raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), executable)
+		elif not os.path.exists(executable):
+			raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), executable)
+		elif not os.access(executable, os.X_OK) or os.path.isdir(executable):
+			raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), executable)
+		if executable != args[0]:
+			# sh can't exec with a different argv[0], so the executable takes its place
+			args = [executable, *args[1:]]
+		return ['/bin/sh', '-c', _GATE, 'pyshell', *args], '/bin/sh'
+
+	def apply(self, pid: int):
+		"""Restrict pid once the gate has stopped and let it go on.
+
+		If any of it fails pid is killed and reaped, then the error is raised.
+		"""
+		try:
+			# Without reaping it, something else will want the exit status if it never got that far
+			if os.waitid(os.P_PID, pid, os.WSTOPPED | os.WEXITED | os.WNOWAIT).si_code != os.CLD_STOPPED:
+				return
+			for limit, values in self.rlimits:
+				resource.prlimit(pid, limit, values)
+			if self.nice is not None:
+				os.setpriority(os.PRIO_PROCESS, pid, self.nice)
+			if self.ionice is not None:
+				_ioprio_set(pid, self.ionice)
+			if self.affinity is not None:
+				os.sched_setaffinity(pid, self.affinity)
+			if self.cgroup is not None:
+				fd = os.open(os.path.join(self.cgroup, 'cgroup.procs'), os.O_WRONLY | os.O_CLOEXEC)
+				try:
+					os.write(fd, str(pid).encode())
+				finally:
+					os.close(fd)
+			os.kill(pid, signal.SIGCONT)
+		except BaseException:
+			# Never leave a child running without the limits it was asked to have
+			try:
+				os.kill(pid, signal.SIGKILL)
+				os.waitpid(pid, 0)
+			except OSError:
+				pass
+			self.release()
+			raise
+
+	def release(self):
+		"""Remove the cgroup we made, once the command is gone."""
+		if self.leaf is not None:
+			try:
+				os.rmdir(self.leaf)
+			except OSError:
+				# Something the command started is still in there. Leave it be
+				return
+			self.leaf = None
+
+def _rlimits(rlimits: dict) -> tuple:
+	# {'as': 1 << 30, resource.RLIMIT_CPU: (60, 70)} -> ((RLIMIT_AS, (soft, hard)), ...)
+	limits = []
+	for name, value in rlimits.items():
+		if isinstance(name, str):
+			limit = getattr(resource, 'RLIMIT_' + name.upper(), None)
+			if limit is None:
+				raise ValueError(f'unknown rlimit {name!r}')
+		else:
+			limit = name
+		if isinstance(value, int):
+			value = (value, value)
+		limits.append((limit, tuple(value)))
+	return tuple(limits)
+
+def _ioprio(ionice) -> int:
+	# 'idle', 'best-effort' or ('best-effort', 7), like ionice -c -n
+	if isinstance(ionice, str):
+		name, level = ionice, 4 if ionice != 'idle' else 0
+	else:
+		name, level = ionice
+	if name not in _IOPRIO_CLASSES:
+		raise ValueError(f"ionice class must be one of {', '.join(_IOPRIO_CLASSES)}, not {name!r}")
+	if not 0 <= level <= 7:
+		raise ValueError(f'ionice level must be between 0 and 7, not {level!r}')
+	return _IOPRIO_CLASSES[name] << _IOPRIO_CLASS_SHIFT | level
+
+def _abi() -> str:
+	# The cpu of the target triplet Python was built for, like x86_64-linux-gnu
+	import sysconfig
+	triplet = sysconfig.get_config_var('MULTIARCH') or sysconfig.get_config_var('HOST_GNU_TYPE') or ''
+	if triplet.endswith('x32'):
+		return 'x32'
+	cpu = triplet.split('-')[0]
+	if not cpu:
+		# Nothing recorded, go by the kernel and the size of our own pointers
+		import platform
+		import struct
+		cpu = platform.machine()
+		if struct.calcsize('P') == 4:
+			cpu = _ABI_32.get(cpu, cpu)
+	if cpu in ('i486', 'i586', 'i686'):
+		return 'i386'
+	if cpu.startswith('arm'):
+		return 'arm'
+	if cpu.startswith(('powerpc64', 'ppc64')):
+		return 'powerpc64'
+	if cpu in ('ppc', 'powerpcle'):
+		return 'powerpc'
+	return cpu
+
+def _ioprio_set(pid: int, ioprio: int):
+	abi = _abi()
+	number = _IOPRIO_SET.get(abi)
+	if number is None:
+		raise OSError(f'ionice is not supported on {abi}')
+	import ctypes
+	libc = ctypes.CDLL(None, use_errno=True)
+	if libc.syscall(number, _IOPRIO_WHO_PROCESS, pid, ioprio) == -1:
+		err = ctypes.get_errno()
+		raise OSError(err, os.strerror(err))
+
+def _make_leaf(parent: str, limits: dict) -> str:
+	# A group of its own for one command, with its limits written before anything is in it
+	leaf = os.path.join(parent, f'pyshell-{os.getpid()}-{next(_leaves)}')
+	os.mkdir(leaf)
+	try:
+		for name, value in limits.items():
+			with open(os.path.join(leaf, name), 'w') as file:
+				file.write(str(value))
+	except BaseException:
+		os.rmdir(leaf)
+		raise
+	return leaf
@@ -0,0 +1,176 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import shlex
+import threading
+import weakref
+
+class CommandLog(object):
+
+	def __init__(self, path, max_bytes=None, backups=3, tee=False):
+		"""A logfile that stays open and frames every command written to it.
+
+		Arguments:
+			path: where to log. It's opened for appending the first time a command uses it.
+			max_bytes: rotate once the file has grown past this many bytes. path becomes path.1,
+				path.1 becomes path.2 and so on, keeping at most backups old files.
+			backups: how many rotated files to keep. With 0 the log just starts over.
+			tee: capture the output and write it to the log once the command is done, instead of
+				pointing the command's stdout and stderr at the log.
+
+		Every command gets a line before and after its output::
+
+			>>> 2021-11-02 14:03:11.518 tar -czf backup.tgz /etc
+			... whatever the command wrote ...
+			<<< 2021-11-02 14:03:12.007 pid 4120 exit 0 in 0.489s
+
+		By default the command writes into the log itself and its output never comes through python.
+		Commands running at the same time can then mix their output, the framing lines only tell you
+		when each one started and stopped. With tee each record is written in one go, so they never
+		mix, and the output is captured like capture_output=True as well.
+
+		Anything you pass to logfile= as a path gets one of these with the defaults,
+		kept by the pyshell for as long as it lives.
+
+		Example::
+
+		log = CommandLog('/var/log/backup.log', max_bytes=50 * 1024 * 1024, tee=True)
+		sh = pyshell(logfile=log)
+		"""
+		self.path = os.fspath(path)
+		self.max_bytes = max_bytes
+		self.backups = backups
+		self.tee = tee
+		self._fd = None
+		self._lock = threading.Lock()
+		self._finalizer = None
+
+	def fileno(self) -> int:
+		"""The log's file descriptor. It stays the same number across rotations."""
+		with self._lock:
+			return self._open()
+
+	def begin(self, args, streaming=False) -> float:
+		"""Start a record for args. Returns the start time to hand to end.
+
+		streaming means the output is written to the log as it comes,
+		so the header has to go out now even with tee.
+		"""
+		started = time.time()
+		with self._lock:
+			self._open()
+			if self.max_bytes is not None and os.fstat(self._fd).st_size >= self.max_bytes:
+				self._rotate()
+			if streaming or not self.tee:
+				self._write(_header(args, started))
+		return started
+
+	def end(self, args, started: float, pid=None, returncode=None,
+			stdout=None, stderr=None, streaming=False):
+		"""Finish the record started by begin with any output we were handed.
+
+		With tee and not streaming the whole record is written here in one go.
+		"""
+		finished = time.time()
+		parts = []
+		if self.tee and not streaming:
+			parts.append(_header(args, started))
+		for name, output in (('stdout', stdout), ('stderr', stderr)):
+			if not output:
+				continue
+			if isinstance(output, str):
+				output = output.encode(errors='surrogateescape')
+			if name == 'stderr':
+				parts.append(b'--- stderr\n')
+			parts.append(output)
+			if not output.endswith(b'\n'):
+				parts.append(b'\n')
+		parts.append(f"<<< {_stamp(finished)} pid {_field(pid)} exit {_field(returncode)} in {finished - started:.3f}s\n".encode())
+		record = b''.join(parts)
+		with self._lock:
+			self._open()
+			self._write(record)
+
+	def write(self, data: bytes):
+		"""Write output into the log as is."""
+		with self._lock:
+			self._open()
+			self._write(data)
+
+	def close(self):
+		"""Close the log. It opens again if it's used."""
+		with self._lock:
+			if self._finalizer is not None:
+				self._finalizer()
+				self._finalizer = None
+			self._fd = None
+
+	def __repr__(self):
+		return f"CommandLog({self.path!r}, max_bytes={self.max_bytes!r}, backups={self.backups!r}, tee={self.tee!r})"
+
+	def _open(self) -> int:
+		if self._fd is None:
+			self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o666)
+			self._finalizer = weakref.finalize(self, os.close, self._fd)
+		return self._fd
+
+	def _write(self, data: bytes):
+		# O_APPEND, so every write lands at the end no matter who else is writing
+		data = memoryview(data)
+		while data:
+			data = data[os.write(self._fd, data):]
+
+	def _rotate(self):
+		if self.backups > 0:
+			for number in range(self.backups - 1, 0, -1):
+				older = f"{self.path}.{number}"
+				if os.path.exists(older):
+					os.replace(older, f"{self.path}.{number + 1}")
+			os.replace(self.path, f"{self.path}.1")
+		else:
+			os.unlink(self.path)
+		# Swap the new file in under the same descriptor. Anyone holding the number,
+		# like a command being started right now, gets the new file and never a closed one.
+		fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o666)
+		try:
+			os.dup2(fd, self._fd, inheritable=False)
+		finally:
+			os.close(fd)
+
+def _stamp(when: float) -> str:
+	return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)) + f".{int(when % 1 * 1000):03d}"
+
+def _field(value) -> str:
+	# A pipeline has one of each for every command
+	if isinstance(value, (list, tuple)):
+		return ' '.join(map(_field, value)) or '-'
+	return '-' if value is None else str(value)
+
+def _header(args, started: float) -> bytes:
+	return f">>> {_stamp(started)} {_describe(args)}\n".encode(errors='surrogateescape')
+
+def _describe(args) -> str:
+	# How a command shows up in the log. A shell command is already a string
+	if isinstance(args, (str, bytes, os.PathLike)):
+		return os.fsdecode(args)
+	args = [os.fsdecode(arg) for arg in args]
+	if len(args) == 1:
+		return args[0]
+	return shlex.join(args)
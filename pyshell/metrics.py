@@ -0,0 +1,216 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import bisect
+import threading
+import weakref
+
+# Histogram buckets in seconds, 1ms doubling up to about 9 minutes. Anything slower lands in the last one
+_BOUNDS = tuple(0.001 * 2 ** number for number in range(20)) + (float('inf'),)
+
+class CommandRecord(object):
+	"""What one command did. Times are seconds.
+
+	resolve is working out the command, spawn is starting it, run is from then until we saw it exit
+	and drain is everything after that until the result was ready: the rest of the output, decoding, logging.
+	user_time, system_time and max_rss (KiB) come from the child's rusage. For a pipeline pid and returncode
+	are lists, the times are added up and max_rss is the biggest.
+	bytes_in and bytes_out are what went through our pipes, None when it didn't go through us.
+	"""
+	__slots__ = ('name', 'args', 'pid', 'returncode', 'error', 'started',
+				'resolve', 'spawn', 'run', 'drain', 'total',
+				'user_time', 'system_time', 'max_rss', 'bytes_in', 'bytes_out',
+				'_begin', '_resolved')
+
+	def __init__(self):
+		self.name = self.args = self.pid = self.returncode = self.error = None
+		self.resolve = self.spawn = self.run = self.drain = self.total = None
+		self.user_time = self.system_time = self.max_rss = None
+		self.bytes_in = self.bytes_out = None
+		self.started = time.time()
+		self._begin = time.perf_counter()
+		self._resolved = None
+
+	def as_dict(self) -> dict:
+		return {name: getattr(self, name) for name in self.__slots__ if not name.startswith('_')}
+
+	def __repr__(self):
+		return f"CommandRecord({self.name!r}, returncode={self.returncode!r}, total={self.total!r})"
+
+class CommandMetrics(object):
+
+	def __init__(self, pre=None, post=None, export=None, histograms=False):
+		"""Collects timings and resource usage for every command a pyshell runs.
+
+		Arguments:
+			pre: called with the CommandRecord once the command is worked out, right before it starts.
+			post: called with the finished CommandRecord.
+			export: a path to append every record to as a line of JSON, or a callable that gets
+				the record as a dict.
+			histograms: also keep a histogram of how long each command took, per command name.
+
+		A pyshell without metrics doesn't pay for any of this.
+		Hooks run in whichever thread ran the command, an exception from one goes to the caller.
+
+		Example::
+
+		metrics = CommandMetrics(export='/var/log/pyshell.jsonl', histograms=True)
+		sh = pyshell(metrics=metrics)
+		sh.rsync('-a', 'src/', 'dst/')
+		print(metrics.summary()['rsync'])
+		"""
+		self.pre = pre
+		self.post = post
+		self.export = export
+		self.histograms = histograms
+		self._lock = threading.Lock()
+		self._commands = {}
+		self._fd = None
+		self._finalizer = None
+
+	def start(self) -> CommandRecord:
+		return CommandRecord()
+
+	def resolved(self, record: CommandRecord, name, args):
+		record.name = name
+		record.args = args
+		record._resolved = time.perf_counter()
+		record.resolve = record._resolved - record._begin
+		if self.pre is not None:
+			self.pre(record)
+
+	def finish(self, record: CommandRecord, processes=(), returncode=None,
+				stdout=None, stderr=None, bytes_in=None, bytes_out=None, error=None):
+		"""Fill in the rest of record from the processes that ran and hand it out.
+
+		bytes_out is worked out from stdout and stderr unless it's given.
+		"""
+		now = time.perf_counter()
+		if record._resolved is None:
+			record._resolved = now
+			record.resolve = now - record._begin
+		record.total = now - record._begin
+		record.bytes_in = bytes_in
+		record.bytes_out = bytes_out
+		if error is not None:
+			record.error = type(error).__name__
+		if bytes_out is None and (stdout is not None or stderr is not None):
+			record.bytes_out = _size(stdout) + _size(stderr)
+
+		if processes:
+			spawned = max(process.spawned_at for process in processes)
+			exits = [process.exited_at for process in processes if process.exited_at is not None]
+			exited = max(exits) if exits else now
+			record.spawn = sum(process.spawned_at - process.started_at for process in processes)
+			record.run = max(exited - spawned, 0.0)
+			record.drain = max(now - exited, 0.0)
+			usages = [process.rusage for process in processes if process.rusage is not None]
+			if usages:
+				record.user_time = sum(usage.ru_utime for usage in usages)
+				record.system_time = sum(usage.ru_stime for usage in usages)
+				record.max_rss = max(usage.ru_maxrss for usage in usages)
+			if len(processes) == 1:
+				record.pid = processes[0].pid
+				record.returncode = processes[0].returncode
+			else:
+				record.pid = [process.pid for process in processes]
+				record.returncode = [process.returncode for process in processes]
+		else:
+			record.run = now - record._resolved
+			record.returncode = returncode
+
+		self._add(record)
+		if self.post is not None:
+			self.post(record)
+		if self.export is not None:
+			self._export(record)
+
+	def summary(self) -> dict:
+		"""Totals so far per command name.
+
+		Each has count, failed (non zero exit or an error), returncodes, total, user_time
+		and system_time in seconds, max_rss, bytes_in, bytes_out and, with histograms,
+		histogram mapping each bucket's upper bound in seconds to its count.
+		"""
+		with self._lock:
+			summary = {}
+			for name, totals in self._commands.items():
+				totals = dict(totals, returncodes=dict(totals['returncodes']))
+				if 'histogram' in totals:
+					totals['histogram'] = {
+						bound: count for bound, count in zip(_BOUNDS, totals['histogram']) if count}
+				summary[name] = totals
+			return summary
+
+	def reset(self):
+		with self._lock:
+			self._commands.clear()
+
+	def close(self):
+		"""Close the export file. It opens again if it's needed."""
+		with self._lock:
+			if self._finalizer is not None:
+				self._finalizer()
+				self._finalizer = None
+			self._fd = None
+
+	def _add(self, record: CommandRecord):
+		codes = record.returncode if isinstance(record.returncode, list) else [record.returncode]
+		failed = record.error is not None or any(codes)
+		with self._lock:
+			totals = self._commands.get(record.name)
+			if totals is None:
+				totals = self._commands[record.name] = {
+					'count': 0, 'failed': 0, 'returncodes': {}, 'total': 0.0,
+					'user_time': 0.0, 'system_time': 0.0, 'max_rss': 0, 'bytes_in': 0, 'bytes_out': 0}
+				if self.histograms:
+					totals['histogram'] = [0] * len(_BOUNDS)
+			totals['count'] += 1
+			totals['failed'] += failed
+			for code in codes:
+				totals['returncodes'][code] = totals['returncodes'].get(code, 0) + 1
+			totals['total'] += record.total
+			totals['user_time'] += record.user_time or 0.0
+			totals['system_time'] += record.system_time or 0.0
+			totals['max_rss'] = max(totals['max_rss'], record.max_rss or 0)
+			totals['bytes_in'] += record.bytes_in or 0
+			totals['bytes_out'] += record.bytes_out or 0
+			if 'histogram' in totals:
+				totals['histogram'][bisect.bisect_left(_BOUNDS, record.total)] += 1
+
+	def _export(self, record: CommandRecord):
+		if callable(self.export):
+			self.export(record.as_dict())
+			return
+		line = json.dumps(record.as_dict(), default=str).encode() + b'\n'
+		with self._lock:
+			if self._fd is None:
+				self._fd = os.open(self.export, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o666)
+				self._finalizer = weakref.finalize(self, os.close, self._fd)
+			# One write per record so lines from other threads or processes never mix
+			os.write(self._fd, line)
+
+def _size(output) -> int:
+	if output is None:
+		return 0
+	if isinstance(output, str):
+		return len(output.encode(errors='surrogateescape'))
+	return len(output)
@@ -0,0 +1,225 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+import csv
+import copy
+import json
+import codecs
+
+class Parser(object):
+	"""Turns a command's stdout into something structured while it's still running.
+
+	A parser given to parse= is a template. Every command gets its own copy from start(),
+	which is fed the output as it comes off the pipe and hands back the result from close().
+	Subclasses that work on lines only need to implement _lines, it gets every batch of
+	complete lines, decoded and without their newlines.
+	"""
+	def __init__(self):
+		self.encoding = 'utf-8'
+		self.errors = 'strict'
+
+	def start(self, encoding: str='utf-8', errors: str='strict') -> 'Parser':
+		parser = copy.copy(self)
+		parser.encoding = encoding
+		parser.errors = errors
+		parser._reset()
+		return parser
+
+	def _reset(self):
+		self._pending = bytearray()
+		self._decoder = codecs.getincrementaldecoder(self.encoding)(self.errors)
+		self._result = []
+
+	def feed(self, data: bytes):
+		# Only whole lines are decoded, once per chunk rather than once per line.
+		# The bytearray grows in place, so a long line is never copied again for every chunk
+		pending = self._pending
+		end = data.rfind(b'\n')
+		if end < 0:
+			pending += data
+			return
+		pending += data[:end + 1]
+		text = self._decoder.decode(pending)
+		pending.clear()
+		pending += data[end + 1:]
+		self._text(text)
+
+	def close(self):
+		if self._pending:
+			text = self._decoder.decode(self._pending, final=True) + '\n'
+			self._pending.clear()
+			self._text(text)
+		return self._result
+
+	def _text(self, text: str):
+		# text is one or more complete lines, the last one ends with a newline
+		self._lines(text.split('\n')[:-1])
+
+	def _lines(self, lines: list):
+		raise NotImplementedError
+
+	def __repr__(self):
+		return f"{type(self).__name__}()"
+
+class LineParser(Parser):
+	"""A list of lines without their newlines. skip_blank leaves out empty lines."""
+	def __init__(self, skip_blank: bool=False):
+		super().__init__()
+		self.skip_blank = skip_blank
+
+	def _lines(self, lines: list):
+		if self.skip_blank:
+			lines = [line for line in lines if line.strip()]
+		self._result.extend(lines)
+
+class JSONParser(Parser):
+	"""One JSON document, like lsblk -J or ip -j gives.
+
+	Nothing is decoded into a string on our side, the raw bytes are kept as they come
+	and json parses them in one go once the output ends.
+	"""
+	def _reset(self):
+		self._chunks = []
+
+	def feed(self, data: bytes):
+		self._chunks.append(data)
+
+	def close(self):
+		data = b''.join(self._chunks)
+		self._chunks = []
+		if not data.strip():
+			return None
+		return json.loads(data)
+
+class JSONLinesParser(Parser):
+	"""A list with one JSON value for every line, like journalctl -o json. Each is parsed as soon as its line is complete."""
+	def _lines(self, lines: list):
+		loads = json.loads
+		self._result.extend(loads(line) for line in lines if line and not line.isspace())
+
+class CSVParser(Parser):
+	"""Rows from csv.reader, parsed as they come.
+
+	Arguments:
+		header: use the first row as keys and return dicts, like csv.DictReader.
+		**fmtparams: anything csv.reader takes, delimiter, quotechar and so on.
+	"""
+	def __init__(self, header: bool=False, **fmtparams):
+		super().__init__()
+		self.header = header
+		self.fmtparams = fmtparams
+
+	def _reset(self):
+		super()._reset()
+		# Lines of a quoted field that hasn't closed yet, and whether it's still open
+		self._held = []
+		self._open = False
+		self._keys = None
+
+	def _text(self, text: str):
+		# A quoted field can have newlines in it. Hold on to the lines until its closing quote shows up.
+		# Only the new text is counted, what's held was counted when it came in
+		if text.count(self.fmtparams.get('quotechar', '"')) % 2:
+			self._open = not self._open
+		if self._open:
+			self._held.append(text)
+			return
+		if self._held:
+			self._held.append(text)
+			text = ''.join(self._held)
+			self._held = []
+		self._rows(text)
+
+	def close(self):
+		result = super().close()
+		if self._held:
+			# Unbalanced quotes right to the end. Let csv make of it what it can
+			held, self._held = ''.join(self._held), []
+			self._open = False
+			self._rows(held)
+		return result
+
+	def _rows(self, text: str):
+		rows = csv.reader(text.splitlines(True), **self.fmtparams)
+		if not self.header:
+			self._result.extend(rows)
+			return
+		for row in rows:
+			if self._keys is None:
+				self._keys = row
+			else:
+				self._result.append(dict(zip(self._keys, row)))
+
+	def __repr__(self):
+		return f"CSVParser(header={self.header!r}, **{self.fmtparams!r})"
+
+class TableParser(Parser):
+	"""Whitespace separated columns with a header line, like ps, df or lsblk. Each row becomes a dict.
+
+	Arguments:
+		headers: the column names, for output without a header line. When given, the first line is data.
+		skip: how many lines to drop before the header, like the total line of ls -l.
+
+	The last column gets whatever is left of the line, so a command with spaces in it stays whole.
+	"""
+	def __init__(self, headers: list=None, skip: int=0):
+		super().__init__()
+		self.headers = headers
+		self.skip = skip
+
+	def _reset(self):
+		super()._reset()
+		self._keys = list(self.headers) if self.headers else None
+		self._skip = self.skip
+
+	def _lines(self, lines: list):
+		append = self._result.append
+		for line in lines:
+			if self._skip:
+				self._skip -= 1
+				continue
+			if not line or line.isspace():
+				continue
+			if self._keys is None:
+				self._keys = line.split()
+				continue
+			keys = self._keys
+			append(dict(zip(keys, line.split(None, len(keys) - 1))))
+
+	def __repr__(self):
+		return f"TableParser(headers={self.headers!r}, skip={self.skip!r})"
+
+# What parse='name' means
+PARSERS = {
+	'lines': LineParser(),
+	'json': JSONParser(),
+	'jsonl': JSONLinesParser(),
+	'csv': CSVParser(),
+	'tsv': CSVParser(delimiter='\t'),
+	'table': TableParser(),
+}
+
+def _parser(parse, encoding: str, errors: str) -> Parser:
+	# A fresh parser for one command from a name or a template
+	if isinstance(parse, str):
+		template = PARSERS.get(parse)
+		if template is None:
+			raise ValueError(f"unknown parser {parse!r}, pick one of {', '.join(PARSERS)} or pass a Parser")
+	else:
+		template = parse
+	return template.start(encoding, errors)
@@ -16,17 +16,28 @@
 # You should have received a copy of the GNU General Public License
 # along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
 
+import io
 import os
 import sys
+import time
+import signal
+import codecs
+import errno
+import functools
+import locale
 import builtins
-import shutil
-from pathlib import Path
-from copy import deepcopy
-from inspect import getouterframes, currentframe
+import struct
+import math
+import threading
+import resource
 from subprocess import (
 	Popen, CalledProcessError, TimeoutExpired, 
 	SubprocessError, CompletedProcess, _USE_POSIX_SPAWN)
-from pexpect import spawn
+
+from .log import CommandLog, _describe
+from .limits import Limits
+from .result import CommandResult
+from .timers import _timers
 
 try:
     import msvcrt
@@ -38,7 +49,1126 @@ except ModuleNotFoundError:
     import select
     import selectors
 
+    # Same choices subprocess makes for communicate()
+    if hasattr(selectors, 'PollSelector'):
+        _PopenSelector = selectors.PollSelector
+    else:
+        _PopenSelector = selectors.SelectSelector
+
+class PathIndex(object):
+	"""Index of the programs found on $PATH, shared by the whole process.
+
+	Nothing touches the disk until the first lookup. Every directory is kept with
+	the device, inode and mtime it had when we listed it, so when $PATH or a
+	directory changes only the stale directories are listed again. Everything else
+	is a stat per directory.
+
+	Checks are done at most every max_age seconds, a program we don't know about
+	always forces one.
+
+	The index can also be kept on disk so short lived processes don't list $PATH
+	at all. Turn it on with enable_cache() or by setting PYSHELL_PATH_CACHE to 1
+	(for $XDG_CACHE_HOME/pyshell) or to a directory of your choosing.
+	"""
+	# Cache file layout, all little endian:
+	#	header:	magic, number of directories
+	#	entry:	st_dev, st_ino, st_mtime_ns, len(directory), len(names)
+	#			directory, names separated by NUL
+	# Names are every regular file, executable or not. which() asks when it's looked up,
+	# so a file that was chmod'd since it was written is still found.
+	# Version 1 files only had what was executable back then and are ignored.
+	_MAGIC = b'PYSHIDX2'
+	_HEADER = struct.Struct('<8sI')
+	_ENTRY = struct.Struct('<QQqII')
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._path = None
+		# dir: ((st_dev, st_ino, st_mtime_ns), frozenset of program names)
+		self._dirs = {}
+		self._programs = frozenset()
+		self._tables = None
+		self._where = None
+		self._checked = None
+		# How long we trust the index before looking at the directories again
+		self.max_age = 1.0
+		self._cache_file = None
+		self._cache_loaded = False
+		# Bumped every time the set of programs changes
+		self.generation = 0
+
+		cache = os.environ.get('PYSHELL_PATH_CACHE')
+		if cache and cache != '0':
+			self.enable_cache(None if cache == '1' else cache)
+
+	def enable_cache(self, directory=None):
+		"""Keep the index in a file so other processes can skip listing $PATH.
+
+		Arguments:
+			directory: where to keep the cache. Defaults to $XDG_CACHE_HOME/pyshell
+		"""
+		if directory is None:
+			directory = os.path.join(
+				os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'pyshell')
+		with self._lock:
+			self._cache_file = os.path.join(directory, 'path-index')
+			self._cache_loaded = False
+
+	def disable_cache(self):
+		"""Stop reading and writing the on-disk index."""
+		with self._lock:
+			self._cache_file = None
+
+	def programs(self):
+		"""Return a frozenset of every program name on $PATH."""
+		with self._lock:
+			self._refresh()
+			return self._programs
+
+	def tables(self):
+		"""Return the sorted program tuple and the dot, dash, underscore and hybrid tuples."""
+		with self._lock:
+			self._refresh()
+			if self._tables is None:
+				self._tables = self._build_tables(self._programs)
+			return self._tables
+
+	def which(self, name: str):
+		"""Return the path $PATH would run for name, or None. Like shutil.which without listing $PATH.
+
+		Whether it's executable is checked now and not when the directory was listed,
+		a chmod +x doesn't change the directory so we'd never hear about it.
+		"""
+		with self._lock:
+			self._refresh()
+			if name not in self._programs:
+				# Might have just been installed
+				self._refresh(force=True)
+				if name not in self._programs:
+					return None
+			if self._where is None:
+				# Every directory that has it, in $PATH order. The first one we may run wins
+				where = {}
+				for directory, (stamp, names) in self._dirs.items():
+					for program in names:
+						where.setdefault(program, []).append(directory)
+				self._where = where
+			for directory in self._where[name]:
+				path = os.path.join(directory, name)
+				if os.access(path, os.X_OK):
+					return path
+			return None
+
+	def check(self) -> int:
+		"""Bring the index up to date if it's due and return its generation."""
+		with self._lock:
+			self._refresh()
+			return self.generation
+
+	def __contains__(self, name):
+		return name in self.programs()
+
+	def _refresh(self, force=False):
+		now = time.monotonic()
+		if (not force and self._checked is not None and now - self._checked < self.max_age
+			and os.environ.get('PATH', os.defpath) == self._path):
+			return
+		self._checked = now
+
+		if self._cache_file is not None and not self._cache_loaded:
+			self._cache_loaded = True
+			known = self._read_cache(self._cache_file)
+			known.update(self._dirs)
+			self._dirs = known
+
+		path = os.environ.get('PATH', os.defpath)
+		changed = path != self._path
+		listed = False
+		dirs = {}
+		for directory in path.split(os.pathsep):
+			# An empty entry means the current directory, same as shutil.which
+			directory = directory or os.curdir
+			if directory in dirs:
+				continue
+			try:
+				st = os.stat(directory)
+				stamp = (st.st_dev, st.st_ino, st.st_mtime_ns)
+			except OSError:
+				stamp = None
+			cached = self._dirs.get(directory)
+			if cached is not None and cached[0] == stamp:
+				dirs[directory] = cached
+			elif stamp is None:
+				dirs[directory] = (None, frozenset())
+				changed = True
+			else:
+				dirs[directory] = (stamp, self._list_dir(directory))
+				changed = listed = True
+
+		if changed or len(dirs) != len(self._dirs):
+			if listed and self._cache_file is not None:
+				# Keep what other processes told us about directories we don't use
+				known = dict(self._dirs)
+				known.update(dirs)
+				self._write_cache(self._cache_file, known)
+			self._path = path
+			self._dirs = dirs
+			self._programs = frozenset().union(*(names for stamp, names in dirs.values()))
+			self._tables = None
+			self._where = None
+			self.generation += 1
+
+	@classmethod
+	def _read_cache(cls, cache_file):
+		try:
+			with open(cache_file, 'rb') as file:
+				data = file.read()
+		except OSError:
+			return {}
+		dirs = {}
+		try:
+			magic, count = cls._HEADER.unpack_from(data, 0)
+			if magic != cls._MAGIC:
+				return {}
+			offset = cls._HEADER.size
+			for _ in range(count):
+				dev, ino, mtime, dir_len, names_len = cls._ENTRY.unpack_from(data, offset)
+				offset += cls._ENTRY.size
+				directory = os.fsdecode(data[offset:offset+dir_len])
+				offset += dir_len
+				names = data[offset:offset+names_len]
+				offset += names_len
+				names = frozenset(os.fsdecode(names).split('\0')) if names else frozenset()
+				dirs[directory] = ((dev, ino, mtime), names)
+		except (struct.error, ValueError):
+			# A truncated or foreign file is no worse than no file
+			return {}
+		return dirs
+
+	@classmethod
+	def _write_cache(cls, cache_file, dirs):
+		entries = []
+		for directory, (stamp, names) in dirs.items():
+			# Missing directories aren't worth remembering
+			if stamp is None:
+				continue
+			directory = os.fsencode(directory)
+			names = os.fsencode('\0'.join(sorted(names)))
+			entries.append(cls._ENTRY.pack(*stamp, len(directory), len(names)) + directory + names)
+		# Write next to the real file and swap it in, so readers see all or nothing
+		try:
+			os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+			import tempfile
+			fd, tmp = tempfile.mkstemp(prefix='.path-index.', dir=os.path.dirname(cache_file))
+		except OSError:
+			return
+		try:
+			with os.fdopen(fd, 'wb') as file:
+				file.write(cls._HEADER.pack(cls._MAGIC, len(entries)))
+				file.write(b''.join(entries))
+			os.replace(tmp, cache_file)
+		except OSError:
+			try:
+				os.unlink(tmp)
+			except OSError:
+				pass
+
+	@staticmethod
+	def _list_dir(directory):
+		# Every regular file. Whether it may be run is only asked when it's looked up
+		names = []
+		try:
+			with os.scandir(directory) as entries:
+				for entry in entries:
+					try:
+						if entry.is_file():
+							names.append(entry.name)
+					except OSError:
+						pass
+		except OSError:
+			pass
+		return frozenset(names)
+
+	@staticmethod
+	def _build_tables(programs):
+		programs_tuple = tuple(sorted(programs))
+		dot_file_tuple = tuple(name for name in programs_tuple if '.' in name)
+		dash_file_tuple = tuple(name for name in programs_tuple if '-' in name and '_' not in name)
+		underscore_file_tuple = tuple(name for name in programs_tuple if '_' in name and '-' not in name)
+		hybrid_file_tuple = tuple(name for name in programs_tuple if '-' in name and '_' in name)
+		return programs_tuple, dot_file_tuple, dash_file_tuple, underscore_file_tuple, hybrid_file_tuple
+
+# Every pyshell shares this one
+_path_index = PathIndex()
+
+def _is_result_cache(cache) -> bool:
+	# .cache is only imported once a call is cached. Until then there can't be a ResultCache to check for
+	module = sys.modules.get(f'{__package__}.cache')
+	return module is not None and isinstance(cache, module.ResultCache)
+
+def _output_shape(compact, max_output, keep) -> tuple:
+	# For the cache key. compact changes the type that comes back, keep only matters when something is cut
+	return (compact, max_output, None if max_output is None else keep)
+
+def _text_options(kwargs: dict, input=None):
+	"""Pop text, universal_newlines, encoding and errors out of Popen kwargs.
+
+	For when we read the pipes ourselves and Popen should only see bytes.
+	Returns text, encoding, errors, with text switched on by str input.
+	"""
+	text = kwargs.pop('text', None)
+	text = kwargs.pop('universal_newlines', None) or text
+	encoding = kwargs.pop('encoding', None)
+	errors = kwargs.pop('errors', None)
+	if encoding or errors or isinstance(input, str):
+		text = True
+	return bool(text), encoding or locale.getpreferredencoding(False), errors or 'strict'
+
+class _LineSplitter(object):
+	"""Splits bytes into lines as they come in, decoding them if given an encoding.
+
+	Lines keep their newline. A line that grows past max_line is handed over in pieces.
+	"""
+	def __init__(self, encoding=None, errors='strict', max_line=1048576):
+		self._decoder = codecs.getincrementaldecoder(encoding)(errors) if encoding else None
+		self._pending = bytearray()
+		self._max_line = max_line
+
+	def feed(self, data: bytes) -> list:
+		pending = self._pending
+		pending += data
+		end = pending.rfind(b'\n')
+		if end < 0:
+			# No newline in sight. Don't let one huge line eat our memory
+			if len(pending) < self._max_line:
+				return []
+			lines = [bytes(pending)]
+			pending.clear()
+		else:
+			complete = bytes(pending[:end + 1])
+			del pending[:end + 1]
+			lines = [line + b'\n' for line in complete.split(b'\n')[:-1]]
+		if self._decoder:
+			return [self._decoder.decode(line) for line in lines]
+		return lines
+
+	def flush(self) -> list:
+		last = bytes(self._pending)
+		self._pending.clear()
+		if self._decoder:
+			last = self._decoder.decode(last, final=True)
+		return [last] if last else []
+
+# The Popen arguments a persistent shell can handle for a single command
+_PERSISTENT_KWARGS = frozenset((
+	'shell', 'executable', 'cwd', 'stdout', 'stderr',
+	'text', 'universal_newlines', 'encoding', 'errors'))
+
+def _write_all(fd: int, data: bytes):
+	while data:
+		data = data[os.write(fd, data):]
+
+# How much of the input we hand to the pipe per write. It's the default pipe size on Linux
+_FEED_CHUNK = 65536
+
+def _stdin_source(input):
+	"""Returns what can be given to the child as stdin as it is, or None if input has to be fed through a pipe.
+
+	Paths are opened by pyshellPopen. Anything with a real file descriptor is passed straight
+	through, the child reads it from where the file is at and the data never comes through us.
+	A text file only when it's at the start, anywhere else we can't tell which byte that is.
+	"""
+	if isinstance(input, os.PathLike):
+		return input
+	if isinstance(input, (str, bytes, bytearray, memoryview)) or not hasattr(input, 'fileno'):
+		return None
+	try:
+		fd = input.fileno()
+	except (OSError, ValueError):
+		# BytesIO and friends
+		return None
+	try:
+		seekable = input.seekable()
+	except (AttributeError, OSError, ValueError):
+		seekable = False
+	if isinstance(input, io.TextIOBase):
+		# tell() on a text file is a cookie with the decoder state in it, not a byte offset.
+		# 0 is the only one we know the meaning of, anything else is read and fed through the pipe
+		if not seekable or input.tell() != 0:
+			return None
+		os.lseek(fd, 0, os.SEEK_SET)
+	elif seekable:
+		# Buffered files read ahead. Put the descriptor back where the reader actually is
+		os.lseek(fd, input.tell(), os.SEEK_SET)
+	return input
+
+def _reusable(input) -> bool:
+	# Whether input gives the same thing every time. A file or a generator is used up by the first command
+	if input is None or isinstance(input, (str, os.PathLike)):
+		return True
+	if hasattr(input, 'read'):
+		return False
+	try:
+		memoryview(input).release()
+		return True
+	except TypeError:
+		pass
+	try:
+		return iter(input) is not input
+	except TypeError:
+		# Not input at all, let the command say so
+		return True
+
+def _read_pieces(file):
+	while True:
+		data = file.read(_FEED_CHUNK)
+		if not data:
+			return
+		yield data
+
+class _InputFeeder(object):
+	"""Writes input into a non-blocking pipe as fast as it drains.
+
+	input can be str, bytes or anything else with the buffer protocol like bytearray or mmap,
+	a file-like object with read() or an iterable of chunks. Buffers are written from a memoryview
+	so they are never copied, and only one chunk of a file or an iterator is held at a time.
+	"""
+	__slots__ = ('_chunks', '_view', '_offset', '_encoding', '_errors', 'written')
+
+	def __init__(self, input, encoding=None, errors='strict'):
+		self._encoding = encoding or locale.getpreferredencoding(False)
+		self._errors = errors
+		self.written = 0
+		self._view = None
+		self._offset = 0
+		self._chunks = iter(())
+		if isinstance(input, str):
+			input = input.encode(self._encoding, errors)
+		try:
+			view = memoryview(input)
+		except TypeError:
+			self._chunks = _read_pieces(input) if hasattr(input, 'read') else iter(input)
+		else:
+			if not view.c_contiguous:
+				view = memoryview(view.tobytes())
+			self._view = view.cast('B')
+
+	def write(self, fd: int) -> bool:
+		"""Write until the pipe is full. Returns True once everything is in or the reader went away."""
+		while True:
+			view = self._view
+			if view is None or self._offset >= len(view):
+				if not self._next():
+					return True
+				continue
+			try:
+				written = os.write(fd, view[self._offset:self._offset + _FEED_CHUNK])
+			except BlockingIOError:
+				return False
+			except BrokenPipeError:
+				self.close()
+				return True
+			self._offset += written
+			self.written += written
+
+	def _next(self) -> bool:
+		self._release()
+		for chunk in self._chunks:
+			if isinstance(chunk, str):
+				chunk = chunk.encode(self._encoding, self._errors)
+			view = memoryview(chunk).cast('B')
+			if view:
+				self._view = view
+				self._offset = 0
+				return True
+		return False
+
+	def close(self):
+		self._release()
+		self._chunks = iter(())
+
+	def _release(self):
+		# Let go of the buffer so an mmap can be closed
+		if self._view is not None:
+			self._view.release()
+			self._view = None
+
+class _OutputBuffer(object):
+	"""Keeps at most size bytes of what comes out of a pipe, read straight into a buffer made up front.
+
+	keep is 'tail' for the last size bytes, 'head' for the first or 'both' for half of each.
+	The tail is a ring, so once it's full every read writes over the oldest output.
+	total is how many bytes came out, all of them. Once something was dropped the cuts
+	move to where lines end, so what's kept can be a little less than size.
+	"""
+	__slots__ = ('size', 'keep', 'total', '_buffer', '_head', '_ring', '_filled', '_position', '_wrapped')
+
+	def __init__(self, size: int, keep: str='tail'):
+		if keep not in ('tail', 'head', 'both'):
+			raise ValueError(f"keep must be 'tail', 'head' or 'both', not {keep!r}")
+		if size < 0:
+			raise ValueError('max_output must not be negative')
+		head = size if keep == 'head' else size // 2 if keep == 'both' else 0
+		self.size = size
+		self.keep = keep
+		self.total = 0
+		self._buffer = bytearray(size)
+		view = memoryview(self._buffer)
+		self._head = view[:head]
+		self._ring = view[head:]
+		self._filled = self._position = 0
+		self._wrapped = False
+
+	def read(self, fd: int) -> int:
+		"""One read from fd into the buffer. Returns how much was read, 0 at the end."""
+		head, ring = self._head, self._ring
+		vectors = []
+		if self._filled < len(head):
+			vectors.append(head[self._filled:])
+		if ring:
+			position = self._position
+			vectors.append(ring[position:])
+			if position:
+				vectors.append(ring[:position])
+		if not vectors:
+			# Keeping the head and it's full, the rest only gets counted
+			data = os.read(fd, 65536)
+			self.total += len(data)
+			return len(data)
+		if sum(map(len, vectors)) < 65536:
+			# Too small to read into straight, that would be a syscall for every few bytes
+			data = os.read(fd, 65536)
+			self.write(data)
+			return len(data)
+		read = os.readv(fd, vectors)
+		self.total += read
+		taken = min(read, len(head) - self._filled)
+		self._filled += taken
+		rest = read - taken
+		if rest:
+			position = self._position + rest
+			if position >= len(ring):
+				self._wrapped = True
+				position -= len(ring)
+			self._position = position
+		return read
+
+	def write(self, data: bytes):
+		# For output that has already been read. Only the part that stays is copied
+		size = len(data)
+		self.total += size
+		view = memoryview(data)
+		taken = min(size, len(self._head) - self._filled)
+		if taken:
+			self._head[self._filled:self._filled + taken] = view[:taken]
+			self._filled += taken
+			view = view[taken:]
+		ring = self._ring
+		if not ring or not view:
+			return
+		if len(view) >= len(ring):
+			ring[:] = view[len(view) - len(ring):]
+			self._position = 0
+			self._wrapped = True
+			return
+		position = self._position
+		first = min(len(view), len(ring) - position)
+		ring[position:position + first] = view[:first]
+		if first < len(view):
+			ring[:len(view) - first] = view[first:]
+			self._wrapped = True
+		self._position = (position + len(view)) % len(ring)
+		if self._position == 0 and len(view):
+			self._wrapped = True
+
+	@property
+	def truncated(self) -> bool:
+		return self.total > self.size
+
+	def getvalue(self) -> bytes:
+		ring, position = self._ring, self._position
+		head = bytes(self._head[:self._filled])
+		tail = b''.join((ring[position:], ring[:position])) if self._wrapped else bytes(ring[:position])
+		if self.truncated:
+			# Cut where lines end when there's a newline to cut at, so a character
+			# split in half doesn't make decoding fail
+			end = head.rfind(b'\n')
+			if end >= 0:
+				head = head[:end + 1]
+			start = tail.find(b'\n')
+			if start >= 0:
+				tail = tail[start + 1:]
+		return head + tail
+
+def _output_buffers(max_output, keep, count: int) -> list:
+	# One _OutputBuffer per pipe we read, or None for each when there's no limit
+	if max_output is None:
+		return [None] * count
+	return [_OutputBuffer(max_output, keep) for number in range(count)]
+
+# How much of stderr a stream keeps when there's no max_output. It's the end that has the error in it
+_STREAM_STDERR = 1048576
+
+def _stderr_buffer(max_output, keep) -> _OutputBuffer:
+	# stderr of a stream, for the exception and the log. Bounded like everything else we hold
+	return _OutputBuffer(_STREAM_STDERR if max_output is None else max_output, keep)
+
+def _total_output(buffers) -> int:
+	# bytes_out for metrics when the output went through _OutputBuffers, they know what was dropped
+	buffers = [buffer for buffer in buffers if buffer is not None]
+	return sum(buffer.total for buffer in buffers) if buffers else None
+
+def _bounded(result, stdout_buffer, stderr_buffer):
+	# How much came out in total and whether we kept all of it, for max_output
+	result.stdout_total = None if stdout_buffer is None else stdout_buffer.total
+	result.stderr_total = None if stderr_buffer is None else stderr_buffer.total
+	result.truncated = any(buffer.truncated for buffer in (stdout_buffer, stderr_buffer) if buffer is not None)
+	return result
+
+def _input_size(input):
+	# For metrics. Whatever didn't go through a feeder went in whole or not through us at all
+	if isinstance(input, bytes):
+		return len(input)
+	if isinstance(input, str):
+		return len(input.encode(errors='surrogateescape'))
+	return None
+
+def _pipeline_name(prepared: list) -> str:
+	# What metrics files a pipeline under, its programs joined up like the shell would
+	return ' | '.join(os.path.basename(os.fsdecode(commands[0])) for commands, popen_kwargs in prepared)
+
+def _completed(process, returncode, stdout, stderr) -> CompletedProcess:
+	# CompletedProcess plus what the child used. usage is its rusage from wait4
+	result = CompletedProcess(process.args, returncode, stdout, stderr)
+	result.usage = process.rusage
+	return result
+
+def _outcome(args, returncode, stdout, stderr, check, text, encoding, errors, compact):
+	# The result for output we read as bytes, with check applied. A compact one
+	# keeps the bytes and only decodes them if someone asks
+	if compact:
+		result = CommandResult(args, returncode, stdout, stderr, encoding if text else None, errors)
+		if check:
+			result.check_returncode()
+		return result
+	if text:
+		if stdout is not None:
+			stdout = stdout.decode(encoding, errors)
+		if stderr is not None:
+			stderr = stderr.decode(encoding, errors)
+	if check and returncode:
+		raise CalledProcessError(returncode, args, output=stdout, stderr=stderr)
+	return CompletedProcess(args, returncode, stdout, stderr)
+
+def _total_usage(usages: list):
+	# One rusage for a pipeline. Everything adds up except the peaks, those take the biggest
+	usages = [usage for usage in usages if usage is not None]
+	if not usages:
+		return None
+	fields = []
+	for index, name in enumerate(('ru_utime', 'ru_stime', 'ru_maxrss', 'ru_ixrss', 'ru_idrss', 'ru_isrss',
+								'ru_minflt', 'ru_majflt', 'ru_nswap', 'ru_inblock', 'ru_oublock',
+								'ru_msgsnd', 'ru_msgrcv', 'ru_nsignals', 'ru_nvcsw', 'ru_nivcsw')):
+		values = [getattr(usage, name) for usage in usages]
+		fields.append(max(values) if name in ('ru_maxrss', 'ru_ixrss', 'ru_idrss', 'ru_isrss') else sum(values))
+	return resource.struct_rusage(fields)
+
+def _parsed(parser, outcome: list, text, encoding, errors) -> CompletedProcess:
+	# The result of a parse= run. stdout went into the parser and was never kept
+	process, stderr = outcome[0]
+	if stderr is not None and text:
+		stderr = stderr.decode(encoding, errors)
+	result = _completed(process, process.returncode, None, stderr)
+	result.parsed = parser.close()
+	return result
+
+def _feeder(input, encoding=None, errors='strict'):
+	return None if input is None else _InputFeeder(input, encoding, errors)
+
+def _feed(process, feeder, timeout, text, encoding, errors, buffers=(None, None)):
+	# communicate() for input that isn't str or bytes, or output we keep in buffers. Popen is in bytes mode here
+	deadline = None if timeout is None else time.monotonic() + timeout
+	pipes = [(file, buffer) for file, buffer in zip((process.stdout, process.stderr), buffers) if file]
+	try:
+		outputs = _communicate(process.stdin, feeder, [file.fileno() for file, buffer in pipes], deadline,
+								[buffer for file, buffer in pipes])
+		process.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+	except TimeoutExpired as exc:
+		raise TimeoutExpired(process.args, timeout, output=exc.output) from None
+	finally:
+		if feeder is not None:
+			feeder.close()
+	if text:
+		outputs = [output.decode(encoding, errors) for output in outputs]
+	outputs = iter(outputs)
+	return next(outputs) if process.stdout else None, next(outputs) if process.stderr else None
+
+def _communicate(stdin, feeder, readers: list, deadline=None, buffers=()):
+	"""Write what feeder has to stdin while reading every fd in readers until they are all closed.
+
+	Returns a list with the bytes read from each reader. Raises TimeoutExpired
+	with what was read so far if the deadline passes. buffers can have an _OutputBuffer
+	for each reader to read into instead of keeping everything, None keeps it all.
+	"""
+	outputs = {fd: [] for fd in readers}
+	outputs.update((fd, buffer) for fd, buffer in zip(readers, buffers) if buffer is not None)
+	with _PopenSelector() as selector:
+		if stdin:
+			if feeder is not None:
+				os.set_blocking(stdin.fileno(), False)
+				selector.register(stdin, selectors.EVENT_WRITE)
+			else:
+				stdin.close()
+		for fd in readers:
+			selector.register(fd, selectors.EVENT_READ)
+
+		while selector.get_map():
+			if deadline is None:
+				ready = selector.select()
+			else:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					raise TimeoutExpired(None, None,
+						output=_joined(outputs[readers[0]]) if readers else None)
+				ready = selector.select(remaining)
+
+			for key, events in ready:
+				if key.fileobj is stdin:
+					if feeder.write(key.fd):
+						selector.unregister(key.fileobj)
+						key.fileobj.close()
+				else:
+					output = outputs[key.fd]
+					if isinstance(output, _OutputBuffer):
+						more = output.read(key.fd)
+					else:
+						data = more = os.read(key.fd, 32768)
+						if data:
+							output.append(data)
+					if not more:
+						selector.unregister(key.fileobj)
+	return [_joined(outputs[fd]) for fd in readers]
+
+def _joined(output) -> bytes:
+	# What was read into a list of chunks or an _OutputBuffer
+	return output.getvalue() if isinstance(output, _OutputBuffer) else b''.join(output)
+
+class _BatchJob(object):
+	"""One command being run by pyshell.map"""
+	__slots__ = ('index', 'process', 'result', 'readers', 'outputs', 'feeder',
+				'deadline', 'timeout', 'check', 'text', 'encoding', 'errors', 'pidfd',
+				'logfile', 'started', 'metrics', 'record', 'stopping', 'compact')
+
+	def __init__(self, index: int):
+		self.index = index
+		self.process = None
+		self.result = None
+		self.readers = {}
+		self.outputs = {}
+		self.feeder = None
+		self.deadline = None
+		self.pidfd = None
+		self.logfile = None
+		self.record = None
+		self.stopping = False
+
+	def start(self, shell, chain: tuple, args: tuple, kwargs: dict, selector):
+		self.metrics = metrics = shell._metrics
+		record = metrics.start() if metrics is not None else None
+		self.compact = shell._compact_for(kwargs)
+		max_output, keep = shell._output_limit(kwargs)
+		(name, commands, found, input, capture_output, check,
+		logfile, timeout, expect, popen, kwargs) = shell._prepare(chain, args, **kwargs)
+		if not found:
+			raise CommandNotFound(f'command {name} does not exist')
+		if record is not None:
+			metrics.resolved(record, name, commands)
+			self.record = record
+		self.text, self.encoding, self.errors = _text_options(kwargs, input)
+		if not capture_output and logfile:
+			kwargs['stdout'] = logfile.fileno()
+			kwargs['stderr'] = shell.STDOUT
+		self.check = check
+		self.timeout = timeout
+
+		if logfile:
+			self.logfile = logfile
+			self.started = logfile.begin(commands)
+		try:
+			self.process = process = pyshellPopen(commands, **kwargs)
+		except BaseException as exc:
+			if logfile:
+				logfile.end(commands, self.started)
+			if record is not None:
+				metrics.finish(record, error=exc)
+			raise
+		if timeout is not None:
+			self.deadline = time.monotonic() + timeout
+		if process.stdin:
+			if input is not None:
+				self.feeder = _InputFeeder(input, self.encoding, self.errors)
+				os.set_blocking(process.stdin.fileno(), False)
+				selector.register(process.stdin, selectors.EVENT_WRITE, self)
+			else:
+				process.stdin.close()
+		for name, file in (('stdout', process.stdout), ('stderr', process.stderr)):
+			if file:
+				self.readers[file.fileno()] = file
+				self.outputs[name] = [] if max_output is None else _OutputBuffer(max_output, keep)
+				selector.register(file, selectors.EVENT_READ, self)
+		try:
+			self.pidfd = os.pidfd_open(process.pid)
+		except (AttributeError, OSError):
+			pass
+		else:
+			selector.register(self.pidfd, selectors.EVENT_READ, self)
+
+	def ready(self, key, selector):
+		process = self.process
+		if key.fileobj is process.stdin:
+			if self.feeder.write(key.fd):
+				selector.unregister(key.fileobj)
+				key.fileobj.close()
+		elif key.fd == self.pidfd:
+			# It exited, whatever is left in the pipes will still be read
+			selector.unregister(key.fd)
+			os.close(self.pidfd)
+			self.pidfd = None
+			process.poll()
+		else:
+			output = self.outputs['stdout' if key.fileobj is process.stdout else 'stderr']
+			if isinstance(output, _OutputBuffer):
+				more = output.read(key.fd)
+			else:
+				data = more = os.read(key.fd, 32768)
+				if data:
+					output.append(data)
+			if not more:
+				selector.unregister(key.fileobj)
+				del self.readers[key.fd]
+
+	def finish(self, selector, now) -> bool:
+		# Returns True once the job has a result
+		process = self.process
+		if self.deadline is not None and now >= self.deadline and (
+			self.readers or process.poll() is None):
+			# Drop the pipes so nothing it left running can hold us up. The pidfd stays
+			# to tell us when it's gone, which with a kill_grace doesn't have to be right away
+			self._close(selector, pidfd=False)
+			process.stop()
+			self.deadline = None
+			self.stopping = True
+		if self.stopping:
+			if process.poll() is None:
+				return False
+			self._close(selector)
+			self.result = TimeoutExpired(process.args, self.timeout)
+			self._record(error=self.result)
+			return True
+		if self.readers or process.poll() is None:
+			return False
+
+		self._close(selector)
+		outputs = self.outputs
+		stdout, stderr = (_joined(outputs[name]) if name in outputs else None for name in ('stdout', 'stderr'))
+		self._record(stdout, stderr)
+		try:
+			self.result = _outcome(process.args, process.returncode, stdout, stderr,
+								self.check, self.text, self.encoding, self.errors, self.compact)
+		except CalledProcessError as exc:
+			self.result = exc
+		else:
+			self.result.usage = process.rusage
+			buffers = [output if isinstance(output, _OutputBuffer) else None
+						for output in (outputs.get('stdout'), outputs.get('stderr'))]
+			if any(buffers):
+				_bounded(self.result, *buffers)
+		return True
+
+	def _close(self, selector, pidfd=True):
+		process = self.process
+		for file in list(self.readers.values()) + [process.stdin]:
+			if file and not file.closed:
+				try:
+					selector.unregister(file)
+				except (KeyError, ValueError):
+					pass
+				file.close()
+		self.readers.clear()
+		if self.feeder is not None:
+			self.feeder.close()
+		if pidfd and self.pidfd is not None:
+			selector.unregister(self.pidfd)
+			os.close(self.pidfd)
+			self.pidfd = None
+		for file in (process.stdout, process.stderr):
+			if file:
+				file.close()
+
+	def _record(self, stdout=None, stderr=None, error=None):
+		# Finish off the log and metrics records, once
+		process = self.process
+		if self.logfile:
+			self.logfile.end(process.args, self.started, process.pid, process.returncode, stdout, stderr)
+			self.logfile = None
+		if self.record is not None:
+			buffers = [output for output in self.outputs.values() if isinstance(output, _OutputBuffer)]
+			self.metrics.finish(self.record, (process,), stdout=stdout, stderr=stderr,
+								bytes_in=self.feeder.written if self.feeder is not None else None,
+								bytes_out=_total_output(buffers), error=error)
+			self.record = None
+
+	def kill(self):
+		process = self.process
+		if process is not None:
+			if process.returncode is None:
+				process.stop()
+			process.__exit__(None, None, None)
+			self._record()
+		if self.pidfd is not None:
+			os.close(self.pidfd)
+			self.pidfd = None
+
+def _wait_jobs(running: list, selector) -> tuple:
+	"""Waits until one of the running _BatchJobs has something to do, a deadline passes or it's time to poll.
+
+	Returns (still running, finished). map and TaskGraph both schedule with this, so their timeouts work the same.
+	"""
+	timeout = None
+	for job in running:
+		if job.deadline is not None:
+			remaining = max(job.deadline - time.monotonic(), 0)
+			timeout = remaining if timeout is None else min(timeout, remaining)
+		if job.pidfd is None and not job.readers:
+			# Nothing to tell us it exited, so we have to poll
+			timeout = 0.05 if timeout is None else min(timeout, 0.05)
+
+	for key, events in selector.select(timeout):
+		key.data.ready(key, selector)
+
+	now = time.monotonic()
+	still_running = []
+	finished = []
+	for job in running:
+		if job.finish(selector, now):
+			finished.append(job)
+		else:
+			still_running.append(job)
+	return still_running, finished
+
+def _inheritable_fds():
+	# Every open descriptor without FD_CLOEXEC, or None if we can't tell cheaply
+	try:
+		fds = os.listdir('/proc/self/fd')
+	except OSError:
+		# Trying every number up to SC_OPEN_MAX can be a million syscalls in a
+		# container. fork_exec closes them with close_range, leave it to that
+		return None
+	inheritable = []
+	for fd in fds:
+		fd = int(fd)
+		try:
+			if os.get_inheritable(fd):
+				inheritable.append(fd)
+		except OSError:
+			# Including the one listdir just closed
+			pass
+	return inheritable
+
+class _Environment(dict):
+	"""An env for a prepared command, with the KEY=VALUE blocks execve wants encoded once."""
+	__slots__ = ('encoded',)
+
+	def __init__(self, env):
+		super().__init__(env)
+		encoded = []
+		for key, value in self.items():
+			key = os.fsencode(key)
+			if b'=' in key:
+				raise ValueError("illegal environment variable name")
+			encoded.append(key + b'=' + os.fsencode(value))
+		self.encoded = encoded
+
+	def __reduce__(self):
+		# The fork server only knows plain dicts
+		return (dict, (dict(self),))
+
 class pyshellPopen(Popen):
+
+	def __init__(self, *args, fast_spawn=False, rlimits=None, nice=None, ionice=None,
+				affinity=None, cgroup=None, cgroup_limits=None, kill_group=False, kill_grace=0,
+				fork_server=None, **kwargs):
+		"""Popen with a few pyshell patches.
+
+		Arguments:
+			fast_spawn: start the child with posix_spawn whenever it is safe, even with close_fds.
+				Inheritable descriptors are closed through spawn file actions instead of in a forked child.
+				It is skipped for cwd, pass_fds, preexec_fn, user/group changes and umask.
+			rlimits: a dict of resource limits, like {'as': 2 << 30, 'cpu': 60, resource.RLIMIT_NOFILE: (1024, 4096)}.
+				A single number is both the soft and the hard limit.
+			nice: added to our niceness for the child, like nice -n.
+			ionice: an I/O class, 'realtime', 'best-effort' or 'idle', or a class and a level like ('best-effort', 7).
+			affinity: the CPUs the child may run on.
+			cgroup: a cgroup v2 directory to put the child in. Relative paths are under /sys/fs/cgroup.
+			cgroup_limits: make the child a cgroup of its own under cgroup with these limits,
+				like {'memory.max': '512M', 'cpu.max': '50000 100000'}. It's removed again once the child is reaped.
+
+			kill_group: start the child in a session of its own so stop() gets everything it started too,
+				like the commands of a shell. It won't have our terminal.
+			kill_grace: seconds stop() gives the child between SIGTERM and SIGKILL. With 0 it's SIGKILL right away.
+			fork_server: have a ForkServer start the child instead of forking ourselves, True for the shared one.
+				The cost of starting it doesn't grow with our memory then. Children with limits,
+				preexec_fn or pass_fds are still started by us.
+
+		None of the limits run anything in the child, they're set from here through its pid as soon as
+		it exists. So they don't need preexec_fn and fast_spawn still works with them.
+
+		Waits with a timeout sleep on a pidfd until the child exits rather than polling for it.
+
+		stdin can also be a path, it is opened for the child and closed again once it's started.
+
+		Children are reaped with wait4, so once it has exited rusage holds the child's resource
+		usage. started_at, spawned_at and exited_at are time.perf_counter() readings from when
+		we began starting it, when it was running and when we saw it exit.
+		"""
+		self._fast_spawn = fast_spawn
+		self._fork_server = None
+		if fork_server:
+			from .forkserver import _server
+			self._fork_server = _server(fork_server)
+		# The ForkServer that started the child, it has the exit status
+		self._remote = None
+		self.kill_group = kill_group
+		self.kill_grace = kill_grace
+		if kill_group:
+			kwargs['start_new_session'] = True
+		self._limits = None
+		if (rlimits or nice is not None or ionice is not None or affinity is not None
+				or cgroup is not None or cgroup_limits):
+			self._limits = Limits(rlimits, nice, ionice, affinity, cgroup, cgroup_limits)
+		self.rusage = None
+		self.exited_at = None
+		self.started_at = time.perf_counter()
+		stdin = kwargs.get('stdin')
+		try:
+			if isinstance(stdin, os.PathLike):
+				with open(stdin, 'rb') as kwargs['stdin']:
+					super().__init__(*args, **kwargs)
+			else:
+				super().__init__(*args, **kwargs)
+		except BaseException:
+			if self._limits is not None:
+				self._limits.release()
+			raise
+		self.spawned_at = time.perf_counter()
+
+	def _wait4(self, pid, flags, _wait4=os.wait4, _perf_counter=time.perf_counter):
+		# waitpid that keeps the rusage. The defaults are bound so it works during shutdown, like Popen's
+		if self._remote is not None:
+			pid, sts, rusage = self._remote.wait(pid, not flags & os.WNOHANG)
+		else:
+			pid, sts, rusage = _wait4(pid, flags)
+		if pid:
+			self.rusage = rusage
+			self.exited_at = _perf_counter()
+			if self._limits is not None:
+				self._limits.release()
+		return pid, sts
+
+	def _internal_poll(self, _deadstate=None, _waitpid=None, _WNOHANG=os.WNOHANG, _ECHILD=errno.ECHILD):
+		return super()._internal_poll(_deadstate, self._wait4, _WNOHANG, _ECHILD)
+
+	def _wait(self, timeout):
+		# Popen sleeps and polls in a loop when there's a timeout. Sleep on a pidfd instead,
+		# it wakes us the moment the child exits.
+		if timeout is None or self.returncode is not None:
+			return super()._wait(timeout)
+		deadline = time.monotonic() + timeout
+		try:
+			pidfd = os.pidfd_open(self.pid)
+		except (AttributeError, OSError):
+			return super()._wait(timeout)
+		try:
+			poller = select.poll()
+			poller.register(pidfd, select.POLLIN)
+			exited = False
+			while True:
+				if self._waitpid_lock.acquire(False):
+					try:
+						if self.returncode is not None:
+							break
+						(pid, sts) = self._try_wait(os.WNOHANG)
+						if pid == self.pid:
+							self._handle_exitstatus(sts)
+							break
+					finally:
+						self._waitpid_lock.release()
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					raise TimeoutExpired(self.args, timeout)
+				if exited:
+					# Another thread has the lock and is reaping it, give it a moment
+					time.sleep(min(remaining, 0.001))
+				else:
+					exited = bool(poller.poll(math.ceil(remaining * 1000)))
+		finally:
+			os.close(pidfd)
+		return self.returncode
+
+	def stop(self):
+		"""Stop the child, or its whole session with kill_group. Doesn't wait for it.
+
+		SIGTERM first and SIGKILL once kill_grace is up. The SIGKILL comes from a timer thread
+		shared by every command. It goes through a pidfd, so it can't hit some other process
+		that got the pid in the meantime, and with kill_group it also gets anything the child
+		left behind when it exited on the SIGTERM.
+		"""
+		if self.returncode is not None and not self.kill_group:
+			return
+		if self.kill_grace <= 0:
+			self._signal(signal.SIGKILL)
+			return
+		pidfd = None
+		if not self.kill_group and self.returncode is None:
+			try:
+				pidfd = os.pidfd_open(self.pid)
+			except (AttributeError, OSError):
+				pass
+		self._signal(signal.SIGTERM)
+		_timers.call_later(self.kill_grace, self._escalate, pidfd)
+
+	def _signal(self, sig):
+		if self.kill_group:
+			try:
+				os.killpg(self.pid, sig)
+			except ProcessLookupError:
+				pass
+		else:
+			self.send_signal(sig)
+
+	def _escalate(self, pidfd):
+		# On the timer thread, once the grace period is over
+		if pidfd is None:
+			self._signal(signal.SIGKILL)
+			return
+		try:
+			signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+		except ProcessLookupError:
+			pass
+		finally:
+			os.close(pidfd)
+
+	def _try_wait(self, wait_flags):
+		try:
+			(pid, sts) = self._wait4(self.pid, wait_flags)
+		except ChildProcessError:
+			# This happens if SIGCLD is set to be ignored or waiting
+			# for child processes has otherwise been disabled for our
+			# process.  This child is dead, we can't get the status.
+			pid = self.pid
+			sts = 0
+		return (pid, sts)
+
 	# we are overriding execute child so we can pass a list into the shell for extglob.
 	def _execute_child(self, args, executable, preexec_fn, close_fds,
 						pass_fds, cwd, env,
@@ -83,7 +1213,67 @@ class pyshellPopen(Popen):
 			executable = args[0]
 
 		sys.audit("subprocess.Popen", executable, args, cwd, env)
-		
+
+		## Pyshell Patch ##
+		# Restricted commands start behind a gate that holds them until they're restricted
+		if self._limits is not None:
+			args, executable = self._limits.gate(args, executable, env)
+
+		# The fork server forks a process of a few MB instead of us. The limits need
+		# the child stopped under us, and functions and fd numbers can't be sent over
+		elif (self._fork_server is not None
+				and self._fork_server.usable
+				and preexec_fn is None
+				and not pass_fds):
+			self.pid = self._fork_server.spawn(
+				args, executable,
+				# Our own stdio where it's not redirected
+				(0 if p2cread == -1 else p2cread,
+				1 if c2pwrite == -1 else c2pwrite,
+				2 if errwrite == -1 else errwrite),
+				# It should see ours as they are now, not what the server started with
+				cwd=os.getcwd() if cwd is None else cwd,
+				env=dict(os.environb) if env is None else env,
+				close_fds=close_fds, restore_signals=restore_signals,
+				start_new_session=start_new_session,
+				group=gid, extra_groups=gids, user=uid, umask=umask)
+			self._child_created = True
+			self._remote = self._fork_server
+			self._close_pipe_fds(p2cread, p2cwrite,
+									c2pread, c2pwrite,
+									errread, errwrite)
+			return
+
+		if (self._fast_spawn
+				and _USE_POSIX_SPAWN
+				and preexec_fn is None
+				and not pass_fds
+				and cwd is None
+				and (p2cread == -1 or p2cread > 2)
+				and (c2pwrite == -1 or c2pwrite > 2)
+				and (errwrite == -1 or errwrite > 2)
+				and gid is None
+				and gids is None
+				and uid is None
+				and umask < 0):
+			if not os.path.dirname(executable):
+				# posix_spawn doesn't search $PATH. Fall through if we can't find it
+				# so the normal path raises the usual error.
+				import shutil
+				found = shutil.which(executable, path=os.pathsep.join(os.get_exec_path(env)))
+				if found is not None and os.path.dirname(found):
+					executable = found
+			inheritable = _inheritable_fds() if close_fds else ()
+			if os.path.dirname(executable) and inheritable is not None:
+				self._spawn(args, executable, env, restore_signals,
+							close_fds, start_new_session,
+							p2cread, p2cwrite,
+							c2pread, c2pwrite,
+							errread, errwrite, inheritable)
+				if self._limits is not None:
+					self._limits.apply(self.pid)
+				return
+
 		if (_USE_POSIX_SPAWN
 				and os.path.dirname(executable)
 				and preexec_fn is None
@@ -102,6 +1292,8 @@ class pyshellPopen(Popen):
 								p2cread, p2cwrite,
 								c2pread, c2pwrite,
 								errread, errwrite)
+			if self._limits is not None:
+				self._limits.apply(self.pid)
 			return
 
 		orig_executable = executable
@@ -124,7 +1316,11 @@ class pyshellPopen(Popen):
 				# potential deadlocks, thus we do all this here.
 				# and pass it to fork_exec()
 
-				if env is not None:
+				if isinstance(env, _Environment):
+					## Pyshell Patch ##
+					# Encoded once when the template was prepared
+					env_list = env.encoded
+				elif env is not None:
 					env_list = []
 					for k, v in env.items():
 						k = os.fsencode(k)
@@ -155,6 +1351,9 @@ class pyshellPopen(Popen):
 						gid, gids, uid, umask,
 						preexec_fn)
 				self._child_created = True
+				## Pyshell Patch ##
+				if self._limits is not None:
+					self._limits.apply(self.pid)
 			finally:
 				# be sure the FD is closed no matter what
 				os.close(errpipe_write)
@@ -214,12 +1413,62 @@ class pyshellPopen(Popen):
 				raise child_exception_type(errno_num, err_msg, err_filename)
 			raise child_exception_type(err_msg)
 
+	def _spawn(self, args, executable, env, restore_signals,
+				close_fds, start_new_session,
+				p2cread, p2cwrite,
+				c2pread, c2pwrite,
+				errread, errwrite, inheritable=()):
+		"""Execute program using os.posix_spawn(), closing the inheritable fds with file actions"""
+		if env is None:
+			env = os.environ
+
+		kwargs = {}
+		if restore_signals:
+			# See _Py_RestoreSignals() in Python/pylifecycle.c
+			sigset = []
+			for signame in ('SIGPIPE', 'SIGXFZ', 'SIGXFSZ'):
+				signum = getattr(signal, signame, None)
+				if signum is not None:
+					sigset.append(signum)
+			kwargs['setsigdef'] = sigset
+		if start_new_session:
+			kwargs['setsid'] = True
+
+		file_actions = []
+		for fd in (p2cwrite, c2pread, errread):
+			if fd != -1:
+				file_actions.append((os.POSIX_SPAWN_CLOSE, fd))
+		for fd, fd2 in (
+			(p2cread, 0),
+			(c2pwrite, 1),
+			(errwrite, 2),
+		):
+			if fd != -1:
+				file_actions.append((os.POSIX_SPAWN_DUP2, fd, fd2))
+		if close_fds:
+			# Everything Python opens is close on exec already (PEP 446),
+			# so only the descriptors someone made inheritable need closing.
+			skip = {p2cwrite, c2pread, errread}
+			for fd in inheritable:
+				if fd > 2 and fd not in skip:
+					file_actions.append((os.POSIX_SPAWN_CLOSE, fd))
+		if file_actions:
+			kwargs['file_actions'] = file_actions
+
+		self.pid = os.posix_spawn(executable, args, env, **kwargs)
+		self._child_created = True
+
+		self._close_pipe_fds(p2cread, p2cwrite,
+								c2pread, c2pwrite,
+								errread, errwrite)
+
 class pyshell(object):
 
 	def __init__(	self,
 					input=None, capture_output=False, check=False,
 					logfile=None, timeout=None, alias: dict={},
-					expect=False, popen=False, **kwargs):
+					expect=False, popen=False, persistent=False, metrics=None, cache=None, compact=False,
+					max_output=None, keep='tail', **kwargs):
 		"""Subprocess as an object, for Linux.
 
 		Initialize with certain options and use them through the life of your object.
@@ -228,12 +1477,34 @@ class pyshell(object):
 
 		Arguments:
 			logfile: logfile='/tmp/pyshell.log' expects an unopen file. We will open for you.
+				It stays open for as long as the pyshell does and every command is framed in it.
+				Pass a CommandLog instead for rotation or tee.
 			aliasing: You can alias commands like so sh = pyshell(alias={'ls': ['ls', '-lah', '--color']})
 
 		anytime you run sh.ls() you will actually run 'ls -lah --color'. This works for all commands as it does it by name
 
 			input: can be either str or bytes. It will figure it out and switch text for you.
+				Paths, open files, buffers like mmap and iterables of chunks work too and are never read in whole.
 			shell: if you specify True it will use '/bin/bash'. You can also pass the shell instead of True, it's fine. shell='/bin/dash'
+			persistent: keep one shell running and send shell commands to it instead of starting a new shell every time.
+			metrics: a CommandMetrics to time and count every command with.
+			parse: parse stdout as it arrives instead of keeping it. 'json', 'jsonl', 'lines', 'csv', 'tsv',
+				'table' or a Parser. Give it per call, the result's parsed has what came out and stdout is None.
+			cache: keep the results of commands that always give the same answer. True keeps them
+				until they're pushed out, a number keeps them that many seconds, or pass a ResultCache.
+				Only captured output with str or bytes input (or none) can be cached, other calls
+				just run as they are. Only successful results are kept. cache_depends=[paths] on a call drops its result
+				when one of those files changes.
+			compact: return a CommandResult instead of a CompletedProcess. It has no __dict__ and
+				keeps the output as bytes until it's read, for when you hold on to a lot of results.
+			max_output: keep at most this many bytes of stdout and of stderr. The output is read into a
+				buffer of that size made up front, however much the command writes. The result's
+				truncated says if anything was dropped, stdout_total and stderr_total how much there was.
+			keep: what max_output keeps. 'tail' for the end, like a build log's error, 'head' for the start
+				or 'both' for half of each.
+			fork_server: start commands from a small helper process instead of forking this one,
+				for programs with a big heap. True uses a shared ForkServer, which is started right
+				away so it's forked while we're still small. Or pass your own ForkServer.
 
 		The run function can override things that are defined in the object. If you just need one off command to work differently the use it.
 
@@ -251,70 +1522,372 @@ class pyshell(object):
 		self._timeout = timeout
 		self._popen = popen
 		self._expect = expect
+		self._persistent = persistent
+		self._metrics = metrics
+		self._cache = cache
+		# Made the first time something is cached
+		self._results = cache if _is_result_cache(cache) else None
+		self._results_lock = threading.Lock()
+		self._compact = compact
+		self._max_output = max_output
+		self._keep = keep
+		# name: cache, for aliases with their own
+		self._alias_cache = {}
+		# shell: ShellCoprocess, for persistent
+		self._coprocesses = {}
+		self._coprocess_lock = threading.Lock()
+		# path: CommandLog, for every logfile given as a path
+		self._logs = {}
+		self._log_lock = threading.Lock()
 		# Arguments that will be passed to Popen
 		self.kwargs = kwargs
-		self._list = []
-
-		# Define all the available shell commands
-		# Might end up removing some of these in the future as they aren't used
-		# But for now they aren't causing any harm
-		(self.programs_tuple,
-		self.dot_file_tuple, 
-		self.dash_file_tuple, 
-		self.underscore_file_tuple, 
-		self.hybrid_file_tuple) = self.Parse_Path_Programs()
+		if kwargs.get('fork_server') is True:
+			from .forkserver import _server
+			_server(True)
 
 		self.PIPE = -1
 		self.STDOUT = -2
 		self.DEVNULL = -3
 		self.DEFAULT = -4
+		self.ARG = ARG
 
 		# If alias was defined and is not a dict throw an error
 		if alias is not None:
 			if not isinstance(alias, dict):
 				raise TypeError(f"expected dict but got {type(alias).__name__} instead")
-		self._alias = alias
+		# Take our own copy. The default dict is shared between every instance
+		# and setAlias swaps the whole dict, so threads never see it half updated.
+		self._alias = dict(alias) if alias else {}
+		# chain: (path index generation, alias dict, resolved command)
+		self._resolved = {}
 
 	def __getattr__(self, attr: str):
-		# We need to do some check against what was called. So we get our call. 
-		call = getouterframes(currentframe())[1].code_context[0]
+		# Dunder lookups come from things like copy and pickle, they are never commands
+		if attr.startswith('__') and attr.endswith('__'):
+			raise AttributeError(f"{type(self).__name__!r} object has no attribute {attr!r}")
+		# Hand back a command that remembers the chain. Nothing runs until it's called,
+		# and a chain that is never called is simply thrown away.
+		return pyshellCommand(self, (attr,))
+
+	def __call__(self, *args, **kwargs):
+		return self._run_chain((), *args, **kwargs)
+
+	def prepare(self, *args, **kwargs) -> 'pyshellTemplate':
+		"""Work out a command once and get back something that runs it as often as you like.
+
+		Takes the same arguments as calling the pyshell. Aliases, $PATH, our options and
+		the env are all dealt with here instead of on every call. sh.ARG marks an
+		argument that is given when it runs, anything given past those is added at the end.
+
+		A prepared command always starts a fresh process, cache and persistent don't apply
+		to it and it can't be used with shell or expect. Keyword arguments given when it's
+		called go through the normal way, with the ones it was prepared with.
+
+		input is used by every call, so it has to be something that can be read more than once:
+		str, bytes or another buffer, a path or a list of chunks. A file or an iterator would be
+		empty after the first call and is a ValueError, pass those as input= when calling it.
+
+		Example::
+
+		copy = sh.prepare('rsync', '-a', sh.ARG, 'backup:/srv/', env={'RSYNC_RSH': 'ssh -c aes128-gcm@openssh.com'})
+		for path in paths:
+			copy(path)
+		"""
+		return self._template((), args, kwargs)
+
+	def _template(self, chain: tuple, args: tuple, kwargs: dict) -> 'pyshellTemplate':
+		given = dict(kwargs)
+		for option in ('cache', 'cache_depends', 'parse'):
+			if kwargs.get(option) is not None:
+				raise ValueError(f'{option} may not be used with prepare.')
+		kwargs.pop('persistent', None)
+		# Checked before _prepare, that hands a file straight to stdin
+		input = kwargs.get('input')
+		if input is None:
+			input = self._input
+		if not _reusable(None if input is self.DEFAULT else input):
+			raise ValueError('prepare needs input that can be used again, like str, bytes, a path or a list. '
+							'A file or an iterator would be used up by the first call, give it when calling instead.')
+		compact = self._compact_for(kwargs)
+		max_output, keep = self._output_limit(kwargs)
+
+		(name, commands, found, input, capture_output, check,
+		logfile, timeout, expect, popen, kwargs) = self._prepare(chain, args, **kwargs)
+
+		if kwargs.get('shell') is not None or self.kwargs.get('shell') is not None:
+			raise ValueError('shell may not be used with prepare.')
+		if expect:
+			raise ValueError('expect may not be used with prepare.')
+		if not found:
+			raise CommandNotFound(f'command {name} does not exist')
+		if kwargs.get('env') is not None:
+			kwargs['env'] = _Environment(kwargs['env'])
+		options = (input, capture_output, check, logfile, timeout, popen, compact, max_output, keep)
+		return pyshellTemplate(self, name, tuple(commands), options, kwargs, chain, args, given)
+
+	def _run_template(self, name, commands: list, options: tuple, kwargs: dict):
+		# A prepared command with its arguments filled in, straight to run
+		input, capture_output, check, logfile, timeout, popen, compact, max_output, keep = options
+		if logfile and not capture_output:
+			kwargs = dict(kwargs, stdout=logfile.fileno(), stderr=self.STDOUT)
+		if popen:
+			if logfile:
+				logfile.begin(commands)
+			return pyshellPopen(commands, **kwargs)
+		record = None
+		metrics = self._metrics
+		if metrics is not None:
+			record = metrics.start()
+			metrics.resolved(record, name, commands)
+		return self.run(	commands,
+							input=input, capture_output=capture_output, check=check,
+							logfile=logfile, timeout=timeout, record=record,
+							compact=compact, max_output=max_output, keep=keep, **kwargs)
+
+	def _run_chain(self, chain: tuple, *args, **kwargs):
+		persistent = kwargs.pop('persistent', False)
+		if persistent is False:
+			persistent = self._persistent
+		if persistent is self.DEFAULT:
+			persistent = False
+		cache = kwargs.pop('cache', None)
+		depends = kwargs.pop('cache_depends', None)
+		parse = kwargs.pop('parse', None)
+		compact = self._compact_for(kwargs)
+		max_output, keep = self._output_limit(kwargs)
+
+		metrics = self._metrics
+		record = metrics.start() if metrics is not None else None
+
+		(name, commands, found, input, capture_output, check,
+		logfile, timeout, expect, popen, kwargs) = self._prepare(chain, args, **kwargs)
+
+		if record is not None:
+			if expect or popen:
+				# We never see these finish
+				record = None
+			else:
+				metrics.resolved(record, name, commands)
+
+		if parse is not None:
+			if expect or popen or cache:
+				raise ValueError('parse may not be used with expect, popen or cache.')
+			parser, text, encoding, errors = self._parse_options(name, found, parse, input, capture_output, kwargs)
+			outcome = []
+			for chunk in self._stream(commands, input, check, logfile, timeout,
+										False, 65536, None, kwargs, record, outcome, max_output, keep):
+				parser.feed(chunk)
+			return _parsed(parser, outcome, text, encoding, errors)
+
+		store, ttl = self._cache_for(name, cache)
+		key = None
+		if store is not None and not expect and not popen:
+			key = self._cache_key(commands, found, input, capture_output, kwargs, depends,
+									cache is not None, _output_shape(compact, max_output, keep))
+		if key is not None:
+			result = store.get(key, ttl)
+			if result is not None:
+				return result
+			stored = time.monotonic()
+			snapshot = store.snapshot(depends) if depends else ()
+			result = self.run(	commands,
+								input=input, capture_output=capture_output, check=check,
+								logfile=logfile, timeout=timeout, record=record,
+								compact=compact, max_output=max_output, keep=keep, **kwargs)
+			if result.returncode == 0:
+				store.put(key, result, snapshot, stored)
+			return result
+
+		if (persistent and kwargs.get('shell') and not expect and not popen
+				and input is None and max_output is None):
+			# Anything the long lived shell can't do for one command goes to a fresh one
+			if set(kwargs) <= _PERSISTENT_KWARGS and (capture_output or (
+				kwargs.get('stdout') is None and kwargs.get('stderr') is None)):
+				return self._run_persistent(commands[0], capture_output, check, logfile, timeout, kwargs, record, compact)
+
+		if not capture_output:
+			if logfile:
+				# The log stays open, the command just writes into it
+				kwargs['stdout'] = logfile.fileno()
+				kwargs['stderr'] = self.STDOUT
+
+		if kwargs.get('shell') is None and self.kwargs.get('shell') is None:
+			if found:
+				if expect:
+					# pexpect is only loaded for the few who use it
+					from pexpect import spawn
+					return spawn(" ".join(com for com in commands))
+				elif popen:
+					# We never see it finish, so there's only the start of a record
+					if logfile:
+						logfile.begin(commands)
+					return pyshellPopen(commands, **kwargs)
+				else:
+					return self.run(	commands,
+										input=input, capture_output=capture_output, check=check,
+										logfile=logfile, timeout=timeout, record=record,
+										compact=compact, max_output=max_output, keep=keep, **kwargs)
+			else:
+				raise CommandNotFound(f'command {name} does not exist')
+		else:
+			return self.run(	commands,
+								input=input, capture_output=capture_output, check=check,
+								logfile=logfile, timeout=timeout, record=record,
+								compact=compact, max_output=max_output, keep=keep, **kwargs)
+
+	def _output_limit(self, kwargs: dict) -> tuple:
+		# max_output= and keep= from the call, or ours
+		max_output = kwargs.pop('max_output', None)
+		if max_output is None:
+			max_output = self._max_output
+		if max_output is self.DEFAULT:
+			max_output = None
+		keep = kwargs.pop('keep', None) or self._keep
+		return max_output, keep
+
+	def _compact_for(self, kwargs: dict) -> bool:
+		# compact= from the call, or ours
+		compact = kwargs.pop('compact', False)
+		if compact is False:
+			compact = self._compact
+		if compact is self.DEFAULT:
+			compact = False
+		return bool(compact)
+
+	def _run_persistent(self, command: str, capture_output, check, logfile, timeout, kwargs: dict, record=None, compact=False):
+		shell = kwargs['executable']
+		shell = tuple(shell) if isinstance(shell, list) else (shell,)
+		text, encoding, errors = _text_options(kwargs)
+		with self._coprocess_lock:
+			coprocess = self._coprocesses.get(shell)
+			if coprocess is None:
+				from .coprocess import ShellCoprocess
+				coprocess = self._coprocesses[shell] = ShellCoprocess(shell)
+
+		out_sink = err_sink = None
+		if logfile:
+			started = logfile.begin([command])
+		if not capture_output:
+			if logfile:
+				out_sink = err_sink = logfile.write
+			else:
+				# Same place a fresh shell would have written to
+				sys.stdout.flush()
+				sys.stderr.flush()
+				out_sink = functools.partial(_write_all, 1)
+				err_sink = functools.partial(_write_all, 2)
+		returncode = stdout = stderr = error = None
 		try:
-			# Now we're going to try to index it at a (). If this fails due to ValueError
-			# Then it means the command wasn't called. Ex: pyshell.mkfs.ext4 instead of pyshell.mkfs.ext4().
-			# We HAVE to catch and clear the list if this happens Or else commands could build in the store and
-			# You might call something later you don't really want to.
-			call = call[:call.index('(')].split('.')
-			self._list.append(attr)
-			return self
-		except ValueError:
-			self._list.clear()
-		return self
-
-	def __call__(self, *args,
+			returncode, stdout, stderr = coprocess.run(command, kwargs.get('cwd'), timeout, out_sink, err_sink)
+		except BaseException as exc:
+			error = exc
+			raise
+		finally:
+			if logfile:
+				logfile.end([command], started, None, returncode, stdout, stderr)
+			if record is not None:
+				self._metrics.finish(record, returncode=returncode, stdout=stdout, stderr=stderr, error=error)
+
+		result = _outcome([command], returncode, stdout, stderr, check, text, encoding, errors, compact)
+		# It ran inside the long lived shell, there's no rusage of its own
+		result.usage = None
+		return result
+
+	def _parse_options(self, name: str, found: bool, parse, input, capture_output, kwargs: dict) -> tuple:
+		# The parser for a call. Its stdout is ours to read, so it has to be a pipe
+		if not found and not kwargs.get('shell'):
+			raise CommandNotFound(f'command {name} does not exist')
+		if not capture_output and kwargs.get('stdout') is not None:
+			raise ValueError('stdout may not be used with parse.')
+		kwargs['stdout'] = self.PIPE
+		# Only peek, _stream takes the text options out itself
+		text, encoding, errors = _text_options(dict(kwargs), input)
+		from .parse import _parser
+		return _parser(parse, encoding, errors), text, encoding, errors
+
+	def _cache_for(self, name: str, cache) -> tuple:
+		# The ResultCache and ttl for a call, None when it isn't cached
+		if cache is None:
+			cache = self._alias_cache.get(name, self._cache)
+		if _is_result_cache(cache):
+			return cache, None
+		if cache is self.DEFAULT or not cache:
+			return None, None
+		return self.result_cache, None if cache is True else cache
+
+	def _cache_key(self, commands: list, found: bool, input, capture_output, kwargs: dict, depends=None,
+					strict=True, shape=()) -> tuple:
+		# None when the call can't be cached. That's only an error when the call itself asked for
+		# the cache, a cache on the pyshell or an alias is just skipped for it.
+		# shape is the options that were taken out of kwargs but change what the result looks like
+		if not capture_output:
+			if not strict:
+				return None
+			raise ValueError('cache needs capture_output, there is nothing to keep otherwise.')
+		if not (input is None or isinstance(input, (str, bytes))):
+			if not strict:
+				return None
+			raise ValueError('only str or bytes input can be cached.')
+		if not found and not kwargs.get('shell'):
+			raise CommandNotFound(f'command {commands[0]} does not exist')
+		from .cache import _cache_key
+		return _cache_key(commands, input, kwargs, depends, shape)
+
+	@property
+	def result_cache(self):
+		"""The ResultCache cache=True and cache=seconds keep results in."""
+		if self._results is None:
+			with self._results_lock:
+				if self._results is None:
+					from .cache import ResultCache
+					self._results = ResultCache()
+		return self._results
+
+	def close(self):
+		"""Stop any persistent shells and close our logfiles. They start again when they're needed."""
+		with self._coprocess_lock:
+			coprocesses = list(self._coprocesses.values())
+			self._coprocesses.clear()
+		for coprocess in coprocesses:
+			coprocess.close()
+		with self._log_lock:
+			logs = list(self._logs.values())
+			self._logs.clear()
+		for log in logs:
+			log.close()
+
+	def _log(self, logfile) -> CommandLog:
+		# A path gets one CommandLog for the life of this pyshell, so it's only opened once
+		if isinstance(logfile, CommandLog):
+			return logfile
+		path = os.fspath(logfile)
+		with self._log_lock:
+			log = self._logs.get(path)
+			if log is None:
+				log = self._logs[path] = CommandLog(path)
+			return log
+
+	def _prepare(self, chain: tuple, args: tuple,
 				input=None, capture_output=False, check=False,
 				logfile=None, timeout=None, expect=False, popen=False, **kwargs):
+		# Works out everything about a call without running anything.
+		# Returns the command, our own options and what is left for Popen
+		# Only a plain call can use the persistent shell, everything else starts a fresh process
+		kwargs.pop('persistent', None)
 		# If someone sent us a list we should handle it
 		if len(args) == 1:
 			if isinstance(*args, list):
 				args = tuple(*args)
-		# Once called we send our list and Arguments to the call parser
-		# Which will return our command (name), and then our args
-		name, args = self.__parse_caller_commands(self._list, *args)
-		# DEV echo
-		#commands = ['echo', name]
-		commands = [name]
-		# Check kwargs to see if an alias was set
-		# If it was set our commands to that
-		
-		if self._alias is not None:
-			if self._alias.get(name):
-				commands = deepcopy(self._alias.get(name))
+		# Work out the command (name), whatever it expands to with aliases and
+		# the program it runs. Then we can append our arguments
+		shell = kwargs.get('shell')
+		if shell is None:
+			shell = self.kwargs.get('shell')
+		(name, prefix, executable, found, alias), args = self._resolve(
+			chain, args, shell is not None and shell is not False and shell != self.DEFAULT)
+		commands = list(prefix)
+		commands.extend(args)
 
-		# Now that possible aliases are set, we can append our arguments
-		for arg in args:
-			commands.append(arg)
-
-		self._list.clear()
 		# This block says to error if we're not using the shell and we can't find the command.
 		# But if we're using the shell then send it anyway. I'm not sure why I did this.
 		# Maybe we should just send it no matter what?
@@ -377,30 +1950,38 @@ class pyshell(object):
 		if input is not None:
 			if kwargs.get('stdin') is not None:
 				raise ValueError('stdin and input arguments may not both be used.')
-			kwargs['stdin'] = self.PIPE
+			source = _stdin_source(input)
+			if source is not None:
+				# A path or a real file goes to the child as it is, no pipe in between
+				kwargs['stdin'] = source
+				input = None
+			else:
+				kwargs['stdin'] = self.PIPE
+
+		if logfile is not None:
+			logfile = self._log(logfile)
+			if logfile.tee:
+				if kwargs.get('stdout') is not None or kwargs.get('stderr') is not None:
+					raise ValueError('stdout and stderr arguments may not be used '
+									'with a tee logfile.')
+				# It has to capture the output to log it, so the caller gets it too
+				capture_output = True
+			elif capture_output:
+				raise ValueError('logfile will not work with capture_output')
 
 		if capture_output:
-			if logfile is not None:
-				raise ValueError('logfile will not work with capture_output')
 			if kwargs.get('stdout') is not None or kwargs.get('stderr') is not None:
 				raise ValueError('stdout and stderr arguments may not be used '
 								'with capture_output.')
 			kwargs['stdout'] = self.PIPE
 			kwargs['stderr'] = self.PIPE
 
-		if input:
+		if isinstance(input, (str, bytes)) and input:
 			if isinstance(input, str):
 				kwargs['text'] = True
 			if isinstance(input, bytes):
 				kwargs['text'] = False
 
-		if not capture_output:
-			if logfile:
-				# Open our file. This makes it easier on the user. Just give us a filename
-				logfile = open(logfile, 'a')
-				kwargs['stdout'] = logfile
-				kwargs['stderr'] = self.STDOUT
-
 		# before we pass kwargs we need to remove anything remaining which was defaulted.	
 		for Key, Value in kwargs.copy().items():
 			if kwargs.get(Key) == self.DEFAULT:
@@ -435,30 +2016,23 @@ class pyshell(object):
 				rcommand.append(repr(arg).strip('\''))
 			commands = [' '.join((arg) for arg in rcommand)]
 
+		# Without a shell the command has to exist. With one we send it anyway
 		if kwargs.get('shell') is None and self.kwargs.get('shell') is None:
-			if shutil.which(name) is not None or self._alias.get(name) is not None:
-				if expect:
-					return spawn(" ".join(com for com in commands))
-				elif popen:
-					return pyshellPopen(commands, **kwargs)
-				else:
-					self.run(	commands,
-								input=input, capture_output=capture_output, check=check,
-								logfile=logfile, timeout=timeout, **kwargs)
-
-					return self.process
-			else:
-				raise CommandNotFound(f'command {name} does not exist')
+			# Hand Popen the full path so it doesn't have to search $PATH again.
+			# Unless we were given a different $PATH to search
+			if executable is not None and kwargs.get('executable') is None:
+				env = kwargs.get('env')
+				if env is None or env.get('PATH', os.defpath) == os.environ.get('PATH', os.defpath):
+					kwargs['executable'] = executable
 		else:
-			self.run(	commands,
-						input=input, capture_output=capture_output, check=check,
-						logfile=logfile, timeout=timeout, **kwargs)
+			found = True
+
+		return (name, commands, found, input, capture_output, check,
+				logfile, timeout, expect, popen, kwargs)
 
-			return self.process
-		
 	def run(self, *popenargs,
 			input=None, capture_output=False, check=False,
-			logfile=None, timeout=None, **kwargs):
+			logfile=None, timeout=None, record=None, compact=False, max_output=None, keep='tail', **kwargs):
 		"""Run command with arguments and return a CompletedProcess instance.
 
 		The returned instance will have attributes args, returncode, stdout and
@@ -476,7 +2050,9 @@ class pyshell(object):
 		There is an optional argument "input", allowing you to
 		pass bytes or a string to the subprocess's stdin.  If you use this argument
 		you may not also use the Popen constructor's "stdin" argument, as
-		it will be used internally.
+		it will be used internally. Paths and open files are given to the child
+		as its stdin. Buffers like mmap, file-likes and iterables of chunks are
+		written a chunk at a time, so they are never read into memory whole.
 
 		pyshell run has a couple of customizations over the original run.
 
@@ -493,14 +2069,47 @@ class pyshell(object):
 		What you have in quotes will be passed exact and the shell will expand.
 
 		The other arguments are the same as for the Popen constructor.
+		record is a CommandRecord from our metrics to fill in.
+		compact returns a CommandResult, the output is read as bytes and only decoded when it's used.
+		max_output keeps only that many bytes of stdout and of stderr, keep says which ones.
 		"""
+		feeder = None
+		buffers = None
+		# Popen stays in bytes mode when we read the pipes or the result decodes
+		ours = compact or max_output is not None
+		if ours:
+			text, encoding, errors = _text_options(kwargs, input)
+			if isinstance(input, str):
+				input = input.encode(encoding, errors)
+		if input is not None and not isinstance(input, (str, bytes)):
+			source = _stdin_source(input)
+			if source is not None:
+				kwargs['stdin'] = source
+				input = None
+			else:
+				kwargs.setdefault('stdin', self.PIPE)
+				if not ours:
+					text, encoding, errors = _text_options(kwargs)
+				feeder = _InputFeeder(input, encoding, errors)
+		process = stdout = stderr = error = None
+		if logfile:
+			args = popenargs[0] if popenargs else kwargs.get('args')
+			started = logfile.begin(args)
 		try:
 			# Using our patched Popen for some special goodies.
 			with pyshellPopen(*popenargs, **kwargs) as process:
 				try:
-					stdout, stderr = process.communicate(input, timeout=timeout)
+					if max_output is not None:
+						buffers = _output_buffers(max_output, keep, 2)
+						if feeder is None:
+							feeder = _feeder(input)
+						stdout, stderr = _feed(process, feeder, timeout, False, encoding, errors, buffers)
+					elif feeder is not None:
+						stdout, stderr = _feed(process, feeder, timeout, text and not ours, encoding, errors)
+					else:
+						stdout, stderr = process.communicate(input, timeout=timeout)
 				except TimeoutExpired as exc:
-					process.kill()
+					process.stop()
 					if _mswindows:
 						# Windows accumulates the output in a single blocking
 						# read() call run on child threads, with the timeout
@@ -514,99 +2123,562 @@ class pyshell(object):
 						process.wait()
 					raise
 				except:  # Including KeyboardInterrupt, communicate handled that.
-					process.kill()
+					process.stop()
 					# We don't call process.wait() as .__exit__ does that for us.
 					raise
 				retcode = process.poll()
+				if ours:
+					result = _outcome(process.args, retcode, stdout, stderr, check, text, encoding, errors, compact)
+					result.usage = process.rusage
+					if buffers is not None:
+						_bounded(result, buffers[0] if process.stdout else None, buffers[1] if process.stderr else None)
+					return result
 				if check and retcode:
 					raise CalledProcessError(retcode, process.args,
 											output=stdout, stderr=stderr)
-			self.process = CompletedProcess(process.args, retcode, stdout, stderr)
-			return self.process
-		# Wrap everything in a try finally so we make sure we close our file if it exists.	
+			return _completed(process, retcode, stdout, stderr)
+		except BaseException as exc:
+			error = exc
+			raise
+		# Wrap everything in a try finally so the record gets finished even if it blew up.
 		finally:
 			if logfile:
-				logfile.close()
+				if process is None:
+					logfile.end(args, started)
+				else:
+					logfile.end(args, started, process.pid, process.returncode, stdout, stderr)
+			if record is not None:
+				bytes_in = feeder.written if feeder is not None else _input_size(input)
+				self._metrics.finish(record, (process,) if process else (), stdout=stdout, stderr=stderr,
+									bytes_in=bytes_in, bytes_out=_total_output(buffers or ()), error=error)
+
+	def iter_lines(self, *args, **kwargs):
+		"""Run a command and yield its output one line at a time as it arrives.
 
-	def setAlias(self, command: str, alias: list):
+		Takes the same arguments as calling pyshell. Nothing is held in memory
+		besides the line being built, and the command only runs as fast as you read.
+		Lines keep their newline just like iterating over a file.
+
+		Lines are bytes unless the output is text. Pass text=True or encoding= for str,
+		or send str as input. A line longer than max_line (default 1MiB) is handed over in pieces.
+
+		timeout covers the whole run and check raises CalledProcessError once the output ends.
+		With a logfile stdout is written to it as you read it and stderr goes straight to it.
+		With capture_output stderr is kept for the exception. Otherwise it goes to your terminal.
+		Only the last 1MiB of it is kept, max_output and keep change how much and which part.
+
+		Example::
+
+		for line in sh.iter_lines('journalctl', '-b'):
+			print(line)
+
+		for line in sh.find.iter_lines('/', text=True):
+			print(line, end='')
+		"""
+		return self._stream_chain((), args, True, kwargs)
+
+	def iter_chunks(self, *args, **kwargs):
+		"""Run a command and yield its raw output as bytes as it arrives.
+
+		Works the same as iter_lines, but hands over whatever the pipe gave us,
+		up to chunk_size bytes (default 64KiB) at a time.
+
+		Example::
+
+		for chunk in sh.tar.iter_chunks('-c', '/etc'):
+			archive.write(chunk)
+		"""
+		return self._stream_chain((), args, False, kwargs)
+
+	def _stream_chain(self, chain: tuple, args: tuple, lines: bool, kwargs: dict):
+		chunk_size = kwargs.pop('chunk_size', 65536)
+		max_line = kwargs.pop('max_line', 1048576)
+		# Only for stderr, stdout is handed over and never kept
+		max_output, keep = self._output_limit(kwargs)
+		metrics = self._metrics
+		record = metrics.start() if metrics is not None else None
+		(name, commands, found, input, capture_output, check,
+		logfile, timeout, expect, popen, kwargs) = self._prepare(chain, args, **kwargs)
+
+		if not found:
+			raise CommandNotFound(f'command {name} does not exist')
+		if not capture_output and kwargs.get('stdout') is not None:
+			raise ValueError('stdout may not be used when streaming.')
+		kwargs['stdout'] = self.PIPE
+		if record is not None:
+			metrics.resolved(record, name, commands)
+
+		return self._stream(commands, input, check, logfile, timeout,
+							lines, chunk_size, max_line, kwargs, record, None, max_output, keep)
+
+	def _stream(self, commands, input, check, logfile, timeout,
+				lines, chunk_size, max_line, kwargs, record=None, outcome=None, max_output=None, keep='tail'):
+		# We read the pipes ourselves so Popen only ever deals in bytes.
+		# outcome, if given, gets the process and its stderr once it's done
+		text, encoding, errors = _text_options(kwargs, input)
+		feeder = _feeder(input, encoding, errors)
+
+		process = error = stderr = None
+		received = 0
+		if logfile:
+			if not logfile.tee:
+				kwargs['stderr'] = logfile.fileno()
+			started = logfile.begin(commands, streaming=True)
+
+		splitter = _LineSplitter(text and encoding, errors, max_line) if lines else None
+		deadline = None if timeout is None else time.monotonic() + timeout
+
+		try:
+			process = pyshellPopen(commands, **kwargs)
+			try:
+				with _PopenSelector() as selector:
+					if process.stdin:
+						if feeder is not None:
+							os.set_blocking(process.stdin.fileno(), False)
+							selector.register(process.stdin, selectors.EVENT_WRITE)
+						else:
+							process.stdin.close()
+					selector.register(process.stdout, selectors.EVENT_READ)
+					if process.stderr:
+						stderr = _stderr_buffer(max_output, keep)
+						selector.register(process.stderr, selectors.EVENT_READ)
+
+					while selector.get_map():
+						if deadline is None:
+							ready = selector.select()
+						else:
+							remaining = deadline - time.monotonic()
+							if remaining <= 0:
+								raise TimeoutExpired(process.args, timeout)
+							ready = selector.select(remaining)
+
+						for key, events in ready:
+							if key.fileobj is process.stdin:
+								if feeder.write(key.fd):
+									selector.unregister(key.fileobj)
+									key.fileobj.close()
+								continue
+
+							if key.fileobj is process.stderr:
+								if not stderr.read(key.fd):
+									selector.unregister(key.fileobj)
+								continue
+							data = os.read(key.fd, chunk_size)
+							if not data:
+								selector.unregister(key.fileobj)
+								continue
+							received += len(data)
+							if logfile:
+								logfile.write(data)
+							if not lines:
+								yield data
+								continue
+
+							yield from splitter.feed(data)
+
+					# Whatever is left didn't end with a newline
+					if lines:
+						yield from splitter.flush()
+
+					try:
+						process.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+					except TimeoutExpired:
+						raise TimeoutExpired(process.args, timeout)
+
+				retcode = process.returncode
+				if outcome is not None:
+					outcome.append((process, stderr.getvalue() if stderr is not None else None))
+				if check and retcode:
+					output = stderr.getvalue() if stderr is not None else None
+					if output is not None and text:
+						output = output.decode(encoding, errors)
+					raise CalledProcessError(retcode, process.args, stderr=output)
+			finally:
+				# Timed out, raised or the caller stopped reading. Either way we're done with it
+				if process.returncode is None:
+					process.stop()
+				process.__exit__(None, None, None)
+		except BaseException as exc:
+			error = exc
+			raise
+		finally:
+			if feeder is not None:
+				feeder.close()
+			if logfile:
+				if process is None:
+					logfile.end(commands, started, streaming=True)
+				else:
+					logfile.end(commands, started, process.pid, process.returncode,
+								stderr=stderr.getvalue() if stderr is not None else b'', streaming=True)
+			if record is not None:
+				self._metrics.finish(record, (process,) if process else (),
+									bytes_in=feeder.written if feeder is not None else None,
+									bytes_out=received + (stderr.total if stderr is not None else 0), error=error)
+
+	def _run_pipeline(self, stages: tuple, **kwargs):
+		metrics = self._metrics
+		record = metrics.start() if metrics is not None else None
+		compact = self._compact_for(kwargs)
+		max_output, keep = self._output_limit(kwargs)
+		(prepared, input, capture_output, check, logfile,
+		timeout, text, encoding, errors) = self._pipeline_options(stages, **kwargs)
+		if record is not None:
+			metrics.resolved(record, _pipeline_name(prepared), [commands for commands, popen_kwargs in prepared])
+
+		processes = []
+		errread = None
+		outputs = error = None
+		feeder = _feeder(input, encoding, errors)
+		if logfile:
+			description = ' | '.join(_describe(commands) for commands, popen_kwargs in prepared)
+			started = logfile.begin(description)
+		try:
+			errread = self._spawn_pipeline(prepared, input, capture_output, logfile, processes)
+			args = [process.args for process in processes]
+			deadline = None if timeout is None else time.monotonic() + timeout
+			readers = buffers = []
+			if capture_output:
+				readers = [processes[-1].stdout.fileno(), errread]
+				buffers = _output_buffers(max_output, keep, 2)
+			try:
+				outputs = _communicate(processes[0].stdin, feeder, readers, deadline, buffers)
+				for process in processes:
+					process.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+			except TimeoutExpired as exc:
+				for process in processes:
+					process.stop()
+				for process in processes:
+					process.wait()
+				raise TimeoutExpired(args, timeout, output=getattr(exc, 'output', None))
+
+			return self._pipeline_result(processes, outputs, check, text, encoding, errors, compact, buffers)
+		except BaseException as exc:
+			error = exc
+			raise
+		finally:
+			for process in processes:
+				if process.returncode is None:
+					process.stop()
+			for process in processes:
+				process.__exit__(None, None, None)
+			if errread is not None:
+				os.close(errread)
+			if feeder is not None:
+				feeder.close()
+			if logfile:
+				logfile.end(description, started,
+							[process.pid for process in processes],
+							[process.returncode for process in processes],
+							*(outputs or ()))
+			if record is not None:
+				stdout, stderr = outputs or (None, None)
+				metrics.finish(record, processes, stdout=stdout, stderr=stderr,
+							bytes_in=feeder.written if feeder is not None else None,
+							bytes_out=_total_output(buffers), error=error)
+
+	def _pipeline_options(self, stages: tuple,
+					input=None, capture_output=False, check=False,
+					logfile=None, timeout=None, **kwargs):
+		# Same fall back to our defaults as a normal call
+		if input is None:
+			input = self._input
+		if input is self.DEFAULT:
+			input = None
+		if capture_output is False:
+			capture_output = self._capture_output
+		if capture_output is self.DEFAULT:
+			capture_output = False
+		if check is False:
+			check = self._check
+		if check is self.DEFAULT:
+			check = False
+		if logfile is None:
+			logfile = self._logfile
+		if logfile is self.DEFAULT:
+			logfile = None
+		if timeout is None:
+			timeout = self._timeout
+		if timeout is self.DEFAULT:
+			timeout = None
+		if logfile is not None:
+			logfile = self._log(logfile)
+			if logfile.tee:
+				capture_output = True
+			elif capture_output:
+				raise ValueError('logfile will not work with capture_output')
+
+		text, encoding, errors = _text_options(kwargs, input)
+		if kwargs:
+			raise TypeError(f"unexpected pipeline arguments {', '.join(kwargs)}")
+		source = _stdin_source(input) if input is not None else None
+		if source is not None:
+			input = None
+
+		# Work out every command before anything is started
+		prepared = []
+		for stage in stages:
+			(name, commands, found, _input, _capture_output, _check,
+			_logfile, _timeout, expect, popen, popen_kwargs) = stage._shell._prepare(
+				stage._chain, stage._args,
+				**dict(stage._kwargs, input=self.DEFAULT, capture_output=self.DEFAULT,
+					logfile=self.DEFAULT, expect=self.DEFAULT, popen=self.DEFAULT))
+			if not found:
+				raise CommandNotFound(f'command {name} does not exist')
+			_text_options(popen_kwargs)
+			prepared.append((commands, popen_kwargs))
+		if source is not None:
+			# The first command reads the file itself
+			prepared[0][1]['stdin'] = source
+
+		return prepared, input, capture_output, check, logfile, timeout, text, encoding, errors
+
+	def _spawn_pipeline(self, prepared: list, input, capture_output, logfile, processes: list):
+		# Starts every command, adding them to processes as we go so the caller
+		# can clean up if one fails. Returns the read end of the stderr pipe.
+		errread = errwrite = None
+		if capture_output:
+			# Every command shares one pipe for stderr
+			errread, errwrite = os.pipe()
+		try:
+			last = len(prepared) - 1
+			for number, (commands, popen_kwargs) in enumerate(prepared):
+				if number == 0:
+					if input is not None:
+						popen_kwargs['stdin'] = self.PIPE
+				else:
+					popen_kwargs['stdin'] = processes[-1].stdout
+				if number < last or capture_output:
+					popen_kwargs['stdout'] = self.PIPE
+				elif logfile:
+					popen_kwargs['stdout'] = logfile.fileno()
+				if capture_output:
+					popen_kwargs['stderr'] = errwrite
+				elif logfile:
+					popen_kwargs['stderr'] = logfile.fileno()
+				processes.append(pyshellPopen(commands, **popen_kwargs))
+				if number:
+					# The child has it now. Holding it open would keep the pipe alive
+					processes[-2].stdout.close()
+		except:
+			if errread is not None:
+				os.close(errread)
+			raise
+		finally:
+			if errwrite is not None:
+				os.close(errwrite)
+		return errread
+
+	@staticmethod
+	def _pipeline_result(processes: list, outputs: list, check, text, encoding, errors, compact=False, buffers=()):
+		args = [process.args for process in processes]
+		stdout, stderr = outputs or (None, None)
+		returncodes = [process.returncode for process in processes]
+		retcode = 0
+		for code in returncodes:
+			if code:
+				retcode = code
+		result = _outcome(args, retcode, stdout, stderr, check, text, encoding, errors, compact)
+		result.returncodes = returncodes
+		result.usages = [process.rusage for process in processes]
+		result.usage = _total_usage(result.usages)
+		if any(buffers):
+			_bounded(result, *buffers)
+		return result
+
+	def map(self, command, iterable, max_parallel: int=None, ordered: bool=True, **kwargs):
+		"""Run a command once for every item, keeping up to max_parallel running at once.
+
+		Arguments:
+			command: the command to run. A name like 'sha256sum', a list like ['ssh-keygen', '-l', '-f']
+				or a command like sh.ssh_keygen._l._f
+			iterable: each item is added to the end of the command. A tuple or list adds several arguments
+			max_parallel: how many commands run at the same time. Defaults to the number of CPUs
+			ordered: yield results in the order the items came in. If False yield them as they finish
+
+		Every other argument is the same as calling pyshell and applies to each command,
+		timeout and check included. This yields a CompletedProcess per item. When one fails
+		you get the exception (CalledProcessError, TimeoutExpired, CommandNotFound...) in its
+		place instead, so one bad item doesn't stop the rest.
+
+		All the commands are handled from this thread with a single selector.
+
+		Example::
+
+		for result in sh.map('sha256sum', files, capture_output=True, check=True):
+			if isinstance(result, Exception):
+				print('failed', result)
+			else:
+				print(result.stdout)
+		"""
+		if isinstance(command, pyshellCommand):
+			chain, base_args, base_kwargs = command._chain, command._args, command._kwargs
+		elif isinstance(command, (list, tuple)):
+			chain, base_args, base_kwargs = (), tuple(command), {}
+		else:
+			chain, base_args, base_kwargs = (), (command,), {}
+		kwargs = dict(base_kwargs, **kwargs)
+		if max_parallel is None:
+			max_parallel = os.cpu_count() or 1
+		if max_parallel < 1:
+			raise ValueError('max_parallel must be at least 1')
+		return self._map(chain, base_args, kwargs, iterable, max_parallel, ordered)
+
+	def _map(self, chain: tuple, base_args: tuple, kwargs: dict, iterable, max_parallel: int, ordered: bool):
+		items = enumerate(iterable)
+		exhausted = False
+		running = []
+		done = {}
+		next_index = 0
+
+		try:
+			with _PopenSelector() as selector:
+				while True:
+					# Keep the pool full
+					while not exhausted and len(running) < max_parallel:
+						try:
+							index, item = next(items)
+						except StopIteration:
+							exhausted = True
+							break
+						if isinstance(item, (list, tuple)):
+							args = base_args + tuple(item)
+						else:
+							args = base_args + (item,)
+						job = _BatchJob(index)
+						try:
+							job.start(self, chain, args, dict(kwargs), selector)
+						except (OSError, ValueError, SubprocessError) as exc:
+							job.result = exc
+						if job.result is None:
+							running.append(job)
+						else:
+							done[index] = job.result
+
+					if not running and exhausted and not done:
+						return
+					if running:
+						running, finished = _wait_jobs(running, selector)
+						for job in finished:
+							done[job.index] = job.result
+
+					# Hand over whatever we can
+					if ordered:
+						while next_index in done:
+							yield done.pop(next_index)
+							next_index += 1
+					else:
+						for index in list(done):
+							yield done.pop(index)
+		finally:
+			# The caller stopped early or something broke, don't leave anything behind
+			for job in running:
+				job.kill()
+
+	def setAlias(self, command: str, alias: list, cache=None):
 		"""Sets a command alias
 		
 		Arguments:
 			command: The command you want to alias. Such as 'echo' or 'mkfs.ext4'
 			alias: a list containing your alias ['echo', '-e']
+			cache: cache this command's results, the same as cache= on a call. It wins over the pyshell's cache
 		"""
-		# If our alias is not a dict we assume it's none and then create a bare one.
-		if not isinstance(self._alias, dict):
-			self._alias = {}
 		# If the alias is not in a list format then we will raise an exception
 		if not isinstance(alias, list):
 			raise TypeError(f"expected list but got {type(alias).__name__} instead")
-		self._alias.update({command:alias})
+		# Build a new dict and swap it in. Commands running in other threads
+		# keep using whichever dict they already grabbed.
+		aliases = dict(self._alias)
+		aliases[command] = alias
+		self._alias = aliases
+		if cache is not None:
+			self._alias_cache = dict(self._alias_cache, **{command: cache})
+		# Everything we resolved was for the old aliases
+		self._resolved = {}
+
+	# The program tables live in the process wide path index. They are only
+	# built the first time somebody looks at them, so creating a pyshell is free.
+	@property
+	def programs_tuple(self):
+		return _path_index.tables()[0]
+
+	@property
+	def dot_file_tuple(self):
+		return _path_index.tables()[1]
+
+	@property
+	def dash_file_tuple(self):
+		return _path_index.tables()[2]
+
+	@property
+	def underscore_file_tuple(self):
+		return _path_index.tables()[3]
+
+	@property
+	def hybrid_file_tuple(self):
+		return _path_index.tables()[4]
 
 	@staticmethod
 	def Parse_Path_Programs():
-		# Might end up removing some of these in the future as they aren't used
-		# But for now they aren't causing any harm
-		#
-		# Get Users Path
-		env = os.environ.get('PATH').split(':')
-		# Make a set to store Items since it's unique
-		files_set = set()
-		# Iterate through the environment globing up the whole town
-		for path in env:
-			for file in Path(path).glob('*'):
-				if file.is_file():
-					files_set.add(file.name)
-		# Convert the set to a list		
-		files = list(files_set)
-		files.sort()
-		# Make a new list because we need to run each program
-		# Through which to make sure they're executable
-		programs_list = []
-		for path in files:
-			prog = shutil.which(path)
-			if prog is not None:
-				prog = Path(prog)
-				programs_list.append(prog)
-		programs_list = tuple(programs_list)
-		
-		programs_tuple = []
-		for path in programs_list:
-			programs_tuple.append(path.name)
-		programs_tuple = tuple(programs_tuple)
-
-		dot_file_list = []
-		# Make a list of dot.files
-		for path in programs_list:
-			if '.' in path.name:
-				dot_file_list.append(path.name)
-		dot_file_tuple = tuple(dot_file_list)
-
-		underscore_file_list = []
-		# Make a list of underscore_files
-		for path in programs_list:
-			if '_' in path.name:
-				if '-' not in path.name:
-					underscore_file_list.append(path.name)
-		underscore_file_tuple = tuple(underscore_file_list)
-
-		dash_file_list = []
-		# Make a list of dash-files
-		for path in programs_list:
-			if '-' in path.name:
-				if '_' not in path.name:
-					dash_file_list.append(path.name)
-		dash_file_tuple = tuple(dash_file_list)
-
-		hybrid_file_list = []
-		# Make a hybrid_file-list
-		for path in programs_list:
-			if '-' in path.name:
-				if '_' in path.name:
-					hybrid_file_list.append(path.name)
-		hybrid_file_tuple = tuple(hybrid_file_list)
+		"""Return the program tables for the current $PATH.
 
-		return programs_tuple, dot_file_tuple, dash_file_tuple, underscore_file_tuple, hybrid_file_tuple
+		programs_tuple, dot_file_tuple, dash_file_tuple, underscore_file_tuple, hybrid_file_tuple
+		"""
+		return _path_index.tables()
+
+	def _resolve(self, chain: tuple, args: tuple, shell: bool=False):
+		# Returns (name, command prefix, full path of the program, found, alias) and the remaining args.
+		# The prefix is the alias or name plus whatever was left of the chain.
+		# This is cached per chain until the aliases or the path index change.
+		# With a shell nothing is looked up, it finds the program itself.
+		if chain:
+			key = chain
+		elif args:
+			# Called directly, pyshell('echo', 'hello'), echo becomes our name
+			key = (None, args[0])
+			args = args[1:]
+		else:
+			raise PyshellError(f"No arguments were passed")
+
+		generation = _path_index.check()
+		aliases = self._alias
+		cached = self._resolved.get(key)
+		if cached is not None and cached[0] == generation and cached[1] is aliases:
+			return cached[2], args
+
+		if chain:
+			name, rest = self.__parse_caller_commands(list(chain))
+		else:
+			name, rest = key[1], ()
+		alias = aliases.get(name)
+		prefix = (tuple(alias) if alias else (name,)) + rest
+
+		if shell:
+			# A command line like 'ls | wc -l' is never on $PATH. Looking for it would
+			# miss every time, and a miss makes the index check every directory again
+			return (name, prefix, None, True, alias), args
+
+		program = prefix[0]
+		if isinstance(name, str) and os.sep not in name:
+			found = alias is not None or _path_index.which(name) is not None
+		else:
+			# A path, or something we can't look up. Check it every time
+			import shutil
+			return (name, prefix, None, alias is not None or shutil.which(name) is not None, alias), args
+		executable = None
+		if isinstance(program, str) and os.sep not in program:
+			executable = _path_index.which(program)
+			if executable is not None and not os.path.isabs(executable):
+				# Relative $PATH entries depend on cwd, leave those to Popen
+				executable = None
+
+		resolved = (name, prefix, executable, found, alias)
+		# Don't remember misses, the program might be installed any moment
+		if found:
+			cache = self._resolved
+			if len(cache) >= 1024:
+				cache = self._resolved = {}
+			cache[key] = (generation, aliases, resolved)
+		return resolved, args
 
 	def __parse_caller_commands(self, command_list: list, *args):
 		# If our list is only one then we can just drop and use that as a command
@@ -629,14 +2701,15 @@ class pyshell(object):
 			name = name.lstrip('.')	
 			num = len(reverse_list)
 			# Iterate through the reverse list stripping our command down 1 by 1
-			# And then checking it against the programs tuple
+			# And then checking it against the programs on our path
+			programs = _path_index.programs()
 			for command in reverse_list:
 				num = num -1
 				# All this replacing was here before I did a full convert list. It doesn't hurt anything so I'll keep it in
 				# Possible that it comes in handy later if we don't want full conversion, and only want conversion on matched programs
 				# Maybe make a switch to disable argument conversion? - is more common in linux commands anyway
 				name = name.rstrip(command.replace('_','-')).rstrip('.').replace('_','-')
-				if name in self.programs_tuple:
+				if name in programs:
 					break
 
 			# We kept track of our place in the list so that we can use the rest of our list as arguments
@@ -661,6 +2734,173 @@ class pyshell(object):
 				else:
 					raise PyshellError(f"No arguments were passed")
 
+class pyshellCommand(object):
+	"""A command built from attributes, such as sh.mkfs.ext4
+
+	These are immutable. Every attribute returns a new one with the name added to the chain,
+	so they can be kept around and reused. The chain is only resolved when it is called.
+	bind() returns a copy with some arguments filled in, and commands can be joined
+	into a pipeline with |
+
+	Example::
+
+	mkfs = sh.mkfs.ext4
+	mkfs('/dev/sdb1')
+
+	count = sh.cat.bind('/var/log/syslog') | sh.grep.bind('error') | sh.wc._l
+	count(capture_output=True)
+	"""
+	__slots__ = ('_shell', '_chain', '_args', '_kwargs')
+
+	def __init__(self, shell, chain: tuple, args: tuple=(), kwargs: dict=None):
+		object.__setattr__(self, '_shell', shell)
+		object.__setattr__(self, '_chain', chain)
+		object.__setattr__(self, '_args', args)
+		object.__setattr__(self, '_kwargs', kwargs or {})
+
+	def __getattr__(self, attr: str):
+		if attr.startswith('__') and attr.endswith('__'):
+			raise AttributeError(f"{type(self).__name__!r} object has no attribute {attr!r}")
+		return pyshellCommand(self._shell, self._chain + (attr,), self._args, self._kwargs)
+
+	def __setattr__(self, attr, value):
+		raise AttributeError(f"{type(self).__name__!r} object is immutable")
+
+	def __call__(self, *args, **kwargs):
+		return self._shell._run_chain(self._chain, *self._args, *args, **dict(self._kwargs, **kwargs))
+
+	def bind(self, *args, **kwargs):
+		"""Return a copy of this command with arguments filled in.
+
+		Arguments given when it is called are added after these.
+		"""
+		if len(args) == 1 and isinstance(args[0], list):
+			args = tuple(args[0])
+		return pyshellCommand(self._shell, self._chain,
+							self._args + args, dict(self._kwargs, **kwargs))
+
+	def map(self, iterable, **kwargs):
+		"""Run the command once per item. See pyshell.map"""
+		return self._shell.map(self, iterable, **kwargs)
+
+	def iter_lines(self, *args, **kwargs):
+		"""Run the command and yield its output line by line. See pyshell.iter_lines"""
+		return self._shell._stream_chain(self._chain, self._args + args, True, dict(self._kwargs, **kwargs))
+
+	def iter_chunks(self, *args, **kwargs):
+		"""Run the command and yield its output as raw chunks. See pyshell.iter_chunks"""
+		return self._shell._stream_chain(self._chain, self._args + args, False, dict(self._kwargs, **kwargs))
+
+	def prepare(self, *args, **kwargs) -> 'pyshellTemplate':
+		"""Work out the command once to run it many times. See pyshell.prepare"""
+		return self._shell._template(self._chain, self._args + args, dict(self._kwargs, **kwargs))
+
+	def __or__(self, other):
+		if isinstance(other, pyshellCommand):
+			return pyshellPipeline((self, other))
+		if isinstance(other, pyshellPipeline):
+			return pyshellPipeline((self,) + other._stages)
+		return NotImplemented
+
+	def _describe(self):
+		return ' '.join(('.'.join(self._chain),) + tuple(repr(arg) for arg in self._args))
+
+	def __repr__(self):
+		return f"<pyshellCommand {self._describe()}>"
+
+class pyshellPipeline(object):
+	"""Commands joined with |, such as sh.cat.bind('f') | sh.grep.bind('x') | sh.wc._l
+
+	Each command's stdout is connected straight to the next command's stdin with a pipe,
+	no shell is started and nothing is copied through Python between them.
+	Calling the pipeline runs it. input, capture_output, logfile, timeout and check
+	apply to the pipeline as a whole, anything else given when the commands were bound
+	(cwd, env and so on) applies to that command only.
+
+	The result is a CompletedProcess. Like set -o pipefail its returncode is the last
+	non zero exit status, and returncodes has the exit status of every command.
+	"""
+	__slots__ = ('_stages',)
+
+	def __init__(self, stages: tuple):
+		object.__setattr__(self, '_stages', stages)
+
+	def __setattr__(self, attr, value):
+		raise AttributeError(f"{type(self).__name__!r} object is immutable")
+
+	def __or__(self, other):
+		if isinstance(other, pyshellCommand):
+			return pyshellPipeline(self._stages + (other,))
+		if isinstance(other, pyshellPipeline):
+			return pyshellPipeline(self._stages + other._stages)
+		return NotImplemented
+
+	def __call__(self, **kwargs):
+		return self._stages[0]._shell._run_pipeline(self._stages, **kwargs)
+
+	def __repr__(self):
+		return f"<pyshellPipeline {' | '.join(stage._describe() for stage in self._stages)}>"
+
+class _Placeholder(object):
+	__slots__ = ()
+
+	def __repr__(self):
+		return 'ARG'
+
+# Marks an argument of a prepared command that's given when it runs
+ARG = _Placeholder()
+
+class pyshellTemplate(object):
+	"""A command worked out by pyshell.prepare, ready to be run many times.
+
+	Calling it only puts the arguments in place of the sh.ARG markers, adds any extra
+	ones at the end and starts the process. The argv, the options and the encoded
+	environment are kept from when it was prepared. Like pyshellCommand it's immutable,
+	so it can be shared between threads.
+
+	Example::
+
+	checksum = sh.prepare('sha256sum', sh.ARG, capture_output=True, text=True)
+	sums = [checksum(path).stdout for path in paths]
+	"""
+	__slots__ = ('_shell', '_name', '_argv', '_holes', '_options', '_kwargs', '_chain', '_args', '_given')
+
+	def __init__(self, shell, name, argv: tuple, options: tuple, kwargs: dict, chain: tuple, args: tuple, given: dict):
+		object.__setattr__(self, '_shell', shell)
+		object.__setattr__(self, '_name', name)
+		object.__setattr__(self, '_argv', argv)
+		object.__setattr__(self, '_holes', tuple(index for index, arg in enumerate(argv) if arg is ARG))
+		object.__setattr__(self, '_options', options)
+		object.__setattr__(self, '_kwargs', kwargs)
+		# What it was prepared from, for calls with keyword arguments
+		object.__setattr__(self, '_chain', chain)
+		object.__setattr__(self, '_args', args)
+		object.__setattr__(self, '_given', given)
+
+	def __setattr__(self, attr, value):
+		raise AttributeError(f"{type(self).__name__!r} object is immutable")
+
+	def __call__(self, *args, **kwargs):
+		if kwargs:
+			# Those change what was worked out, so this one goes the long way
+			return self._shell._run_chain(self._chain, *_filled(self._args, None, args), **dict(self._given, **kwargs))
+		return self._shell._run_template(self._name, _filled(self._argv, self._holes, args), self._options, self._kwargs)
+
+	def __repr__(self):
+		return f"<pyshellTemplate {' '.join(repr(arg) for arg in self._argv)}>"
+
+def _filled(template: tuple, holes, args: tuple) -> list:
+	# The template with args in place of ARG, in order, and the rest added at the end
+	filled = list(template)
+	if holes is None:
+		holes = [index for index, arg in enumerate(template) if arg is ARG]
+	if len(args) < len(holes):
+		raise TypeError(f'expected at least {len(holes)} arguments, got {len(args)}')
+	for index, arg in zip(holes, args):
+		filled[index] = arg
+	filled.extend(args[len(holes):])
+	return filled
+
 class PyshellError(Exception): pass
 
 class CommandNotFound(OSError): pass
@@ -0,0 +1,124 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+import locale
+from subprocess import CalledProcessError
+
+class CommandResult(object):
+	"""A smaller CompletedProcess for when you keep a lot of them, what compact=True gives back.
+
+	It has the same args, returncode, stdout, stderr and check_returncode(), plus usage and the
+	rest of what pyshell adds. There's no __dict__ and the output is kept as the bytes that came
+	off the pipe. With text it's decoded the first time stdout or stderr is read and then kept.
+	Like map and pipelines, \\r\\n is left as it is.
+	"""
+	__slots__ = ('args', 'returncode', 'usage', 'usages', 'returncodes', 'parsed',
+				'truncated', 'stdout_total', 'stderr_total',
+				'_stdout', '_stderr', '_stdout_text', '_stderr_text', '_encoding', '_errors')
+
+	def __init__(self, args, returncode, stdout=None, stderr=None, encoding=None, errors='strict'):
+		"""encoding is what stdout and stderr are decoded with, None leaves them bytes."""
+		self.args = args
+		self.returncode = returncode
+		self.usage = None
+		self._stdout = stdout
+		self._stderr = stderr
+		self._stdout_text = self._stderr_text = None
+		self._encoding = encoding
+		self._errors = errors
+
+	@property
+	def stdout(self):
+		if self._encoding is None or self._stdout is None:
+			return self._stdout
+		if self._stdout_text is None:
+			self._stdout_text = self._stdout.decode(self._encoding, self._errors)
+		return self._stdout_text
+
+	@stdout.setter
+	def stdout(self, value):
+		self._stdout, self._stdout_text = self._raw(value)
+
+	@property
+	def stderr(self):
+		if self._encoding is None or self._stderr is None:
+			return self._stderr
+		if self._stderr_text is None:
+			self._stderr_text = self._stderr.decode(self._encoding, self._errors)
+		return self._stderr_text
+
+	@stderr.setter
+	def stderr(self, value):
+		self._stderr, self._stderr_text = self._raw(value)
+
+	@property
+	def stdout_bytes(self) -> bytes:
+		"""stdout the way the command wrote it."""
+		return self._stdout
+
+	@property
+	def stderr_bytes(self) -> bytes:
+		return self._stderr
+
+	@property
+	def text(self) -> str:
+		"""stdout decoded, even without text=True. It's only decoded once."""
+		if self._stdout is None:
+			return None
+		if self._stdout_text is None:
+			self._stdout_text = self._stdout.decode(self._encoding or locale.getpreferredencoding(False), self._errors)
+		return self._stdout_text
+
+	def lines(self, keepends: bool=False):
+		"""Yield stdout a line at a time as memoryview slices of it. Nothing is copied or decoded.
+
+		bytes(line) or str(line, 'utf-8') for one you want to keep.
+		"""
+		data = self._stdout
+		if not data:
+			return
+		view = memoryview(data)
+		find = data.find
+		start = 0
+		size = len(data)
+		while start < size:
+			end = find(b'\n', start)
+			if end < 0:
+				yield view[start:]
+				return
+			yield view[start:end + 1 if keepends else end]
+			start = end + 1
+
+	def check_returncode(self):
+		"""Raise CalledProcessError if the exit code is non-zero."""
+		if self.returncode:
+			raise CalledProcessError(self.returncode, self.args, self.stdout, self.stderr)
+
+	def _raw(self, value) -> tuple:
+		# Setting stdout or stderr, bytes stay as they are and text is kept as it was given
+		if isinstance(value, str):
+			return value.encode(self._encoding or locale.getpreferredencoding(False), self._errors), value
+		return value, None
+
+	def __repr__(self):
+		args = [f'args={self.args!r}', f'returncode={self.returncode!r}']
+		if self._stdout is not None:
+			args.append(f'stdout={self.stdout!r}')
+		if self._stderr is not None:
+			args.append(f'stderr={self.stderr!r}')
+		return f"{type(self).__name__}({', '.join(args)})"
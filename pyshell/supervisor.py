@@ -0,0 +1,159 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import threading
+import selectors
+from collections import deque
+
+# How often children without a pidfd are polled, on kernels older than 5.3
+_POLL_INTERVAL = 0.05
+
+class Supervisor(object):
+
+	def __init__(self, processes=()):
+		"""Waits on many running commands at once without polling them.
+
+		Arguments:
+			processes: pyshellPopen objects to start with, like what pyshell(popen=True) hands back.
+
+		Every child gets a pidfd in one epoll set. Nothing happens until one of them exits,
+		then only that one is reaped, with a waitpid for its own pid. So there's no waitpid
+		per child per tick and nothing reaps children that aren't ours.
+		A finished process has its returncode and, for a pyshellPopen, its rusage.
+
+		Waiting is meant for one thread at a time, add works from any.
+
+		Example::
+
+		sh = pyshell(popen=True)
+		with Supervisor(sh.rsync('-a', host + ':/srv/', host) for host in hosts) as supervisor:
+			for process in supervisor.as_completed(timeout=600):
+				print(process.args, process.returncode, process.rusage.ru_maxrss)
+		"""
+		self._selector = selectors.DefaultSelector()
+		self._lock = threading.Lock()
+		# Children we couldn't get a pidfd for
+		self._polled = []
+		# Finished and not handed out yet
+		self._done = deque()
+		for process in processes:
+			self.add(process)
+
+	def add(self, process):
+		"""Watch process until it exits. Returns it, so sup.add(sh.sleep('1')) works."""
+		if process.poll() is not None:
+			self._done.append(process)
+			return process
+		try:
+			pidfd = os.pidfd_open(process.pid)
+		except (AttributeError, OSError):
+			# No pidfd_open, or it's gone already. poll() finds out which
+			with self._lock:
+				self._polled.append(process)
+			return process
+		with self._lock:
+			self._selector.register(pidfd, selectors.EVENT_READ, process)
+		return process
+
+	def wait_any(self, timeout: float=None):
+		"""The next process to finish, or None if none did within timeout or there's nothing to wait for."""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while not self._done:
+			if not self.running:
+				return None
+			if deadline is None:
+				remaining = None
+			else:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return None
+			self._reap(remaining)
+		return self._done.popleft()
+
+	def wait_all(self, timeout: float=None) -> list:
+		"""Every process, in the order they finished. Whatever is still running after timeout stays with us."""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		finished = []
+		while True:
+			process = self.wait_any(None if deadline is None else max(deadline - time.monotonic(), 0))
+			if process is None:
+				return finished
+			finished.append(process)
+
+	def as_completed(self, timeout: float=None):
+		"""Yield processes as they finish. Raises TimeoutError if some are still running after timeout."""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while self._done or self.running:
+			process = self.wait_any(None if deadline is None else max(deadline - time.monotonic(), 0))
+			if process is None:
+				raise TimeoutError(f'{self.running} processes still running')
+			yield process
+
+	@property
+	def running(self) -> int:
+		"""How many processes haven't been seen to exit yet."""
+		return len(self._selector.get_map()) + len(self._polled)
+
+	def _reap(self, timeout):
+		if self._polled:
+			timeout = _POLL_INTERVAL if timeout is None else min(timeout, _POLL_INTERVAL)
+		for key, events in self._selector.select(timeout):
+			process = key.data
+			with self._lock:
+				self._selector.unregister(key.fd)
+			os.close(key.fd)
+			# It exited, this is the only waitpid it gets. If another thread is in
+			# the middle of reaping it we'll only wait for that to finish
+			if process.poll() is None:
+				process.wait()
+			self._done.append(process)
+		if self._polled:
+			with self._lock:
+				polled, self._polled = self._polled, []
+			still_running = []
+			for process in polled:
+				if process.poll() is None:
+					still_running.append(process)
+				else:
+					self._done.append(process)
+			with self._lock:
+				self._polled.extend(still_running)
+
+	def close(self):
+		"""Stop watching. Nothing is killed, the processes go on as they were."""
+		with self._lock:
+			for key in list(self._selector.get_map().values()):
+				self._selector.unregister(key.fd)
+				os.close(key.fd)
+			self._selector.close()
+			self._polled.clear()
+		self._done.clear()
+
+	def __len__(self):
+		return self.running + len(self._done)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, value, traceback):
+		self.close()
+
+	def __repr__(self):
+		return f"<Supervisor running={self.running} done={len(self._done)}>"
@@ -0,0 +1,85 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import heapq
+import itertools
+import threading
+
+class Timers(object):
+	"""Runs callbacks after a delay, all of them from one thread.
+
+	There's one of these for the whole process, so a thousand commands waiting
+	to be killed still only cost one thread. The thread starts the first time
+	something is scheduled and then sleeps until the next deadline.
+	Callbacks should be quick, they hold up everything scheduled after them.
+	"""
+	def __init__(self):
+		self._heap = []
+		self._condition = threading.Condition(threading.Lock())
+		self._order = itertools.count()
+		self._thread = None
+
+	def call_later(self, delay: float, callback, *args) -> list:
+		"""Run callback(*args) in delay seconds. Returns a handle for cancel."""
+		entry = [time.monotonic() + delay, next(self._order), callback, args]
+		with self._condition:
+			heapq.heappush(self._heap, entry)
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='pyshell-timers', daemon=True)
+				self._thread.start()
+			elif self._heap[0] is entry:
+				# Sooner than whatever the thread is sleeping on
+				self._condition.notify()
+		return entry
+
+	def cancel(self, entry: list):
+		# It stays in the heap and is skipped when it comes up
+		entry[2] = None
+
+	def _run(self):
+		condition = self._condition
+		heap = self._heap
+		while True:
+			with condition:
+				while True:
+					if not heap:
+						condition.wait()
+						continue
+					remaining = heap[0][0] - time.monotonic()
+					if remaining <= 0:
+						entry = heapq.heappop(heap)
+						break
+					condition.wait(remaining)
+			callback = entry[2]
+			if callback is not None:
+				try:
+					callback(*entry[3])
+				except Exception:
+					# Nobody is around to hear about it. A kill that fails means it's gone already
+					pass
+
+	def _after_fork(self):
+		# The thread didn't come along into the child
+		self._heap.clear()
+		self._condition = threading.Condition(threading.Lock())
+		self._thread = None
+
+_timers = Timers()
+os.register_at_fork(after_in_child=_timers._after_fork)
@@ -0,0 +1,41 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+# Options given to bind are defaults, the call can change them
+
+import asyncio
+
+from pyshell import pyshell, AsyncPyshell
+
+def test_call_overrides_bound_option():
+	sh = pyshell()
+	echo = sh.echo.bind('x', capture_output=True)
+	assert echo().stdout == b'x\n'
+	assert echo(capture_output=False).stdout is None
+	assert echo('y', text=True).stdout == 'x y\n'
+
+def test_call_overrides_bound_option_async():
+	async def main():
+		sh = AsyncPyshell()
+		return await sh.echo.bind('x', capture_output=True)(capture_output=False)
+	assert asyncio.run(main()).stdout is None
+
+def test_bind_overrides_bind():
+	sh = pyshell()
+	echo = sh.echo.bind('x', capture_output=True, text=False).bind(text=True)
+	assert echo().stdout == 'x\n'
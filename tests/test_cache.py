@@ -0,0 +1,66 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+# The cache has to tell apart calls whose results come back in a different shape
+
+import asyncio
+from subprocess import CompletedProcess
+
+from pyshell import pyshell, AsyncPyshell, CommandResult
+
+SEQ = ('-c', 'seq 1 1000')
+
+def test_max_output_in_key():
+	sh = pyshell(capture_output=True, cache=True)
+	capped = sh.sh(*SEQ, max_output=20)
+	full = sh.sh(*SEQ)
+	assert capped.truncated and len(capped.stdout) < 20
+	assert not getattr(full, 'truncated', False)
+	assert full.stdout.count(b'\n') == 1000
+	# And the other way around, with each of them cached now
+	assert sh.sh(*SEQ, max_output=20).stdout == capped.stdout
+	assert sh.sh(*SEQ, max_output=20, keep='head').stdout != capped.stdout
+	assert sh.sh(*SEQ).stdout == full.stdout
+
+def test_max_output_in_key_async():
+	async def main():
+		sh = AsyncPyshell(capture_output=True, cache=True)
+		capped = await sh.sh(*SEQ, max_output=20)
+		full = await sh.sh(*SEQ)
+		return capped, full
+	capped, full = asyncio.run(main())
+	assert capped.truncated
+	assert full.stdout.count(b'\n') == 1000
+
+def test_compact_in_key():
+	sh = pyshell(capture_output=True, cache=True)
+	compact = sh.sh(*SEQ, compact=True)
+	full = sh.sh(*SEQ)
+	assert isinstance(compact, CommandResult)
+	assert isinstance(full, CompletedProcess)
+	assert isinstance(sh.sh(*SEQ, compact=True), CommandResult)
+	assert isinstance(sh.sh(*SEQ), CompletedProcess)
+	assert compact.stdout == full.stdout
+
+def test_compact_and_max_output_in_key():
+	sh = pyshell(capture_output=True, cache=True)
+	both = sh.sh(*SEQ, compact=True, max_output=20)
+	assert isinstance(both, CommandResult) and len(both.stdout) < 20
+	assert isinstance(sh.sh(*SEQ, max_output=20), CompletedProcess)
+	plain = sh.sh(*SEQ)
+	assert isinstance(plain, CompletedProcess) and plain.stdout.count(b'\n') == 1000
@@ -0,0 +1,82 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+# import pyshell has to stay cheap. Everything that isn't needed to run a command is only
+# imported when it's first used, see _lazy in __init__
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+# import pyshell may take at most this many times what the interpreter takes to start.
+# It's about 2 now, it was 8 before the lazy imports
+BUDGET = 3
+RUNS = 5
+
+LAZY = ('pyshell.cache', 'pyshell.parse', 'pyshell.graph', 'pyshell.forkserver',
+	'pyshell.supervisor', 'pyshell.aio', 'asyncio', 'pexpect')
+
+def _import(code: str, env: dict=None) -> subprocess.CompletedProcess:
+	# A fresh interpreter, anything pytest already imported would hide a regression
+	return subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+		capture_output=True, text=True, check=True, env=env)
+
+def _cumulative(stderr: str) -> dict:
+	# Microseconds for each import at the top, with everything it imported
+	times = {}
+	for line in stderr.splitlines():
+		if not line.startswith('import time:'):
+			continue
+		own, cumulative, name = line[len('import time:'):].split('|')
+		if not name.startswith('  ') and cumulative.strip().isdigit():
+			times[name.strip()] = int(cumulative)
+	return times
+
+def _imported(stderr: str) -> set:
+	# -X importtime lines are "import time: self | cumulative | name", nested ones are indented
+	return {line.rsplit('|', 1)[1].strip() for line in stderr.splitlines() if line.startswith('import time:')}
+
+@pytest.mark.parametrize('module', LAZY)
+def test_not_imported(module):
+	process = _import('import sys, pyshell; print(" ".join(sys.modules))')
+	assert module not in process.stdout.split()
+	assert module not in _imported(process.stderr)
+
+def test_shell_stays_lazy():
+	# A first command doesn't need any of them either
+	process = _import('import sys, pyshell; pyshell.shell.true(); print(" ".join(sys.modules))')
+	loaded = set(process.stdout.split())
+	assert not loaded & set(LAZY)
+
+@pytest.mark.parametrize('name, module', [('ResultCache', 'pyshell.cache'), ('TaskGraph', 'pyshell.graph'),
+	('AsyncPyshell', 'pyshell.aio')])
+def test_loaded_on_use(name, module):
+	process = _import(f'import sys, pyshell; pyshell.{name}; print(" ".join(sys.modules))')
+	assert module in process.stdout.split()
+
+def test_import_budget():
+	# Bytecode has to be written for this, compiling every time isn't what anyone pays
+	env = dict(os.environ)
+	env.pop('PYTHONDONTWRITEBYTECODE', None)
+	_import('import pyshell', env)
+	# Best of a few, the noise only ever adds
+	startup = min(sum(_cumulative(_import('pass', env).stderr).values()) for run in range(RUNS))
+	imported = min(_cumulative(_import('import pyshell', env).stderr)['pyshell'] for run in range(RUNS))
+	assert imported < BUDGET * startup, f'import pyshell took {imported} us, starting python {startup} us'
@@ -0,0 +1,45 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+# map and TaskGraph wait on their commands with the same loop, a timeout has to end up the same in both
+
+import time
+from subprocess import CompletedProcess, TimeoutExpired
+
+from pyshell import pyshell, TaskGraph, DependencyFailed
+
+def test_map_timeout():
+	sh = pyshell(capture_output=True)
+	start = time.monotonic()
+	results = list(sh.map(sh.sleep, ['5', '0'], timeout=0.3))
+	assert time.monotonic() - start < 3
+	assert isinstance(results[0], TimeoutExpired)
+	assert isinstance(results[1], CompletedProcess)
+
+def test_graph_timeout():
+	sh = pyshell(capture_output=True)
+	graph = TaskGraph(sh, max_parallel=2)
+	graph.add('slow', sh.sleep, '5', timeout=0.3)
+	graph.add('quick', sh.true)
+	graph.add('after', sh.true, after=['slow'])
+	start = time.monotonic()
+	result = graph.run()
+	assert time.monotonic() - start < 3
+	assert isinstance(result.results['slow'], TimeoutExpired)
+	assert isinstance(result.results['quick'], CompletedProcess)
+	assert isinstance(result.results['after'], DependencyFailed)
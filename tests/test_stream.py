@@ -0,0 +1,54 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+# Streaming hands stdout over as it comes, stderr is kept for the exception but only so much of it
+
+import asyncio
+from subprocess import CalledProcessError
+
+import pytest
+
+from pyshell import pyshell, AsyncPyshell
+
+# 4MiB of x to stderr, then a line of its own to find at the end
+NOISY = ('-c', 'head -c 4194304 /dev/zero | tr "\\0" x >&2; printf "\\nend\\n" >&2; echo out; exit 3')
+
+def test_stderr_is_bounded():
+	sh = pyshell(capture_output=True)
+	with pytest.raises(CalledProcessError) as error:
+		list(sh.sh.iter_lines(*NOISY, check=True))
+	assert len(error.value.stderr) <= 1048576
+	assert error.value.stderr.endswith(b'end\n')
+
+def test_stderr_max_output_and_keep():
+	sh = pyshell(capture_output=True)
+	with pytest.raises(CalledProcessError) as error:
+		list(sh.sh.iter_chunks(*NOISY, check=True, max_output=100, keep='head'))
+	assert error.value.stderr == b'x' * 100
+
+def test_stderr_is_bounded_async():
+	async def main():
+		sh = AsyncPyshell(capture_output=True)
+		lines = []
+		with pytest.raises(CalledProcessError) as error:
+			async for line in sh.sh.iter_lines(*NOISY, check=True, max_output=100):
+				lines.append(line)
+		return lines, error.value.stderr
+	lines, stderr = asyncio.run(main())
+	assert lines == [b'out\n']
+	assert len(stderr) <= 100 and stderr.endswith(b'end\n')
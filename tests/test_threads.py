@@ -0,0 +1,129 @@
+# This file is part of pyshell
+
+# pyshell is a Linux subprocess module.
+# Copyright (C) 2021 Volitank
+
+# pyshell is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyshell is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyshell.  If not, see <https://www.gnu.org/licenses/>.
+
+# Many threads against one shared pyshell and the one PathIndex, while $PATH changes under them
+
+import os
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import pyshell as package
+from pyshell import pyshell
+from pyshell.pyshell import PathIndex
+
+THREADS = 32
+TASKS = 64
+CALLS = 25
+
+@pytest.fixture
+def extra_dir(tmp_path):
+	# A $PATH directory with a program of its own, that comes and goes
+	program = tmp_path / 'pyshell-stress'
+	program.write_text('#!/bin/sh\necho stress\n')
+	program.chmod(0o755)
+	path = os.environ.get('PATH', os.defpath)
+	yield str(tmp_path)
+	os.environ['PATH'] = path
+
+def _toggle_path(directory: str, stop: threading.Event):
+	base = os.environ.get('PATH', os.defpath)
+	while not stop.is_set():
+		os.environ['PATH'] = directory + os.pathsep + base
+		stop.wait(0.002)
+		os.environ['PATH'] = base
+		stop.wait(0.002)
+
+def test_shared_instance_while_path_changes(extra_dir):
+	sh = pyshell(capture_output=True)
+	stop = threading.Event()
+	toggler = threading.Thread(target=_toggle_path, args=(extra_dir, stop))
+	toggler.start()
+
+	def work(task: int) -> list:
+		wrong = []
+		for call in range(CALLS):
+			word = f'{task}-{call}'
+			# Chains from different threads must never get mixed up
+			result = sh.echo.hello(word)
+			if result.stdout != f'hello {word}\n'.encode():
+				wrong.append(result.stdout)
+			if task % 8 == 0:
+				sh.setAlias('true', ['true', str(call)])
+		return wrong
+
+	try:
+		with ThreadPoolExecutor(THREADS) as pool:
+			wrong = [stdout for result in pool.map(work, range(TASKS)) for stdout in result]
+	finally:
+		stop.set()
+		toggler.join()
+	assert wrong == []
+
+def test_shared_index_which_while_path_changes(extra_dir):
+	index = PathIndex()
+	# Every check looks at the directories again
+	index.max_age = 0
+	echo = shutil.which('echo')
+	ours = os.path.join(extra_dir, 'pyshell-stress')
+	stop = threading.Event()
+	toggler = threading.Thread(target=_toggle_path, args=(extra_dir, stop))
+	toggler.start()
+
+	def work(task: int) -> list:
+		wrong = []
+		for call in range(CALLS * 4):
+			found = index.which('echo')
+			if found is None or os.path.basename(found) != 'echo':
+				wrong.append(('echo', found))
+			# Either not on $PATH right now or ours, nothing else
+			found = index.which('pyshell-stress')
+			if found not in (None, ours):
+				wrong.append(('pyshell-stress', found))
+			index.tables()
+		return wrong
+
+	try:
+		with ThreadPoolExecutor(THREADS) as pool:
+			wrong = [miss for result in pool.map(work, range(TASKS)) for miss in result]
+	finally:
+		stop.set()
+		toggler.join()
+	assert echo is not None
+	assert wrong == []
+
+def test_module_shell_made_once(monkeypatch):
+	# pyshell.shell is made the first time it's asked for. Slow that down so every thread gets there first
+	class Slow(pyshell):
+		def __init__(self, *args, **kwargs):
+			time.sleep(0.05)
+			super().__init__(*args, **kwargs)
+	monkeypatch.delitem(vars(package), 'shell', raising=False)
+	monkeypatch.setattr(package, 'pyshell', Slow)
+	barrier = threading.Barrier(THREADS)
+
+	def first(task: int):
+		barrier.wait()
+		return package.shell
+
+	with ThreadPoolExecutor(THREADS) as pool:
+		shells = list(pool.map(first, range(THREADS)))
+	assert len({id(shell) for shell in shells}) == 1